@@ -0,0 +1,458 @@
+import argparse
+import asyncio
+import datetime
+import inspect
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from aiohttp import web
+
+# ═══════════════════════════════════════════════════════════════
+#  Нагрузочные замеры бота без Discord
+#
+#  python bench.py --guilds 1000 --warns 100000 --storage sqlite
+#
+#  Генерирует синтетическую базу, поднимает локальную заглушку Discord
+#  API (с заголовками X-RateLimit-* и ответами 429, как у настоящего),
+#  импортирует bot.py во временной папке и гоняет настоящие обработчики
+#  команд через поддельные Interaction / Guild / Member. По каждому
+#  сценарию — p50/p99, пропускная способность и пиковая память; итоги
+#  дописываются в bench_results.jsonl и сравниваются с прошлым запуском.
+# ═══════════════════════════════════════════════════════════════
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# ─── Синтетическая база ───────────────────────────────────── #
+
+def build_database(path: str, guilds: int, warns: int, notes: int, users: int, seed: int) -> list:
+    """Записать снапшот database.json и вернуть ID серверов."""
+    from storage import default_guild_data, save_snapshot
+
+    rnd = random.Random(seed)
+    now = time.time()
+    ids = [10 ** 17 + i for i in range(guilds)]
+    data = {}
+    for gid in ids:
+        gd = default_guild_data()
+        gd["settings"]["log_channel"] = gid + 1
+        gd["settings"]["welcome_channel"] = gid + 2
+        gd["settings"]["color"] = f"{rnd.randrange(0xFFFFFF):06X}"
+        data[str(gid)] = gd
+    next_id = 1
+    for _ in range(warns):
+        gid = rnd.choice(ids)
+        uid = str(gid + 1000 + rnd.randrange(users))
+        created = now - rnd.randrange(90 * 86400)
+        data[str(gid)]["warns"].setdefault(uid, []).append({
+            "reason": rnd.choice(("спам", "флуд", "оскорбления", "реклама")), "by": "bench", "by_id": 1,
+            "date": "01.01.2025 00:00", "created_at": created, "expires_at": None, "id": next_id,
+        })
+        next_id += 1
+    words = ("сервер", "бан", "ивент", "правила", "модератор", "канал", "роль", "рейд", "спам", "обновление")
+    for _ in range(notes):
+        gid = rnd.choice(ids)
+        data[str(gid)]["notes"].append({
+            "text": " ".join(rnd.choice(words) for _ in range(6)), "by": "bench", "by_id": "1",
+            "date": "01.01.2025 00:00", "id": next_id,
+        })
+        next_id += 1
+    for gd in data.values():
+        for user_warns in gd["warns"].values():
+            user_warns.sort(key=lambda w: w["id"])
+    save_snapshot(path, {"__seq__": next_id, **data})
+    return ids
+
+
+# ─── Заглушка Discord API ─────────────────────────────────── #
+
+class FakeDiscordAPI:
+    """Локальный HTTP-сервер вместо discord.com/api. Лимит — limit
+    запросов за per секунд на маршрут+канал, как у настоящих бакетов;
+    сверх лимита — 429 с retry_after. Задержка сети — latency секунд."""
+
+    def __init__(self, limit: int, per: float, latency: float):
+        self.limit = limit
+        self.per = per
+        self.latency = latency
+        self.buckets: dict = {}
+        self.requests = 0
+        self.limited = 0
+        self.next_id = 10 ** 18
+
+    def _bucket_key(self, method: str, path: str) -> str:
+        # Мажорный параметр (ID канала/взаимодействия) отделяет бакеты
+        parts = path.strip("/").split("/")
+        return f"{method} {'/'.join(parts[:2])}"
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        path = request.match_info["tail"]
+        if path == "users/@me":
+            return web.json_response({"id": "1", "username": "bench", "discriminator": "0", "avatar": None})
+        await asyncio.sleep(self.latency)
+        key = self._bucket_key(request.method, path)
+        now = time.monotonic()
+        remaining, reset_at = self.buckets.get(key, (self.limit, now + self.per))
+        if now >= reset_at:
+            remaining, reset_at = self.limit, now + self.per
+        headers = {
+            "X-RateLimit-Limit": str(self.limit),
+            "X-RateLimit-Reset": f"{time.time() + reset_at - now:.3f}",
+            "X-RateLimit-Reset-After": f"{reset_at - now:.3f}",
+            "X-RateLimit-Bucket": f"{abs(hash(re.sub(r'[0-9]{15,}', '', key))):x}",
+        }
+        if remaining <= 0:
+            self.limited += 1
+            headers.update({"X-RateLimit-Remaining": "0", "X-RateLimit-Scope": "user", "Via": "1.1 google",
+                            "Retry-After": f"{reset_at - now:.3f}"})
+            return web.json_response({"message": "You are being rate limited.", "retry_after": reset_at - now,
+                                      "global": False}, status=429, headers=headers)
+        self.buckets[key] = (remaining - 1, reset_at)
+        headers["X-RateLimit-Remaining"] = str(remaining - 1)
+        self.next_id += 1
+        return web.json_response({"id": str(self.next_id)}, headers=headers)
+
+    async def start(self) -> tuple:
+        app = web.Application()
+        app.router.add_route("*", "/api/v10/{tail:.*}", self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return runner, f"http://127.0.0.1:{port}/api/v10"
+
+
+# ─── Поддельные объекты discord.py ────────────────────────── #
+
+class FakeAsset:
+    url = "https://cdn.discordapp.com/embed/avatars/0.png"
+
+
+class FakeMember:
+    def __init__(self, uid: int, guild: "FakeGuild"):
+        self.id = uid
+        self.guild = guild
+        self.name = f"user{uid % 100000}"
+        self.display_name = self.name
+        self.mention = f"<@{uid}>"
+        self.display_avatar = FakeAsset()
+        self.bot = False
+        self.joined_at = datetime.datetime.now(datetime.timezone.utc)
+
+    def __str__(self):
+        return self.name
+
+
+class FakeChannel:
+    def __init__(self, cid: int, guild: "FakeGuild", http):
+        self.id = cid
+        self.guild = guild
+        self.name = f"channel-{cid % 1000}"
+        self.mention = f"<#{cid}>"
+        self.http = http
+
+    async def send(self, content=None, *, embed=None, embeds=None, **kwargs):
+        from discord.http import Route
+        embeds = embeds or ([embed] if embed else [])
+        payload = {"content": content, "embeds": [e.to_dict() for e in embeds]}
+        return await self.http.request(Route("POST", "/channels/{channel_id}/messages", channel_id=self.id), json=payload)
+
+
+class FakeGuild:
+    def __init__(self, gid: int, http):
+        self.id = gid
+        self.name = f"guild-{gid % 100000}"
+        self.icon = None
+        self.owner_id = 1
+        self.member_count = 5000
+        self.members: dict = {}
+        self.channels = {cid: FakeChannel(cid, self, http) for cid in (gid + 1, gid + 2)}
+
+    def get_member(self, uid: int):
+        return self.members.get(uid)
+
+    def get_channel(self, cid: int):
+        return self.channels.get(cid)
+
+    def get_role(self, rid: int):
+        return None
+
+    def member(self, uid: int) -> FakeMember:
+        m = self.members.get(uid)
+        if m is None:
+            m = self.members[uid] = FakeMember(uid, self)
+        return m
+
+
+class FakeResponse:
+    def __init__(self, interaction: "FakeInteraction"):
+        self.interaction = interaction
+        self.done = False
+
+    def is_done(self) -> bool:
+        return self.done
+
+    async def _callback(self, kind: int, embed=None, content=None):
+        from discord.http import Route
+        self.done = True
+        data = {"content": content, "embeds": [embed.to_dict()] if embed else []}
+        route = Route("POST", "/interactions/{interaction_id}/{interaction_token}/callback",
+                      interaction_id=self.interaction.id, interaction_token="bench")
+        await self.interaction.http.request(route, json={"type": kind, "data": data})
+
+    async def send_message(self, content=None, *, embed=None, view=None, ephemeral=False, **kwargs):
+        await self._callback(4, embed, content)
+
+    async def defer(self, **kwargs):
+        await self._callback(5)
+
+    async def edit_message(self, *, embed=None, view=None, **kwargs):
+        await self._callback(7, embed)
+
+
+class FakeFollowup:
+    def __init__(self, interaction: "FakeInteraction"):
+        self.interaction = interaction
+
+    async def send(self, content=None, *, embed=None, **kwargs):
+        await self.interaction.channel.send(content, embed=embed)
+
+
+class FakeInteraction:
+    _ids = 10 ** 18
+
+    def __init__(self, guild: FakeGuild, user: FakeMember, http):
+        FakeInteraction._ids += 1
+        self.id = FakeInteraction._ids
+        self.http = http
+        self.guild = guild
+        self.guild_id = guild.id
+        self.user = user
+        self.channel = guild.get_channel(guild.id + 1)
+        self.command = None
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+
+
+# ─── Замеры ───────────────────────────────────────────────── #
+
+def percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def _call(fn, i: int):
+    result = fn(i)
+    if inspect.isawaitable(result):
+        await result
+
+
+async def measure(fn, iterations: int, memory_iterations: int) -> dict:
+    """Прогон на время, затем короткий прогон под tracemalloc — он сам
+    замедляет код, поэтому на задержки не влияет."""
+    latencies = []
+    started = time.perf_counter()
+    for i in range(iterations):
+        t = time.perf_counter()
+        await _call(fn, i)
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - started
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    for i in range(memory_iterations):
+        await _call(fn, iterations + i)
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return {
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "ops_per_s": round(iterations / elapsed, 1),
+        "peak_kb": round(peak / 1024, 1),
+    }
+
+
+def scenarios(bot, guilds: list, users: int, rnd: random.Random) -> dict:
+    def pick():
+        guild = rnd.choice(guilds)
+        return guild, guild.member(guild.id + 1000 + rnd.randrange(users))
+
+    async def update(i):
+        guild = rnd.choice(guilds)
+        gd = bot.get_guild_data(guild.id)
+        gd["settings"]["color"] = f"{i % 0xFFFFFF:06X}"
+        await bot.update_guild_data(guild.id, gd)
+
+    async def warn(i):
+        guild, member = pick()
+        await bot.warn_cmd.callback(FakeInteraction(guild, guild.member(1), guild.http), member, "bench")
+
+    async def warns(i):
+        guild, member = pick()
+        await bot.warns_cmd.callback(FakeInteraction(guild, guild.member(1), guild.http), member)
+
+    async def notes_search(i):
+        guild = rnd.choice(guilds)
+        await bot.notes_cmd.callback(FakeInteraction(guild, guild.member(1), guild.http), "бан правила")
+
+    async def member_join(i):
+        guild = rnd.choice(guilds)
+        await bot.on_member_join(guild.member(guild.id + 10 ** 6 + i))
+
+    return {
+        "get_guild_data": lambda i: bot.get_guild_data(rnd.choice(guilds).id),
+        "update_guild_data": update,
+        "Style.embed": lambda i: bot.Style.embed("Заголовок", "Текст", guild=rnd.choice(guilds)),
+        "warn_cmd": warn,
+        "warns_cmd": warns,
+        "notes_search": notes_search,
+        "on_member_join": member_join,
+    }
+
+
+# ─── Результаты ───────────────────────────────────────────── #
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def previous_run(path: str, params: dict):
+    last = None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    run = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if run.get("params") == params:
+                    last = run
+    except FileNotFoundError:
+        pass
+    return last
+
+
+def report(results: dict, previous, threshold: float, min_delta_ms: float):
+    print(f"\n{'сценарий':<20}{'p50 мс':>10}{'p99 мс':>10}{'оп/с':>12}{'пик КБ':>10}   сравнение")
+    regressions = 0
+    for name, r in results.items():
+        delta = ""
+        old = (previous or {}).get("results", {}).get(name)
+        if old:
+            change = (r["p99_ms"] - old["p99_ms"]) / old["p99_ms"] if old["p99_ms"] else 0.0
+            delta = f"p99 {change:+.0%} (было {old['p99_ms']} мс, {previous['commit']})"
+            # Субмиллисекундные сценарии шумят в разы — считаем только заметный рост
+            if change > threshold and r["p99_ms"] - old["p99_ms"] > min_delta_ms:
+                delta += "  ⚠️ регресс"
+                regressions += 1
+        print(f"{name:<20}{r['p50_ms']:>10}{r['p99_ms']:>10}{r['ops_per_s']:>12}{r['peak_kb']:>10}   {delta}")
+    return regressions
+
+
+# ─── Запуск ───────────────────────────────────────────────── #
+
+async def run(args) -> dict:
+    import discord
+    from discord.http import Route
+
+    import bot
+
+    logging.getLogger("discord").setLevel(logging.ERROR)
+    bot.log.setLevel(logging.WARNING)
+    api = FakeDiscordAPI(args.api_limit, args.api_per, args.api_latency_ms / 1000)
+    runner, base = await api.start()
+    Route.BASE = base
+    await bot.bot.http.static_login("bench")
+
+    rnd = random.Random(args.seed)
+    guilds = [FakeGuild(gid, bot.bot.http) for gid in args.guild_ids]
+    for guild in guilds:
+        guild.http = bot.bot.http
+    by_id = {g.id: g for g in guilds}
+    bot.bot.get_guild = by_id.get
+
+    results = {"load_db": {"p50_ms": round(args.load_seconds * 1000, 1), "p99_ms": round(args.load_seconds * 1000, 1),
+                           "ops_per_s": 0.0, "peak_kb": 0.0}}
+    for name, fn in scenarios(bot, guilds, args.users, rnd).items():
+        if args.only and name not in args.only:
+            continue
+        results[name] = await measure(fn, args.iterations, args.memory_iterations)
+        print(f"  ✔ {name}")
+
+    # Дать фоновым очередям (логи, приветствия) дослать накопленное
+    await asyncio.sleep(max(bot.JOIN_WINDOW, bot.LOG_LINGER) + 0.5)
+    await bot.store.flush()
+    await bot.bot.http.close()
+    await runner.cleanup()
+    return results, {"requests": api.requests, "rate_limited": api.limited}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочные замеры бота на синтетических данных")
+    parser.add_argument("--guilds", type=int, default=1000)
+    parser.add_argument("--warns", type=int, default=100000)
+    parser.add_argument("--notes", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=500, help="участников с варнами на сервер")
+    parser.add_argument("--storage", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--memory-iterations", type=int, default=200)
+    parser.add_argument("--api-limit", type=int, default=5, help="запросов на бакет заглушки API")
+    parser.add_argument("--api-per", type=float, default=5.0, help="окно бакета, секунд")
+    parser.add_argument("--api-latency-ms", type=float, default=5.0)
+    parser.add_argument("--only", nargs="*", help="только эти сценарии")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", default=os.path.join(REPO_DIR, "bench_results.jsonl"))
+    parser.add_argument("--threshold", type=float, default=0.2, help="рост p99, который считается регрессом")
+    parser.add_argument("--min-delta-ms", type=float, default=1.0, help="меньший рост p99 не считается регрессом")
+    args = parser.parse_args()
+
+    params = {k: getattr(args, k) for k in ("guilds", "warns", "notes", "users", "storage", "iterations",
+                                            "api_limit", "api_per", "api_latency_ms", "seed")}
+    sys.path.insert(0, REPO_DIR)
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    os.chdir(workdir)
+    print(f"⚙️  Генерация базы: {args.guilds} серверов, {args.warns} варнов, {args.notes} заметок → {workdir}")
+    args.guild_ids = build_database("database.json", args.guilds, args.warns, args.notes, args.users, args.seed)
+    with open("config.json", "w", encoding="utf-8") as f:
+        json.dump({"TOKEN": "bench", "STORAGE": args.storage, "LOG_LEVEL": "WARNING", "JOIN_WINDOW": 0.05,
+                   "MEMBER_CACHE": "none", "NOTES_LIMIT": max(1000, args.notes)}, f)
+
+    started = time.perf_counter()
+    import bot  # noqa: F401 — загрузка базы происходит при импорте
+    args.load_seconds = time.perf_counter() - started
+    print(f"📂 База загружена за {args.load_seconds:.2f}с")
+
+    results, api = asyncio.run(run(args))
+    previous = previous_run(args.out, params)
+    regressions = report(results, previous, args.threshold, args.min_delta_ms)
+    print(f"\n🌐 Запросов к заглушке API: {api['requests']}, 429: {api['rate_limited']}")
+
+    record = {"at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+              "commit": git_commit(), "params": params, "results": results, "api": api}
+    with open(args.out, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    print(f"💾 Результаты дописаны в {args.out}")
+
+    bot.store.close()
+    bot.log_listener.stop()
+    os.chdir(REPO_DIR)
+    shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
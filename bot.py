@@ -1,13 +1,42 @@
+import aiohttp
 import discord
 from discord import app_commands, ui
 from discord.ext import commands, tasks
 import json
 import datetime
 import asyncio
+import copy
+import functools
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
+import logging
+import logging.handlers
 import os
+import queue
+import re
+import shutil
+import subprocess
+import sys
 import time
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from dataclasses import dataclass
 from typing import Optional
 
+from metrics import Registry, serve_metrics
+from storage import AsyncStorage, open_storage
+
+BOOT_STARTED = time.perf_counter()
+boot_marks: list = []   # (этап, секунды с прошлой отметки) — печатаются в первом on_ready
+
+
+def boot_mark(stage: str):
+    last = sum(t for _, t in boot_marks)
+    boot_marks.append((stage, time.perf_counter() - BOOT_STARTED - last))
+
 # ─── Фикс SSL для Windows ────────────────────────────────── #
 try:
     import certifi
@@ -32,56 +61,167 @@ with open("config.json", "r", encoding="utf-8") as f:
 TOKEN = config["TOKEN"]
 OWNER_IDS = config.get("OWNER_IDS", [])
 
-# ─── База данных (JSON) ──────────────────────────────────── #
+# ─── Кластер ──────────────────────────────────────────────── #
+# `python bot.py --cluster` запускает CLUSTERS процессов бота. Каждый
+# получает свой диапазон из SHARD_COUNT шардов, а данные серверов все
+# процессы делят через общую SQLite-базу (см. storage.SqliteBackend).
 
-DB_FILE = "database.json"
+CLUSTERS = config.get("CLUSTERS", 1)
+CLUSTER_ID = int(os.environ["BOT_CLUSTER_ID"]) if os.environ.get("BOT_CLUSTER_ID") else None
 
-def load_db():
+def run_cluster():
+    procs = []
+    for i in range(CLUSTERS):
+        env = dict(os.environ, BOT_CLUSTER_ID=str(i))
+        procs.append(subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env))
     try:
-        with open(DB_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
+        for p in procs:
+            p.wait()
+    except KeyboardInterrupt:
+        for p in procs:
+            p.terminate()
+        for p in procs:
+            p.wait()
+
+def cluster_shards(cluster_id: int, clusters: int, shard_count: int) -> list:
+    per = -(-shard_count // clusters)
+    return list(range(cluster_id * per, min((cluster_id + 1) * per, shard_count)))
+
+if __name__ == "__main__" and "--cluster" in sys.argv:
+    run_cluster()
+    sys.exit(0)
+
+# ─── Журнал работы бота ───────────────────────────────────── #
+# Не путать с лог-каналом Discord (_log_action): это журнал самого
+# процесса. Каждая запись — строка JSON в LOG_FILE; файл ротируется по
+# размеру и по времени, старые части сжимаются в .gz. Обработчики пишут
+# в очередь, а на диск записи уходят из отдельного потока, так что event
+# loop никогда не ждёт файловую систему.
+
+LOG_FILE = config.get("LOG_FILE", "logs/bot.log")
+LOG_LEVEL = config.get("LOG_LEVEL", "INFO")
+LOG_MAX_BYTES = config.get("LOG_MAX_BYTES", 10 * 1024 * 1024)
+LOG_ROTATE_HOURS = config.get("LOG_ROTATE_HOURS", 24)
+LOG_BACKUPS = config.get("LOG_BACKUPS", 14)
+
+_STD_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        # Поля из extra={...} попадают в запись как есть
+        entry.update({k: v for k, v in vars(record).items() if k not in _STD_RECORD_FIELDS})
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def _gzip_rotate(source: str, dest: str):
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+class CompressingFileHandler(logging.handlers.RotatingFileHandler):
+    """Ротация по размеру или раз в interval секунд: bot.log → bot.log.1.gz → …"""
+
+    def __init__(self, path: str, max_bytes: int, interval: float, backups: int):
+        super().__init__(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8", delay=True)
+        self.interval = interval
+        self.rollover_at = time.time() + interval
+        self.namer = lambda name: name + ".gz"
+        self.rotator = _gzip_rotate
 
-def save_db(data):
-    with open(DB_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    def shouldRollover(self, record) -> bool:
+        if self.interval and time.time() >= self.rollover_at:
+            if self.stream is not None and self.stream.tell():
+                return True
+            self.rollover_at = time.time() + self.interval
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = time.time() + self.interval
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Трейсбек форматируем сразу, но отдельно от текста — в JSON это поле exc
+        record = copy.copy(record)
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+def setup_logging() -> logging.handlers.QueueListener:
+    path = LOG_FILE
+    if CLUSTER_ID is not None:
+        # У каждого процесса кластера свой файл — ротация не делится между ними
+        base, ext = os.path.splitext(LOG_FILE)
+        path = f"{base}-cluster{CLUSTER_ID}{ext}"
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    file_handler = CompressingFileHandler(path, LOG_MAX_BYTES, LOG_ROTATE_HOURS * 3600, LOG_BACKUPS)
+    file_handler.setFormatter(JsonFormatter())
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter("%(asctime)s %(levelname)-7s %(message)s", "%H:%M:%S"))
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(LogQueueHandler(records))
+    logging.getLogger("bot").setLevel(LOG_LEVEL)
+    listener = logging.handlers.QueueListener(records, file_handler, console)
+    listener.start()
+    return listener
+
+
+log_listener = setup_logging()
+log = logging.getLogger("bot")
+
+# ─── База данных ─────────────────────────────────────────── #
+
+STORAGE = config.get("STORAGE", "json")   # "json" или "sqlite"
+if CLUSTER_ID is not None:
+    # JSON-файл нельзя делить между процессами — в кластере только SQLite
+    STORAGE = "sqlite"
+DB_FILE = "database.json"
+JOURNAL_FILE = "database.journal"
+SQLITE_FILE = config.get("SQLITE_FILE", "database.sqlite3")
+# Как часто изменения сбрасываются на диск (сек) — это и есть максимум
+# данных, которые можно потерять при падении процесса.
+DB_FLUSH_INTERVAL = config.get("DB_FLUSH_INTERVAL", 10)
+# Если несброшенных изменений накопилось больше — пишем не дожидаясь таймера.
+DB_MAX_DIRTY = config.get("DB_MAX_DIRTY", 50)
+# Журнал сворачивается в снапшот по таймеру или когда вырастает больше лимита.
+DB_COMPACT_INTERVAL = config.get("DB_COMPACT_INTERVAL", 300)
+DB_JOURNAL_MAX_BYTES = config.get("DB_JOURNAL_MAX_BYTES", 1024 * 1024)
+# Сколько последних варнов хранится на участника (старые вытесняются)
+WARN_HISTORY_LIMIT = config.get("WARN_HISTORY_LIMIT", 100)
+# Сколько заметок держит JSON-хранилище (в SQLite без ограничения)
+NOTES_LIMIT = config.get("NOTES_LIMIT", 1000)
+
+store = AsyncStorage(open_storage(
+    STORAGE, json_file=DB_FILE, journal_file=JOURNAL_FILE, sqlite_file=SQLITE_FILE,
+    max_pending=DB_MAX_DIRTY, journal_max_bytes=DB_JOURNAL_MAX_BYTES,
+    shared=CLUSTER_ID is not None, warn_limit=WARN_HISTORY_LIMIT, notes_limit=NOTES_LIMIT,
+))
+store.load()
+boot_mark("загрузка конфига и базы")
 
 def get_guild_data(guild_id: int) -> dict:
-    db = load_db()
-    key = str(guild_id)
-    if key not in db:
-        db[key] = {
-            "settings": {
-                "color": "5865F2",
-                "log_channel": None,
-                "status_channel": None,
-                "welcome_channel": None,
-                "welcome_message": "Добро пожаловать на сервер, {user}! 🎉",
-                "autorole": None,
-            },
-            "status": {
-                "state": "none",
-                "reason": "",
-                "estimated_time": "",
-                "additional_info": "",
-                "updated_by": "",
-                "updated_at": "",
-            },
-            "warns": {},
-            "tickets": {
-                "counter": 0,
-                "category": None,
-            },
-            "notes": [],
-        }
-        save_db(db)
-    return db[key]
+    return store.get(guild_id)
 
-def update_guild_data(guild_id: int, data: dict):
-    db = load_db()
-    db[str(guild_id)] = data
-    save_db(db)
+async def update_guild_data(guild_id: int, data: dict, flush: bool = False):
+    invalidate_settings(guild_id)
+    await store.put(guild_id, data, flush=flush)
 
 # ─── Стили и оформление ──────────────────────────────────── #
 
@@ -99,16 +239,11 @@ class Style:
     MAINT    = 0xE67E22
 
     @staticmethod
-    def embed(title="", desc="", color=None, guild=None):
+    def embed(title="", desc="", color=None, guild=None, settings=None):
         if color is None:
-            if guild:
-                gd = get_guild_data(guild.id)
-                try:
-                    color = int(gd["settings"]["color"], 16)
-                except:
-                    color = Style.MAIN
-            else:
-                color = Style.MAIN
+            if settings is None and guild:
+                settings = get_settings(guild.id)
+            color = settings.color if settings else Style.MAIN
         e = discord.Embed(title=title, description=desc, color=color, timestamp=datetime.datetime.now(datetime.timezone.utc))
         return e
 
@@ -121,16 +256,123 @@ class Style:
         return embed
 
 
+# ─── Настройки сервера (кэш) ─────────────────────────────── #
+
+@dataclass(frozen=True)
+class GuildSettings:
+    color: int
+    color_hex: str
+    log_channel: Optional[int]
+    status_channel: Optional[int]
+    welcome_channel: Optional[int]
+    welcome_message: str
+    welcome_parts: tuple
+    autorole: Optional[int]
+    warn_expire_days: int
+    antiraid: Optional[dict]    # пороги защиты или None, если выключена
+
+    def render_welcome(self, values: dict) -> str:
+        return "".join(values.get(part[1:], part) if part.startswith("\0") else part for part in self.welcome_parts)
+
+    @classmethod
+    def from_dict(cls, s: dict) -> "GuildSettings":
+        try:
+            color = int(s.get("color", ""), 16)
+        except (TypeError, ValueError):
+            color = Style.MAIN
+        welcome = s.get("welcome_message", "Добро пожаловать, {user}!")
+        return cls(
+            color=color,
+            color_hex=s.get("color", "5865F2"),
+            log_channel=s.get("log_channel"),
+            status_channel=s.get("status_channel"),
+            welcome_channel=s.get("welcome_channel"),
+            welcome_message=welcome,
+            welcome_parts=compile_template(welcome),
+            autorole=s.get("autorole"),
+            warn_expire_days=s.get("warn_expire_days", 0),
+            antiraid={**ANTIRAID_DEFAULTS, **s["antiraid"]} if s.get("antiraid", {}).get("enabled") else None,
+        )
+
+
+_TEMPLATE_VAR = re.compile(r"\{(user|server|count)\}")
+
+def compile_template(text: str) -> tuple:
+    """Разбить шаблон на куски один раз: переменные помечаются префиксом \\0,
+    остальное — готовый текст. Подстановка — один проход без str.replace."""
+    parts = []
+    pos = 0
+    for m in _TEMPLATE_VAR.finditer(text):
+        if m.start() > pos:
+            parts.append(text[pos:m.start()])
+        parts.append("\0" + m.group(1))
+        pos = m.end()
+    if pos < len(text):
+        parts.append(text[pos:])
+    return tuple(parts)
+
+
+_settings_cache: dict = {}
+
+def get_settings(guild_id: int) -> GuildSettings:
+    gs = _settings_cache.get(guild_id)
+    if gs is None:
+        gs = _settings_cache[guild_id] = GuildSettings.from_dict(get_guild_data(guild_id)["settings"])
+    return gs
+
+def invalidate_settings(guild_id: int):
+    _settings_cache.pop(guild_id, None)
+
+
 # ─── Бот ──────────────────────────────────────────────────── #
 
 intents = discord.Intents.default()
 intents.guilds = True
-# Включи в Developer Portal для приветствий и авторолей:
-# intents.members = True
-# intents.message_content = True
-
-bot = commands.Bot(command_prefix="!", intents=intents)
+# Привилегированные интенты — сначала включи их в Developer Portal.
+# members нужен приветствиям, авторолям и защите от рейдов (входы),
+# message_content — защите от спама (повторы одинаковых сообщений).
+intents.members = config.get("MEMBERS_INTENT", False)
+intents.message_content = config.get("MESSAGE_CONTENT_INTENT", False)
+
+# Кэш участников. discord.py по умолчанию держит в памяти каждого
+# участника и при включённом members-интенте качает их всех при запуске —
+# на больших серверах это гигабайты и долгий on_ready.
+#   "none"        — не кэшировать участников вообще;
+#   "interaction" — только тех, кто пользовался ботом, и новых вошедших
+#                   (нужен MEMBERS_INTENT, без него — как "none");
+#   "full"        — всех; серверы из CHUNK_GUILDS (или все, если список
+#                   пуст) догружаются в фоне уже после on_ready.
+MEMBER_CACHE = config.get("MEMBER_CACHE", "interaction")
+CHUNK_GUILDS = set(config.get("CHUNK_GUILDS", []))
+MEMBER_CACHE_LIMIT = config.get("MEMBER_CACHE_LIMIT", 50000)   # потолок для "interaction" на сервер
+if MEMBER_CACHE == "full" and intents.members:
+    member_cache_flags = discord.MemberCacheFlags.from_intents(intents)
+elif MEMBER_CACHE == "interaction" and intents.members:
+    member_cache_flags = discord.MemberCacheFlags(voice=False, joined=True)
+else:
+    member_cache_flags = discord.MemberCacheFlags.none()
+
+# Шардинг: "AUTO_SHARD": true — Discord сам скажет, сколько шардов нужно;
+# "SHARD_COUNT" + "SHARD_IDS" — запустить только свои шарды из общего числа.
+# Все шарды живут в одном event loop, поэтому доступ к данным серверов
+# по-прежнему идёт через один поток хранилища и остаётся безопасным.
+SHARD_COUNT = config.get("SHARD_COUNT")
+SHARD_IDS = config.get("SHARD_IDS")
+if CLUSTER_ID is not None:
+    if not SHARD_COUNT:
+        sys.exit("❌ Для кластера укажи SHARD_COUNT в config.json")
+    SHARD_IDS = cluster_shards(CLUSTER_ID, CLUSTERS, SHARD_COUNT)
+    log.info("🧩 Кластер %s/%s: шарды %s", CLUSTER_ID, CLUSTERS, SHARD_IDS)
+SHARDED = bool(config.get("AUTO_SHARD") or SHARD_COUNT or SHARD_IDS)
+
+if SHARDED:
+    bot = commands.AutoShardedBot(command_prefix="!", intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS,
+                                  member_cache_flags=member_cache_flags, chunk_guilds_at_startup=False)
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents,
+                       member_cache_flags=member_cache_flags, chunk_guilds_at_startup=False)
 start_time = time.time()
+_chunk_task: Optional[asyncio.Task] = None
 
 # ─── Проверки прав ────────────────────────────────────────── #
 
@@ -143,11 +385,13 @@ def is_admin():
         try:
             if interaction.user.guild_permissions.administrator:
                 return True
-        except: pass
+        except AttributeError:
+            log.debug("Нет guild_permissions у %s", interaction.user)
         try:
             if interaction.user.resolved_permissions and interaction.user.resolved_permissions.administrator:
                 return True
-        except: pass
+        except AttributeError:
+            log.debug("Нет resolved_permissions у %s", interaction.user)
         return False
     return app_commands.check(predicate)
 
@@ -161,12 +405,14 @@ def is_mod():
             p = interaction.user.guild_permissions
             if p.administrator or p.manage_guild or p.manage_messages or p.kick_members or p.ban_members:
                 return True
-        except: pass
+        except AttributeError:
+            log.debug("Нет guild_permissions у %s", interaction.user)
         try:
             p = interaction.user.resolved_permissions
             if p and (p.administrator or p.manage_guild or p.manage_messages):
                 return True
-        except: pass
+        except AttributeError:
+            log.debug("Нет resolved_permissions у %s", interaction.user)
         return False
     return app_commands.check(predicate)
 
@@ -190,7 +436,7 @@ class WelcomeModal(ui.Modal, title="👋 Настройка приветстви
     async def on_submit(self, interaction: discord.Interaction):
         gd = get_guild_data(self.guild_id)
         gd["settings"]["welcome_message"] = self.message.value
-        update_guild_data(self.guild_id, gd)
+        await update_guild_data(self.guild_id, gd)
         e = Style.embed("✅ Приветствие обновлено", color=Style.SUCCESS, guild=interaction.guild)
         e.add_field(name="Текст", value=self.message.value, inline=False)
         e.add_field(name="Переменные", value="`{user}` — упоминание\n`{server}` — название\n`{count}` — номер участника", inline=False)
@@ -211,7 +457,7 @@ class ColorModal(ui.Modal, title="🎨 Цвет бота"):
             return await interaction.response.send_message("❌ Неверный HEX!", ephemeral=True)
         gd = get_guild_data(self.guild_id)
         gd["settings"]["color"] = self.color.value.upper()
-        update_guild_data(self.guild_id, gd)
+        await update_guild_data(self.guild_id, gd)
         c = int(self.color.value, 16)
         e = Style.embed("🎨 Цвет обновлён!", f"Новый цвет: `#{self.color.value.upper()}`", color=c)
         Style.footer(e, interaction.user)
@@ -247,23 +493,22 @@ class SetupView(ui.View):
 @bot.tree.command(name="setup", description="⚙️ Панель настроек бота")
 @is_admin()
 async def setup_cmd(interaction: discord.Interaction):
-    gd = get_guild_data(interaction.guild.id)
-    s = gd["settings"]
+    s = get_settings(interaction.guild.id)
 
-    e = Style.embed(guild=interaction.guild)
+    e = Style.embed(settings=s)
     e.title = "⚙️  Панель настроек"
     e.description = "Настрой бота под свой сервер.\nНажми кнопки или используй `/settings`"
 
-    log_ch = f"<#{s['log_channel']}>" if s["log_channel"] else "`не установлен`"
-    status_ch = f"<#{s['status_channel']}>" if s["status_channel"] else "`не установлен`"
-    welcome_ch = f"<#{s['welcome_channel']}>" if s["welcome_channel"] else "`не установлен`"
-    autorole = f"<@&{s['autorole']}>" if s["autorole"] else "`не установлена`"
+    log_ch = f"<#{s.log_channel}>" if s.log_channel else "`не установлен`"
+    status_ch = f"<#{s.status_channel}>" if s.status_channel else "`не установлен`"
+    welcome_ch = f"<#{s.welcome_channel}>" if s.welcome_channel else "`не установлен`"
+    autorole = f"<@&{s.autorole}>" if s.autorole else "`не установлена`"
 
     e.add_field(name="📝 Канал логов", value=log_ch, inline=True)
     e.add_field(name="📊 Канал статуса", value=status_ch, inline=True)
     e.add_field(name="👋 Приветствия", value=welcome_ch, inline=True)
     e.add_field(name="🎭 Авто-роль", value=autorole, inline=True)
-    e.add_field(name="🎨 Цвет", value=f"`#{s['color']}`", inline=True)
+    e.add_field(name="🎨 Цвет", value=f"`#{s.color_hex}`", inline=True)
     e.add_field(name="\u200b", value="\u200b", inline=True)
 
     if interaction.guild.icon:
@@ -282,7 +527,7 @@ settings_group = app_commands.Group(name="settings", description="⚙️ Нас
 async def settings_logs(interaction: discord.Interaction, channel: discord.TextChannel):
     gd = get_guild_data(interaction.guild.id)
     gd["settings"]["log_channel"] = channel.id
-    update_guild_data(interaction.guild.id, gd)
+    await update_guild_data(interaction.guild.id, gd)
     e = Style.embed("✅ Канал логов", f"Логи → {channel.mention}", Style.SUCCESS, interaction.guild)
     Style.footer(e, interaction.user)
     await interaction.response.send_message(embed=e, ephemeral=True)
@@ -293,7 +538,7 @@ async def settings_logs(interaction: discord.Interaction, channel: discord.TextC
 async def settings_status_channel(interaction: discord.Interaction, channel: discord.TextChannel):
     gd = get_guild_data(interaction.guild.id)
     gd["settings"]["status_channel"] = channel.id
-    update_guild_data(interaction.guild.id, gd)
+    await update_guild_data(interaction.guild.id, gd)
     e = Style.embed("✅ Канал статуса", f"Уведомления → {channel.mention}", Style.SUCCESS, interaction.guild)
     Style.footer(e, interaction.user)
     await interaction.response.send_message(embed=e, ephemeral=True)
@@ -304,7 +549,7 @@ async def settings_status_channel(interaction: discord.Interaction, channel: dis
 async def settings_welcome_channel(interaction: discord.Interaction, channel: discord.TextChannel):
     gd = get_guild_data(interaction.guild.id)
     gd["settings"]["welcome_channel"] = channel.id
-    update_guild_data(interaction.guild.id, gd)
+    await update_guild_data(interaction.guild.id, gd)
     e = Style.embed("✅ Канал приветствий", f"Приветствия → {channel.mention}", Style.SUCCESS, interaction.guild)
     Style.footer(e, interaction.user)
     await interaction.response.send_message(embed=e, ephemeral=True)
@@ -315,14 +560,128 @@ async def settings_welcome_channel(interaction: discord.Interaction, channel: di
 async def settings_autorole(interaction: discord.Interaction, role: discord.Role):
     gd = get_guild_data(interaction.guild.id)
     gd["settings"]["autorole"] = role.id
-    update_guild_data(interaction.guild.id, gd)
+    await update_guild_data(interaction.guild.id, gd)
     e = Style.embed("✅ Авто-роль", f"Новым → {role.mention}", Style.SUCCESS, interaction.guild)
     Style.footer(e, interaction.user)
     await interaction.response.send_message(embed=e, ephemeral=True)
 
+@settings_group.command(name="warn-expiry", description="⌛ Срок жизни варнов")
+@is_admin()
+@app_commands.describe(days="Через сколько дней варн снимается (0 = никогда)")
+async def settings_warn_expiry(interaction: discord.Interaction, days: app_commands.Range[int, 0, 3650]):
+    gd = get_guild_data(interaction.guild.id)
+    gd["settings"]["warn_expire_days"] = days
+    await update_guild_data(interaction.guild.id, gd)
+    text = f"Новые варны снимаются через **{days}** дн." if days else "Варны больше не истекают"
+    e = Style.embed("✅ Срок варнов", text, Style.SUCCESS, interaction.guild)
+    Style.footer(e, interaction.user)
+    await interaction.response.send_message(embed=e, ephemeral=True)
+
+@settings_group.command(name="status-followers", description="📡 Кто может подписаться на статус")
+@is_admin()
+@app_commands.describe(server_id="ID сервера, которому разрешить или запретить /status-follow", allow="Разрешить (по умолчанию) или запретить")
+async def settings_status_followers(interaction: discord.Interaction, server_id: str, allow: bool = True):
+    if not server_id.isdigit():
+        return await interaction.response.send_message("❌ Неверный ID.", ephemeral=True)
+    follower = int(server_id)
+
+    def change(gd):
+        allowed = gd["settings"].setdefault("status_followers", [])
+        if allow and follower not in allowed:
+            allowed.append(follower)
+        elif not allow:
+            gd["settings"]["status_followers"] = [g for g in allowed if g != follower]
+            # Запрет снимает и уже оформленные подписки этого сервера
+            gd["status_subscribers"] = [sub for sub in gd.get("status_subscribers", []) if sub["guild"] != follower]
+
+    await store.modify(interaction.guild.id, change)
+    invalidate_settings(interaction.guild.id)
+    text = f"Сервер `{follower}` может подписаться на статус" if allow else f"Сервер `{follower}` больше не получает статус"
+    e = Style.embed("✅ Подписчики статуса", text, Style.SUCCESS, interaction.guild)
+    Style.footer(e, interaction.user)
+    await interaction.response.send_message(embed=e, ephemeral=True)
+
 bot.tree.add_command(settings_group)
 
 
+# ─── Планировщик ──────────────────────────────────────────── #
+
+SCHEDULER_MAX_SLEEP = 300   # сек; чаще сверяемся с часами на случай их перевода
+
+
+class Scheduler:
+    """Один таймер на все отложенные действия бота.
+
+    Задания лежат в куче (время, порядковый номер, вид, сервер, ключ), и
+    единственная задача спит до ближайшего — тысячи записей не создают
+    тысячи спящих корутин. Сама куча живёт только в памяти: кто ставит
+    задание, тот хранит его в guild data и заново ставит после перезапуска.
+    Отмена ленивая — обработчик сверяется с сохранёнными данными и
+    просто ничего не делает, если задание уже неактуально.
+
+    Если сервера в момент срабатывания нет в кэше (недоступен, ещё не
+    загружен), задание пропускается: оно лежит в базе, и восстановление
+    по on_guild_available поставит его снова. Повторная постановка того
+    же задания ничего не добавляет.
+    """
+
+    def __init__(self):
+        self.heap: list = []
+        self.queued: set = set()    # (вид, сервер, ключ, время) — задания в куче
+        self.handlers: dict = {}
+        self.order = itertools.count()
+        # Event создаётся в start(): на Python 3.9 примитив asyncio,
+        # созданный при импорте, привязывается не к тому event loop
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task = None
+
+    def handler(self, kind: str):
+        def register(fn):
+            self.handlers[kind] = fn
+            return fn
+        return register
+
+    def at(self, when: float, kind: str, guild_id: int, key=None):
+        job = (kind, guild_id, key, when)
+        if job in self.queued:
+            return
+        self.queued.add(job)
+        entry = (when, next(self.order), kind, guild_id, key)
+        heapq.heappush(self.heap, entry)
+        if self.heap[0] is entry and self.wakeup is not None:
+            self.wakeup.set()
+
+    def start(self):
+        if self.task is None:
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            self.wakeup.clear()
+            now = time.time()
+            while self.heap and self.heap[0][0] <= now:
+                when, _, kind, guild_id, key = heapq.heappop(self.heap)
+                self.queued.discard((kind, guild_id, key, when))
+                guild = bot.get_guild(guild_id)
+                if guild is not None and not guild.unavailable:
+                    asyncio.create_task(self._fire(kind, guild, key, when))
+            delay = min(self.heap[0][0] - now, SCHEDULER_MAX_SLEEP) if self.heap else SCHEDULER_MAX_SLEEP
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fire(self, kind: str, guild, key, when: float):
+        try:
+            await self.handlers[kind](guild, key, when)
+        except Exception:
+            log.exception("Ошибка задания %s", kind, extra={"guild": guild.id})
+
+
+scheduler = Scheduler()
+
+
 # ╔═══════════════════════════════════════════════════════════╗
 # ║                   STATUS / СТАТУС                         ║
 # ╚═══════════════════════════════════════════════════════════╝
@@ -337,10 +696,8 @@ class OfflineModal(ui.Modal, title="🔴 Сервер выключен"):
         self.guild_id = guild_id
 
     async def on_submit(self, interaction: discord.Interaction):
-        gd = get_guild_data(self.guild_id)
         now = datetime.datetime.now().strftime("%d.%m.%Y %H:%M")
-        gd["status"] = {"state": "offline", "reason": self.reason.value, "estimated_time": self.estimated.value or "Не указано", "additional_info": self.info.value or "—", "updated_by": str(interaction.user), "updated_at": now}
-        update_guild_data(self.guild_id, gd)
+        await store.set_status(self.guild_id, {"state": "offline", "reason": self.reason.value, "estimated_time": self.estimated.value or "Не указано", "additional_info": self.info.value or "—", "updated_by": str(interaction.user), "updated_at": now})
         e = Style.embed(color=Style.OFFLINE, guild=interaction.guild)
         e.title = "🔴  Сервер — OFFLINE"
         e.description = "```\n⛔ Сервер был отключён\n```"
@@ -351,7 +708,7 @@ class OfflineModal(ui.Modal, title="🔴 Сервер выключен"):
             e.add_field(name="ℹ️ Дополнительно", value=self.info.value, inline=False)
         Style.footer(e, interaction.user, "Status Update")
         await interaction.response.send_message(embed=e)
-        await _notify_status(interaction.guild, e)
+        _notify_status(interaction.guild, e)
         await _log_action(interaction.guild, "Status", f"Статус → **OFFLINE** — {self.reason.value}", interaction.user)
 
 
@@ -364,10 +721,8 @@ class MaintenanceModal(ui.Modal, title="🟠 Тех. обслуживание"):
         self.guild_id = guild_id
 
     async def on_submit(self, interaction: discord.Interaction):
-        gd = get_guild_data(self.guild_id)
         now = datetime.datetime.now().strftime("%d.%m.%Y %H:%M")
-        gd["status"] = {"state": "maintenance", "reason": self.reason.value, "estimated_time": self.estimated.value or "Не указано", "additional_info": "—", "updated_by": str(interaction.user), "updated_at": now}
-        update_guild_data(self.guild_id, gd)
+        await store.set_status(self.guild_id, {"state": "maintenance", "reason": self.reason.value, "estimated_time": self.estimated.value or "Не указано", "additional_info": "—", "updated_by": str(interaction.user), "updated_at": now})
         e = Style.embed(color=Style.MAINT, guild=interaction.guild)
         e.title = "🟠  Сервер — MAINTENANCE"
         e.description = "```\n🔧 Проводятся технические работы\n```"
@@ -376,7 +731,7 @@ class MaintenanceModal(ui.Modal, title="🟠 Тех. обслуживание"):
         e.add_field(name="👤 Обновил", value=interaction.user.mention, inline=True)
         Style.footer(e, interaction.user, "Status Update")
         await interaction.response.send_message(embed=e)
-        await _notify_status(interaction.guild, e)
+        _notify_status(interaction.guild, e)
         await _log_action(interaction.guild, "Status", f"Статус → **MAINTENANCE** — {self.reason.value}", interaction.user)
 
 
@@ -392,17 +747,15 @@ class StatusSelect(ui.Select):
     async def callback(self, interaction: discord.Interaction):
         val = self.values[0]
         if val == "online":
-            gd = get_guild_data(interaction.guild.id)
             now = datetime.datetime.now().strftime("%d.%m.%Y %H:%M")
-            gd["status"] = {"state": "online", "reason": "—", "estimated_time": "—", "additional_info": "—", "updated_by": str(interaction.user), "updated_at": now}
-            update_guild_data(interaction.guild.id, gd)
+            await store.set_status(interaction.guild.id, {"state": "online", "reason": "—", "estimated_time": "—", "additional_info": "—", "updated_by": str(interaction.user), "updated_at": now})
             e = Style.embed(color=Style.ONLINE, guild=interaction.guild)
             e.title = "🟢  Сервер — ONLINE"
             e.description = "```\n✅ Всё работает в штатном режиме\n```"
             e.add_field(name="👤 Обновил", value=interaction.user.mention, inline=True)
             Style.footer(e, interaction.user, "Status Update")
             await interaction.response.send_message(embed=e)
-            await _notify_status(interaction.guild, e)
+            _notify_status(interaction.guild, e)
             await _log_action(interaction.guild, "Status", "Статус → **ONLINE**", interaction.user)
         elif val == "offline":
             await interaction.response.send_modal(OfflineModal(interaction.guild.id))
@@ -435,40 +788,489 @@ async def status_cmd(interaction: discord.Interaction):
         e.add_field(name="🕐 Обновлено", value=f"`{st['updated_at']}`", inline=True)
     if st.get("updated_by"):
         e.add_field(name="👤 Кем", value=st["updated_by"], inline=True)
+    report = status_broadcaster.reports.get(interaction.guild.id)
+    if report:
+        e.add_field(name="📡 Рассылка", value=f"`{report['delivered']}/{report['total']}` • {report['at']}", inline=True)
     if interaction.guild.icon:
         e.set_thumbnail(url=interaction.guild.icon.url)
     Style.footer(e, interaction.user, "Server Manager")
     await interaction.response.send_message(embed=e, view=StatusView(), ephemeral=True)
 
 
-@bot.tree.command(name="serverstatus", description="📡 Текущий статус сервера")
-async def serverstatus_cmd(interaction: discord.Interaction):
-    gd = get_guild_data(interaction.guild.id)
-    st = gd["status"]
+def build_status_embed(guild) -> discord.Embed:
+    st = get_guild_data(guild.id)["status"]
     state = st.get("state", "none")
     if state == "online":
-        e = Style.embed("🟢  Сервер работает", "```\n✅ Всё в порядке, сервер онлайн!\n```", Style.ONLINE, interaction.guild)
+        e = Style.embed("🟢  Сервер работает", "```\n✅ Всё в порядке, сервер онлайн!\n```", Style.ONLINE, guild)
     elif state == "offline":
-        e = Style.embed("🔴  Сервер выключен", "```\n⛔ Сервер временно недоступен\n```", Style.OFFLINE, interaction.guild)
+        e = Style.embed("🔴  Сервер выключен", "```\n⛔ Сервер временно недоступен\n```", Style.OFFLINE, guild)
         e.add_field(name="📝 Причина", value=f">>> {st.get('reason', '?')}", inline=False)
         e.add_field(name="⏰ Возвращение", value=f"`{st.get('estimated_time', '?')}`", inline=True)
         if st.get("additional_info") and st["additional_info"] != "—":
             e.add_field(name="ℹ️ Доп. инфо", value=st["additional_info"], inline=False)
     elif state == "maintenance":
-        e = Style.embed("🟠  Тех. обслуживание", "```\n🔧 Проводятся технические работы\n```", Style.MAINT, interaction.guild)
+        e = Style.embed("🟠  Тех. обслуживание", "```\n🔧 Проводятся технические работы\n```", Style.MAINT, guild)
         e.add_field(name="🔧 Описание", value=f">>> {st.get('reason', '?')}", inline=False)
         e.add_field(name="⏰ Завершение", value=f"`{st.get('estimated_time', '?')}`", inline=True)
     else:
-        e = Style.embed("⚪  Статус не установлен", "Администратор ещё не указал статус.", Style.DARK, interaction.guild)
+        e = Style.embed("⚪  Статус не установлен", "Администратор ещё не указал статус.", Style.DARK, guild)
+    upcoming = next((w for w in _windows(get_guild_data(guild.id)) if not w["active"]), None)
+    if upcoming:
+        e.add_field(name="🗓️ Плановые работы", value=f"<t:{int(upcoming['start'])}:f> — <t:{int(upcoming['end'])}:t>\n{upcoming['reason'][:200]}", inline=False)
     if st.get("updated_at"):
         Style.footer(e, text=f"Обновлено: {st['updated_at']}")
-    await interaction.response.send_message(embed=e)
+    return e
+
+
+@bot.tree.command(name="serverstatus", description="📡 Текущий статус сервера")
+async def serverstatus_cmd(interaction: discord.Interaction):
+    await interaction.response.send_message(embed=build_status_embed(interaction.guild))
+
+
+@bot.tree.command(name="status-follow", description="📡 Получать статус другого сервера")
+@is_admin()
+@app_commands.describe(server_id="ID сервера, за статусом которого следить", channel="Куда присылать обновления")
+async def status_follow_cmd(interaction: discord.Interaction, server_id: str, channel: discord.TextChannel):
+    if not server_id.isdigit():
+        return await interaction.response.send_message("❌ Неверный ID.", ephemeral=True)
+    source = bot.get_guild(int(server_id))
+    # В кластере сервер может обслуживать другой процесс
+    if source is None and CLUSTER_ID is None:
+        return await interaction.response.send_message("❌ Бот не состоит на этом сервере.", ephemeral=True)
+    name = source.name if source else server_id
+    # Подписку разрешает сервер-источник через /settings status-followers.
+    # Неизвестный сервер тоже отсекается здесь, до записи в базу
+    if interaction.guild.id not in get_guild_data(int(server_id))["settings"].get("status_followers", []):
+        return await interaction.response.send_message(
+            f"❌ **{name}** не разрешил подписку. Его админ должен выполнить `/settings status-followers {interaction.guild.id}`.",
+            ephemeral=True)
+    result = None
+
+    def subscribe(gd):
+        nonlocal result
+        subs = gd.setdefault("status_subscribers", [])
+        if interaction.guild.id not in gd["settings"].get("status_followers", []):
+            result = "denied"
+        elif any(sub["channel"] == channel.id for sub in subs):
+            result = "exists"
+        elif len(subs) >= STATUS_SUBSCRIBERS_LIMIT:
+            result = "full"
+        else:
+            subs.append({"guild": interaction.guild.id, "channel": channel.id})
+            result = "ok"
+
+    await store.modify(int(server_id), subscribe)
+    invalidate_settings(int(server_id))
+    if result == "denied":
+        return await interaction.response.send_message(f"❌ **{name}** не разрешил подписку.", ephemeral=True)
+    if result == "full":
+        return await interaction.response.send_message(
+            f"❌ У **{name}** уже {STATUS_SUBSCRIBERS_LIMIT} подписчиков — это максимум.", ephemeral=True)
+    e = Style.embed("📡  Подписка оформлена", f"Статус **{name}** → {channel.mention}", Style.SUCCESS, interaction.guild)
+    Style.footer(e, interaction.user)
+    await interaction.response.send_message(embed=e, ephemeral=True)
+    await _log_action(interaction.guild, "Follow", f"Подписка на статус {name} → #{channel.name}", interaction.user)
+
+
+@bot.tree.command(name="status-unfollow", description="🔕 Отписаться от статуса сервера")
+@is_admin()
+@app_commands.describe(server_id="ID сервера", channel="Канал подписки")
+async def status_unfollow_cmd(interaction: discord.Interaction, server_id: str, channel: discord.TextChannel):
+    if not server_id.isdigit():
+        return await interaction.response.send_message("❌ Неверный ID.", ephemeral=True)
+    removed = []
+
+    def unsubscribe(gd):
+        subs = gd.get("status_subscribers", [])
+        gd["status_subscribers"] = [sub for sub in subs if sub["channel"] != channel.id]
+        removed.append(len(subs) - len(gd["status_subscribers"]))
+
+    await store.modify(int(server_id), unsubscribe)
+    if not removed[0]:
+        return await interaction.response.send_message("❌ Такой подписки нет.", ephemeral=True)
+    e = Style.embed("🔕  Подписка отменена", f"{channel.mention} больше не получает статус", Style.SUCCESS, interaction.guild)
+    Style.footer(e, interaction.user)
+    await interaction.response.send_message(embed=e, ephemeral=True)
+
+
+# ─── Плановые тех. работы ─────────────────────────────────── #
+# Окно хранится в gd["maintenance"]["windows"] и ставится в планировщик
+# дважды: на начало (статус → MAINTENANCE) и на конец (→ ONLINE). Статус
+# помечается ID окна — если за время работ его сменили вручную, конец
+# окна его не трогает.
+
+MAINTENANCE_LIMIT = config.get("MAINTENANCE_LIMIT", 20)   # окон на сервер
+MAINTENANCE_MAX_MINUTES = 7 * 24 * 60
+TIME_FORMAT = "%d.%m.%Y %H:%M"
+
+
+def _parse_when(text: str) -> Optional[float]:
+    """«ДД.ММ.ГГГГ ЧЧ:ММ», «ДД.ММ ЧЧ:ММ» или «ЧЧ:ММ» (ближайшее такое время)
+    — по местному времени машины, где запущен бот."""
+    text = text.strip()
+    now = datetime.datetime.now()
+    for fmt in (TIME_FORMAT, "%d.%m %H:%M", "%H:%M"):
+        try:
+            parsed = datetime.datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        if fmt == "%H:%M":
+            parsed = now.replace(hour=parsed.hour, minute=parsed.minute, second=0, microsecond=0)
+            if parsed <= now:
+                parsed += datetime.timedelta(days=1)
+        elif fmt != TIME_FORMAT:
+            parsed = parsed.replace(year=now.year)
+            if parsed <= now:
+                parsed = parsed.replace(year=now.year + 1)
+        return parsed.timestamp()
+    return None
+
+
+def _windows(gd: dict) -> list:
+    return gd.get("maintenance", {}).get("windows", [])
+
+
+def _find_window(gd: dict, window_id: int) -> Optional[dict]:
+    return next((w for w in _windows(gd) if w["id"] == window_id), None)
+
+
+def schedule_window(guild_id: int, window: dict):
+    if not window["active"]:
+        scheduler.at(window["start"], "maintenance_start", guild_id, window["id"])
+    scheduler.at(window["end"], "maintenance_end", guild_id, window["id"])
+
+
+@bot.listen("on_guild_available")
+@bot.listen("on_guild_join")
+async def restore_maintenance(guild: discord.Guild):
+    # Срабатывает при запуске и после недоступности сервера; окна,
+    # пропущенные за это время, сработают сразу
+    for window in _windows(get_guild_data(guild.id)):
+        schedule_window(guild.id, window)
+
+
+@scheduler.handler("maintenance_start")
+async def maintenance_start(guild: discord.Guild, window_id: int, when: float):
+    started = None
+
+    def begin(gd):
+        nonlocal started
+        w = _find_window(gd, window_id)
+        if w is None or w["active"] or w["start"] != when or w["end"] <= time.time():
+            return
+        w["active"] = True
+        gd["status"] = {"state": "maintenance", "reason": w["reason"],
+                        "estimated_time": datetime.datetime.fromtimestamp(w["end"]).strftime(TIME_FORMAT),
+                        "additional_info": "Плановые работы", "updated_by": f"{w['by']} (по расписанию)",
+                        "updated_at": datetime.datetime.now().strftime(TIME_FORMAT), "window": window_id}
+        started = w
+
+    await store.modify(guild.id, begin)
+    if started is None:
+        return
+    _notify_status(guild, build_status_embed(guild))
+    await _log_action(guild, "Status", f"Статус → **MAINTENANCE** по расписанию (#{window_id}) — {started['reason']}")
+
+
+@scheduler.handler("maintenance_end")
+async def maintenance_end(guild: discord.Guild, window_id: int, when: float):
+    ended = None
+
+    def finish(gd):
+        nonlocal ended
+        w = _find_window(gd, window_id)
+        if w is None or w["end"] != when:
+            return
+        gd["maintenance"]["windows"].remove(w)
+        ended = w
+        if w["active"] and gd["status"].get("window") == window_id:
+            gd["status"] = {"state": "online", "reason": "—", "estimated_time": "—", "additional_info": "—",
+                            "updated_by": f"{w['by']} (по расписанию)",
+                            "updated_at": datetime.datetime.now().strftime(TIME_FORMAT)}
+        else:
+            ended = None
+
+    await store.modify(guild.id, finish)
+    if ended is None:
+        return
+    _notify_status(guild, build_status_embed(guild))
+    await _log_action(guild, "Status", f"Статус → **ONLINE** — плановые работы #{window_id} завершены")
+
+
+maintenance_group = app_commands.Group(name="maintenance", description="🗓️ Плановые тех. работы")
+
+
+@maintenance_group.command(name="schedule", description="🗓️ Запланировать тех. работы")
+@is_admin()
+@app_commands.describe(start="Начало: ДД.ММ.ГГГГ ЧЧ:ММ, ДД.ММ ЧЧ:ММ или ЧЧ:ММ",
+                       minutes="Длительность в минутах", reason="Что будет происходить")
+async def maintenance_schedule(interaction: discord.Interaction, start: str,
+                               minutes: app_commands.Range[int, 1, MAINTENANCE_MAX_MINUTES],
+                               reason: app_commands.Range[str, 1, 500]):
+    begin = _parse_when(start)
+    if begin is None:
+        return await interaction.response.send_message("❌ Не понял время. Пример: `25.12.2025 03:00` или `03:00`.", ephemeral=True)
+    if begin <= time.time():
+        return await interaction.response.send_message("❌ Это время уже прошло.", ephemeral=True)
+    end = begin + minutes * 60
+    error = None
+    window = None
+
+    def add(gd):
+        nonlocal error, window
+        m = gd.setdefault("maintenance", {"seq": 0, "windows": []})
+        if len(m["windows"]) >= MAINTENANCE_LIMIT:
+            error = f"❌ Уже запланировано {MAINTENANCE_LIMIT} окон — отмени лишние."
+            return
+        clash = next((w for w in m["windows"] if w["start"] < end and begin < w["end"]), None)
+        if clash:
+            error = f"❌ Пересекается с окном #{clash['id']} (<t:{int(clash['start'])}:f> — <t:{int(clash['end'])}:t>)."
+            return
+        m["seq"] += 1
+        window = {"id": m["seq"], "start": begin, "end": end, "reason": reason, "by": str(interaction.user), "active": False}
+        m["windows"].append(window)
+        m["windows"].sort(key=lambda w: w["start"])
+
+    await store.modify(interaction.guild.id, add)
+    if error:
+        return await interaction.response.send_message(error, ephemeral=True)
+    schedule_window(interaction.guild.id, window)
+    # В закреплённом статусе появится ближайшее окно
+    status_message.schedule(interaction.guild)
+    e = Style.embed("🗓️  Тех. работы запланированы", f">>> {reason}", Style.MAINT, interaction.guild)
+    e.add_field(name="▶️ Начало", value=f"<t:{int(begin)}:f>\n<t:{int(begin)}:R>", inline=True)
+    e.add_field(name="⏹️ Конец", value=f"<t:{int(end)}:f>", inline=True)
+    e.add_field(name="🆔 Окно", value=f"`#{window['id']}`", inline=True)
+    Style.footer(e, interaction.user)
+    await interaction.response.send_message(embed=e, ephemeral=True)
+    await _log_action(interaction.guild, "Maintenance",
+                      f"Запланированы работы #{window['id']}: <t:{int(begin)}:f> — <t:{int(end)}:t> — {reason}", interaction.user)
+
+
+@maintenance_group.command(name="list", description="📋 Запланированные тех. работы")
+@is_admin()
+async def maintenance_list(interaction: discord.Interaction):
+    windows = _windows(get_guild_data(interaction.guild.id))
+    if not windows:
+        return await interaction.response.send_message("📭 Плановых работ нет.", ephemeral=True)
+    lines = [f"{'🟠' if w['active'] else '🗓️'} `#{w['id']}` <t:{int(w['start'])}:f> — <t:{int(w['end'])}:t> • {w['reason'][:60]}"
+             for w in windows]
+    e = Style.embed("📋  Плановые тех. работы", "\n".join(lines), Style.MAINT, interaction.guild)
+    Style.footer(e, interaction.user)
+    await interaction.response.send_message(embed=e, ephemeral=True)
+
+
+@maintenance_group.command(name="cancel", description="🗑️ Отменить тех. работы (идущие — завершить)")
+@is_admin()
+@app_commands.describe(window="Номер окна из /maintenance list")
+async def maintenance_cancel(interaction: discord.Interaction, window: int):
+    w = _find_window(get_guild_data(interaction.guild.id), window)
+    if w is None:
+        return await interaction.response.send_message("❌ Такого окна нет.", ephemeral=True)
+    if w["active"]:
+        # Идущие работы завершаются сразу — статус вернётся в ONLINE
+        await maintenance_end(interaction.guild, window, w["end"])
+        text = f"Работы #{window} завершены досрочно"
+    else:
+        def drop(gd):
+            found = _find_window(gd, window)
+            if found:
+                gd["maintenance"]["windows"].remove(found)
+
+        # Записи в планировщике останутся, но обработчики окна уже не найдут
+        await store.modify(interaction.guild.id, drop)
+        status_message.schedule(interaction.guild)
+        text = f"Работы #{window} отменены"
+    e = Style.embed("🗑️  Готово", text, Style.SUCCESS, interaction.guild)
+    Style.footer(e, interaction.user)
+    await interaction.response.send_message(embed=e, ephemeral=True)
+    await _log_action(interaction.guild, "Maintenance", text, interaction.user)
+
+bot.tree.add_command(maintenance_group)
 
 
 # ╔═══════════════════════════════════════════════════════════╗
 # ║                  МОДЕРАЦИЯ / MOD                          ║
 # ╚═══════════════════════════════════════════════════════════╝
 
+# ─── Очередь модерации ────────────────────────────────────── #
+
+MOD_ACTION_RATE = config.get("MOD_ACTION_RATE", 5)   # действий за 5 секунд на сервер
+
+
+class ModerationQueue:
+    """Автоматические кики/баны/таймауты идут через очередь сервера с
+    лимитом скорости, чтобы волна срабатываний не упиралась в лимиты Discord.
+    submit() возвращает future с результатом (True/False)."""
+
+    def __init__(self):
+        self.queues: dict = {}
+        self.buckets: dict = {}
+        self.workers: dict = {}
+
+    def submit(self, guild, action: str, target, reason: str, duration: Optional[datetime.timedelta] = None) -> asyncio.Future:
+        gid = guild.id
+        q = self.queues.get(gid)
+        if q is None:
+            q = self.queues[gid] = asyncio.Queue()
+            self.buckets[gid] = TokenBucket(MOD_ACTION_RATE, 5)
+        fut = asyncio.get_running_loop().create_future()
+        q.put_nowait((guild, action, target, reason, duration, fut))
+        worker = self.workers.get(gid)
+        if worker is None or worker.done():
+            self.workers[gid] = asyncio.create_task(self._worker(gid, q))
+        return fut
+
+    async def _worker(self, gid: int, q: asyncio.Queue):
+        while not q.empty():
+            guild, action, target, reason, duration, fut = q.get_nowait()
+            await self.buckets[gid].acquire()
+            try:
+                await _moderate(guild, action, target, reason, duration)
+                ok = True
+            except (discord.HTTPException, aiohttp.ClientError, asyncio.TimeoutError):
+                ok = False
+            except Exception:
+                # Любая ошибка — только неудача этого действия: остальные
+                # в очереди должны выполниться, а ждущие — получить ответ
+                log.exception("Очередь модерации: %s не выполнен", action, extra={"guild": gid})
+                ok = False
+            if not fut.done():
+                fut.set_result(ok)
+        self.workers.pop(gid, None)
+
+
+async def _moderate(guild, action: str, target, reason: str, duration: Optional[datetime.timedelta] = None):
+    if action == "timeout":
+        await target.timeout(duration, reason=reason)
+    elif action == "kick":
+        await guild.kick(target, reason=reason)
+    elif action == "ban":
+        await guild.ban(target, reason=reason, delete_message_days=0)
+
+
+moderation_queue = ModerationQueue()
+
+
+# ─── Эскалация варнов ─────────────────────────────────────── #
+
+ESCALATION_ACTIONS = {"timeout": 1, "kick": 2, "ban": 3}     # значение — «тяжесть»
+ESCALATION_LABELS = {"timeout": "⏳ Таймаут", "kick": "🦶 Кик", "ban": "🔨 Бан"}
+ESCALATION_CACHE = 10000     # сколько участников держим в памяти
+
+
+class WarnEscalation:
+    """Правила вида «3 варна за 24ч → таймаут, 5 → бан».
+
+    Для каждого участника в памяти лежит окно времени последних варнов
+    (не длиннее самого большого порога). Новый варн добавляется в окно,
+    а число варнов в окне правила считается бинарным поиском — историю
+    заново не читаем. Окна вытесняются по LRU.
+    """
+
+    def __init__(self):
+        self.windows: OrderedDict = OrderedDict()
+
+    async def on_warn(self, guild, member, total: int, now: float) -> Optional[dict]:
+        rules = get_guild_data(guild.id).get("escalation", [])
+        if not rules:
+            return None
+        key = (guild.id, member.id)
+        size = max(r["count"] for r in rules)
+        window = self.windows.get(key)
+        if window is None or window.maxlen != size:
+            # Первый варн после запуска — поднимаем последние записи один раз
+            recent = await store.list_warns(guild.id, member.id, size)
+            window = deque(sorted(w.get("created_at", now) for w in recent), maxlen=size)
+        else:
+            window.append(now)
+        self.windows[key] = window
+        self.windows.move_to_end(key)
+        while len(self.windows) > ESCALATION_CACHE:
+            self.windows.popitem(last=False)
+
+        fired = None
+        for rule in rules:
+            if rule.get("window_hours"):
+                n = len(window) - bisect_left(window, now - rule["window_hours"] * 3600)
+            else:
+                n = total
+            if n == rule["count"] and (fired is None or ESCALATION_ACTIONS[rule["action"]] > ESCALATION_ACTIONS[fired["action"]]):
+                fired = rule
+        return fired
+
+    def forget(self, guild_id: int, user_id: int):
+        """Сбросить окно после снятия варнов — оно поднимется из базы заново."""
+        self.windows.pop((guild_id, user_id), None)
+
+
+warn_escalation = WarnEscalation()
+
+
+def _rule_text(rule: dict) -> str:
+    window = f" за {rule['window_hours']}ч" if rule.get("window_hours") else ""
+    action = ESCALATION_LABELS[rule["action"]]
+    if rule["action"] == "timeout":
+        action += f" {rule.get('minutes', 60)} мин"
+    return f"{rule['count']} варн(ов){window} → {action}"
+
+
+async def _escalate(interaction: discord.Interaction, member: discord.Member, rule: dict):
+    reason = f"Авто: {_rule_text(rule)}"
+    duration = datetime.timedelta(minutes=rule.get("minutes", 60)) if rule["action"] == "timeout" else None
+    ok = await moderation_queue.submit(interaction.guild, rule["action"], member, reason, duration)
+    status = "применено" if ok else "не удалось"
+    await _log_action(interaction.guild, "Escalation", f"{member} — {_rule_text(rule)} ({status})")
+
+
+escalation_group = app_commands.Group(name="escalation", description="📈 Авто-наказания за варны")
+
+@escalation_group.command(name="add", description="➕ Добавить правило")
+@is_admin()
+@app_commands.describe(count="Сколько варнов", action="Что делать", window_hours="За сколько часов (0 = за всё время)", minutes="Длительность таймаута")
+@app_commands.choices(action=[
+    app_commands.Choice(name="Таймаут", value="timeout"),
+    app_commands.Choice(name="Кик", value="kick"),
+    app_commands.Choice(name="Бан", value="ban"),
+])
+async def escalation_add(interaction: discord.Interaction, count: app_commands.Range[int, 1, 50], action: app_commands.Choice[str],
+                         window_hours: Optional[app_commands.Range[int, 0, 8760]] = 0, minutes: Optional[app_commands.Range[int, 1, 40320]] = 60):
+    gd = get_guild_data(interaction.guild.id)
+    rule = {"count": count, "window_hours": window_hours, "action": action.value}
+    if action.value == "timeout":
+        rule["minutes"] = minutes
+    gd.setdefault("escalation", []).append(rule)
+    await update_guild_data(interaction.guild.id, gd)
+    e = Style.embed("✅ Правило добавлено", _rule_text(rule), Style.SUCCESS, interaction.guild)
+    Style.footer(e, interaction.user)
+    await interaction.response.send_message(embed=e, ephemeral=True)
+
+@escalation_group.command(name="list", description="📋 Правила эскалации")
+@is_mod()
+async def escalation_list(interaction: discord.Interaction):
+    rules = get_guild_data(interaction.guild.id).get("escalation", [])
+    e = Style.embed("📈  Эскалация варнов", guild=interaction.guild)
+    e.description = "\n".join(f"`{i}.` {_rule_text(r)}" for i, r in enumerate(rules, 1)) or "```\nПравил нет\n```"
+    Style.footer(e, interaction.user)
+    await interaction.response.send_message(embed=e, ephemeral=True)
+
+@escalation_group.command(name="remove", description="🗑️ Удалить правило")
+@is_admin()
+@app_commands.describe(number="Номер из /escalation list")
+async def escalation_remove(interaction: discord.Interaction, number: int):
+    gd = get_guild_data(interaction.guild.id)
+    rules = gd.get("escalation", [])
+    if not 1 <= number <= len(rules):
+        return await interaction.response.send_message("❌ Нет такого правила.", ephemeral=True)
+    rule = rules.pop(number - 1)
+    await update_guild_data(interaction.guild.id, gd)
+    e = Style.embed("🗑️ Правило удалено", _rule_text(rule), Style.SUCCESS, interaction.guild)
+    Style.footer(e, interaction.user)
+    await interaction.response.send_message(embed=e, ephemeral=True)
+
+bot.tree.add_command(escalation_group)
+
+
 @bot.tree.command(name="kick", description="🦶 Кикнуть участника")
 @is_mod()
 @app_commands.describe(member="Кого кикнуть", reason="Причина")
@@ -518,87 +1320,522 @@ async def ban_cmd(interaction: discord.Interaction, member: discord.Member, reas
 @app_commands.describe(user_id="ID пользователя")
 async def unban_cmd(interaction: discord.Interaction, user_id: str):
     try:
-        user = await bot.fetch_user(int(user_id))
+        # Для разбана хватает ID — лишний запрос профиля не нужен
+        user = discord.Object(int(user_id))
         await interaction.guild.unban(user)
-        e = Style.embed("🔓  Разбанен", f"**{user}** разбанен.", Style.SUCCESS, interaction.guild)
+        e = Style.embed("🔓  Разбанен", f"<@{user.id}> (`{user.id}`) разбанен.", Style.SUCCESS, interaction.guild)
         e.add_field(name="Модератор", value=interaction.user.mention, inline=True)
         Style.footer(e, interaction.user, "Moderation")
         await interaction.response.send_message(embed=e)
-        await _log_action(interaction.guild, "Unban", f"{user} разбанен", interaction.user)
+        await _log_action(interaction.guild, "Unban", f"{user.id} разбанен", interaction.user)
     except discord.NotFound:
         await interaction.response.send_message("❌ Не найден или не забанен.", ephemeral=True)
-    except:
+    except (ValueError, discord.HTTPException) as err:
+        log.warning("Unban %s не удался: %s", user_id, err, extra={"guild": interaction.guild_id})
         await interaction.response.send_message("❌ Ошибка. Проверь ID.", ephemeral=True)
 
 
+# ─── Массовая модерация ───────────────────────────────────── #
+
+MASS_LIMIT = config.get("MASS_LIMIT", 1000)                 # целей за одну команду
+MASS_CONCURRENCY = config.get("MASS_CONCURRENCY", 4)        # параллельных запросов
+MASS_ACTION_RATE = config.get("MASS_ACTION_RATE", 10)       # действий за 5 секунд
+BULK_BAN_SIZE = 200                                          # лимит Discord на один bulk ban
+ID_RE = re.compile(r"\b\d{17,20}\b")
+MASS_LABELS = {
+    "ban": ("🔨", "Массовый бан", "забанено"),
+    "kick": ("🦶", "Массовый кик", "кикнуто"),
+    "timeout": ("⏳", "Массовый таймаут", "в таймауте"),
+}
+
+_mass_running: set = set()   # guild_id — одна массовая операция на сервер
+
+
+class MassAction:
+    """Массовое действие. Баны идут пачками через bulk ban (до 200 за
+    запрос), кики и таймауты — несколькими воркерами под общим
+    токен-бакетом; на 429 discord.py сам подождёт."""
+
+    def __init__(self, guild, action: str, targets: list, reason: str, duration: Optional[datetime.timedelta] = None):
+        self.guild = guild
+        self.action = action
+        self.targets = targets
+        self.reason = reason
+        self.duration = duration
+        self.done = 0
+        self.failed = 0
+        self.cancelled = False
+
+    async def run(self):
+        rest = self.targets
+        if self.action == "ban":
+            rest = await self._bulk_ban()
+        if rest:
+            await self._workers(rest)
+
+    async def _bulk_ban(self) -> list:
+        for i in range(0, len(self.targets), BULK_BAN_SIZE):
+            if self.cancelled:
+                return []
+            chunk = self.targets[i:i + BULK_BAN_SIZE]
+            try:
+                result = await self.guild.bulk_ban(chunk, reason=self.reason, delete_message_seconds=0)
+            except discord.Forbidden:
+                # bulk ban требует ещё и «Управление сервером» — баним по одному
+                return self.targets[i:]
+            except discord.HTTPException:
+                self.failed += len(chunk)
+                continue
+            self.done += len(result.banned)
+            self.failed += len(result.failed)
+        return []
+
+    async def _workers(self, targets: list):
+        bucket = TokenBucket(MASS_ACTION_RATE, 5)
+        pending = iter(targets)
+
+        async def worker():
+            for target in pending:
+                if self.cancelled:
+                    return
+                await bucket.acquire()
+                try:
+                    await _moderate(self.guild, self.action, target, self.reason, self.duration)
+                    self.done += 1
+                except (discord.HTTPException, aiohttp.ClientError, asyncio.TimeoutError):
+                    self.failed += 1
+
+        await asyncio.gather(*(worker() for _ in range(MASS_CONCURRENCY)))
+
+    def embed(self, finished: bool = False) -> discord.Embed:
+        emoji, title, verb = MASS_LABELS[self.action]
+        if not finished:
+            e = Style.embed(f"{emoji}  {title}…", None, Style.WARNING, self.guild)
+        elif self.cancelled:
+            e = Style.embed(f"⏹️  {title} остановлен", None, Style.WARNING, self.guild)
+        else:
+            e = Style.embed(f"{emoji}  {title}", None, Style.ERROR, self.guild)
+        e.description = f"{verb.capitalize()}: **{self.done}** из **{len(self.targets)}**\nОшибок: `{self.failed}`"
+        return e
+
+
+async def _mass_targets(interaction: discord.Interaction, action: str, ids: Optional[str],
+                        file: Optional[discord.Attachment], joined_minutes: Optional[int]) -> tuple:
+    """Собрать цели из списка ID, файла и окна входа. Владелец, сам
+    модератор, бот и участники с ролью не ниже роли бота/модератора
+    пропускаются. Возвращает (цели, сколько пропущено)."""
+    guild = interaction.guild
+    found = {int(x) for x in ID_RE.findall(ids or "")}
+    if file:
+        if file.size > 1024 * 1024:
+            raise ValueError("Файл больше 1 МБ")
+        found.update(int(x) for x in ID_RE.findall((await file.read()).decode("utf-8", "ignore")))
+    recent = {}
+    if joined_minutes:
+        if not intents.members:
+            raise ValueError("Окно входа недоступно без `MEMBERS_INTENT`")
+        # Без полного кэша (MEMBER_CACHE "none"/"interaction" или сервер ещё
+        # не догружен) guild.members неполон — запрашиваем список у Discord,
+        # в кэш он попадает только в режиме "full"
+        members = guild.members if guild.chunked else await guild.chunk(cache=MEMBER_CACHE == "full")
+        cutoff = discord.utils.utcnow() - datetime.timedelta(minutes=joined_minutes)
+        recent = {m.id: m for m in members if m.joined_at and m.joined_at >= cutoff}
+        found.update(recent)
+
+    me, moderator = guild.me, interaction.user
+    protected = {guild.owner_id, moderator.id, me.id}
+    targets, skipped = [], 0
+    for uid in sorted(found):
+        member = guild.get_member(uid) or recent.get(uid)
+        if uid in protected:
+            skipped += 1
+        elif member is None:
+            # Не участник сервера: забанить по ID можно, кикнуть/замутить — нет
+            if action == "ban":
+                targets.append(discord.Object(uid))
+            else:
+                skipped += 1
+        elif member.top_role >= me.top_role or (moderator.id != guild.owner_id and member.top_role >= moderator.top_role):
+            skipped += 1
+        else:
+            targets.append(member)
+    skipped += max(0, len(targets) - MASS_LIMIT)
+    return targets[:MASS_LIMIT], skipped
+
+
+class MassConfirmView(ui.View):
+    def __init__(self, job: MassAction, moderator: discord.Member):
+        super().__init__(timeout=120)
+        self.job = job
+        self.moderator = moderator
+
+    @ui.button(label="Подтвердить", emoji="✅", style=discord.ButtonStyle.danger)
+    async def confirm_btn(self, interaction: discord.Interaction, button: ui.Button):
+        job = self.job
+        if job.guild.id in _mass_running:
+            return await interaction.response.send_message("⏳ На сервере уже идёт массовая операция.", ephemeral=True)
+        _mass_running.add(job.guild.id)
+        self.stop()
+        cancel_view = JobCancelView(job)
+        await interaction.response.edit_message(embed=job.embed(), view=cancel_view)
+
+        async def report():
+            while True:
+                await asyncio.sleep(2)
+                try:
+                    await interaction.edit_original_response(embed=job.embed(), view=cancel_view)
+                except discord.HTTPException:
+                    pass
+
+        reporter = asyncio.create_task(report())
+        try:
+            await job.run()
+        finally:
+            reporter.cancel()
+            _mass_running.discard(job.guild.id)
+        e = job.embed(finished=True)
+        Style.footer(e, self.moderator, "Moderation")
+        try:
+            await interaction.edit_original_response(embed=e, view=None)
+        except discord.HTTPException:
+            pass
+        _, title, verb = MASS_LABELS[job.action]
+        # Одна сводка в логи вместо записи на каждого участника
+        await _log_action(job.guild, title, f"{verb}: {job.done}, ошибок: {job.failed} из {len(job.targets)} — {job.reason}", self.moderator)
+
+    @ui.button(label="Отмена", emoji="✖️", style=discord.ButtonStyle.secondary)
+    async def cancel_btn(self, interaction: discord.Interaction, button: ui.Button):
+        self.stop()
+        await interaction.response.edit_message(content="Отменено.", embed=None, view=None)
+
+
+async def _mass_command(interaction: discord.Interaction, action: str, ids, file, joined_minutes, reason: str,
+                        dry_run: bool, duration: Optional[datetime.timedelta] = None):
+    if not (ids or file or joined_minutes):
+        return await interaction.response.send_message("❌ Укажи ID, файл или окно входа.", ephemeral=True)
+    await interaction.response.defer(ephemeral=True)
+    try:
+        targets, skipped = await _mass_targets(interaction, action, ids, file, joined_minutes)
+    except (ValueError, discord.HTTPException) as err:
+        return await interaction.followup.send(f"❌ {err}", ephemeral=True)
+    except asyncio.TimeoutError:
+        return await interaction.followup.send("❌ Discord не прислал список участников, попробуй позже.", ephemeral=True)
+    emoji, title, _ = MASS_LABELS[action]
+    e = Style.embed(f"{emoji}  {title} — {'пробный прогон' if dry_run else 'подтверждение'}", None, Style.WARNING, interaction.guild)
+    e.add_field(name="Целей", value=f"```{len(targets)}```", inline=True)
+    e.add_field(name="Пропущено", value=f"```{skipped}```", inline=True)
+    e.add_field(name="Причина", value=f">>> {reason}", inline=False)
+    if targets:
+        shown = " ".join(f"<@{t.id}>" for t in targets[:30])
+        e.add_field(name="Кто попадёт", value=shown + (f" и ещё {len(targets) - 30}" if len(targets) > 30 else ""), inline=False)
+    Style.footer(e, interaction.user, "Moderation")
+    if dry_run or not targets:
+        return await interaction.followup.send(embed=e, ephemeral=True)
+    job = MassAction(interaction.guild, action, targets, reason, duration)
+    await interaction.followup.send(embed=e, view=MassConfirmView(job, interaction.user), ephemeral=True)
+
+
+_mass_params = dict(ids="ID через пробел или запятую", file="Файл со списком ID", joined_minutes="Все, кто вошёл за последние N минут",
+                    reason="Причина", dry_run="Только показать, кого затронет")
+
+@bot.tree.command(name="massban", description="🔨 Массовый бан")
+@is_admin()
+@app_commands.describe(**_mass_params)
+async def massban_cmd(interaction: discord.Interaction, ids: Optional[str] = None, file: Optional[discord.Attachment] = None,
+                      joined_minutes: Optional[app_commands.Range[int, 1, 10080]] = None,
+                      reason: Optional[str] = "Массовый бан", dry_run: Optional[bool] = False):
+    await _mass_command(interaction, "ban", ids, file, joined_minutes, reason, dry_run)
+
+
+@bot.tree.command(name="masskick", description="🦶 Массовый кик")
+@is_admin()
+@app_commands.describe(**_mass_params)
+async def masskick_cmd(interaction: discord.Interaction, ids: Optional[str] = None, file: Optional[discord.Attachment] = None,
+                       joined_minutes: Optional[app_commands.Range[int, 1, 10080]] = None,
+                       reason: Optional[str] = "Массовый кик", dry_run: Optional[bool] = False):
+    await _mass_command(interaction, "kick", ids, file, joined_minutes, reason, dry_run)
+
+
+@bot.tree.command(name="masstimeout", description="⏳ Массовый таймаут")
+@is_admin()
+@app_commands.describe(minutes="Длительность таймаута", **_mass_params)
+async def masstimeout_cmd(interaction: discord.Interaction, minutes: app_commands.Range[int, 1, 40320], ids: Optional[str] = None,
+                          file: Optional[discord.Attachment] = None, joined_minutes: Optional[app_commands.Range[int, 1, 10080]] = None,
+                          reason: Optional[str] = "Массовый таймаут", dry_run: Optional[bool] = False):
+    await _mass_command(interaction, "timeout", ids, file, joined_minutes, reason, dry_run, datetime.timedelta(minutes=minutes))
+
+
 @bot.tree.command(name="warn", description="⚠️ Варн участнику")
 @is_mod()
 @app_commands.describe(member="Кому", reason="Причина")
 async def warn_cmd(interaction: discord.Interaction, member: discord.Member, reason: Optional[str] = "Не указана"):
-    gd = get_guild_data(interaction.guild.id)
-    uid = str(member.id)
-    if uid not in gd["warns"]:
-        gd["warns"][uid] = []
-    gd["warns"][uid].append({"reason": reason, "by": str(interaction.user), "date": datetime.datetime.now().strftime("%d.%m.%Y %H:%M")})
-    update_guild_data(interaction.guild.id, gd)
-    count = len(gd["warns"][uid])
+    now = time.time()
+    days = get_settings(interaction.guild.id).warn_expire_days
+    count = await store.add_warn(interaction.guild.id, member.id, {
+        "reason": reason, "by": str(interaction.user), "by_id": interaction.user.id,
+        "date": datetime.datetime.now().strftime("%d.%m.%Y %H:%M"),
+        "created_at": now, "expires_at": now + days * 86400 if days else None,
+    })
     e = Style.embed(color=Style.WARNING, guild=interaction.guild)
     e.title = "⚠️  Предупреждение"
     e.add_field(name="Участник", value=f"{member.mention} (`{member}`)", inline=True)
     e.add_field(name="Модератор", value=interaction.user.mention, inline=True)
     e.add_field(name="Причина", value=f">>> {reason}", inline=False)
     e.add_field(name="Всего варнов", value=f"```{count}```", inline=True)
+    rule = await warn_escalation.on_warn(interaction.guild, member, count, now)
+    if rule:
+        e.add_field(name="📈 Эскалация", value=_rule_text(rule), inline=True)
     Style.footer(e, interaction.user, "Moderation")
     await interaction.response.send_message(embed=e)
     await _log_action(interaction.guild, "Warn", f"{member} варн #{count} — {reason}", interaction.user)
+    if rule:
+        await _escalate(interaction, member, rule)
+
+
+WARNS_PAGE = 5
+
+
+class WarnsView(ui.View):
+    """Листание варнов: каждая страница читается из хранилища отдельно."""
+
+    def __init__(self, member: discord.Member, total: int):
+        super().__init__(timeout=180)
+        self.member = member
+        self.total = total
+        self.page = 0
+        self.pages = max(1, -(-total // WARNS_PAGE))
+
+    async def render(self, interaction: discord.Interaction) -> discord.Embed:
+        warns = await store.list_warns(interaction.guild.id, self.member.id, WARNS_PAGE, self.page * WARNS_PAGE)
+        e = Style.embed(guild=interaction.guild)
+        e.title = f"📋  Варны — {self.member.display_name}"
+        e.set_thumbnail(url=self.member.display_avatar.url)
+        e.description = f"```\nВсего: {self.total}\n```"
+        for w in warns:
+            expires = f"\n⌛ истекает <t:{int(w['expires_at'])}:R>" if w.get("expires_at") else ""
+            e.add_field(name=f"ID {w.get('id', '?')} │ {w['date']}", value=f">>> {w['reason']}\n*— {w['by']}*{expires}", inline=False)
+        Style.footer(e, interaction.user, f"Страница {self.page + 1}/{self.pages}")
+        self.prev_btn.disabled = self.page == 0
+        self.next_btn.disabled = self.page >= self.pages - 1
+        return e
+
+    @ui.button(label="◀", style=discord.ButtonStyle.secondary)
+    async def prev_btn(self, interaction: discord.Interaction, button: ui.Button):
+        self.page = max(0, self.page - 1)
+        await interaction.response.edit_message(embed=await self.render(interaction), view=self)
+
+    @ui.button(label="▶", style=discord.ButtonStyle.secondary)
+    async def next_btn(self, interaction: discord.Interaction, button: ui.Button):
+        self.page = min(self.pages - 1, self.page + 1)
+        await interaction.response.edit_message(embed=await self.render(interaction), view=self)
 
 
 @bot.tree.command(name="warns", description="📋 Варны участника")
 @is_mod()
 @app_commands.describe(member="Кого проверить")
 async def warns_cmd(interaction: discord.Interaction, member: discord.Member):
-    gd = get_guild_data(interaction.guild.id)
-    warns = gd.get("warns", {}).get(str(member.id), [])
-    e = Style.embed(guild=interaction.guild)
-    e.title = f"📋  Варны — {member.display_name}"
-    e.set_thumbnail(url=member.display_avatar.url)
-    if not warns:
+    total = await store.count_warns(interaction.guild.id, member.id)
+    if not total:
+        e = Style.embed(guild=interaction.guild)
+        e.title = f"📋  Варны — {member.display_name}"
+        e.set_thumbnail(url=member.display_avatar.url)
         e.description = "```\n✅ Предупреждений нет\n```"
-    else:
-        e.description = f"```\nВсего: {len(warns)}\n```"
-        for i, w in enumerate(warns[-10:], 1):
-            e.add_field(name=f"#{i} │ {w['date']}", value=f">>> {w['reason']}\n*— {w['by']}*", inline=False)
+        Style.footer(e, interaction.user, "Moderation")
+        return await interaction.response.send_message(embed=e, ephemeral=True)
+    view = WarnsView(member, total)
+    e = await view.render(interaction)
+    await interaction.response.send_message(embed=e, view=view if view.pages > 1 else discord.utils.MISSING, ephemeral=True)
+
+
+@bot.tree.command(name="unwarn", description="↩️ Снять варн по ID")
+@is_mod()
+@app_commands.describe(warn_id="ID варна из /warns")
+async def unwarn_cmd(interaction: discord.Interaction, warn_id: int):
+    uid = await store.remove_warn(interaction.guild.id, warn_id)
+    if uid:
+        warn_escalation.forget(interaction.guild.id, int(uid))
+    if uid is None:
+        return await interaction.response.send_message("❌ Варн с таким ID не найден.", ephemeral=True)
+    e = Style.embed("↩️  Варн снят", f"Варн `{warn_id}` у <@{uid}> удалён", Style.SUCCESS, interaction.guild)
     Style.footer(e, interaction.user, "Moderation")
-    await interaction.response.send_message(embed=e, ephemeral=True)
+    await interaction.response.send_message(embed=e)
+    await _log_action(interaction.guild, "Unwarn", f"Варн {warn_id} у <@{uid}> снят", interaction.user)
 
 
 @bot.tree.command(name="clearwarns", description="🗑️ Очистить варны участника")
 @is_admin()
 @app_commands.describe(member="У кого")
 async def clearwarns_cmd(interaction: discord.Interaction, member: discord.Member):
-    gd = get_guild_data(interaction.guild.id)
-    uid = str(member.id)
-    old = len(gd.get("warns", {}).get(uid, []))
-    gd.setdefault("warns", {})[uid] = []
-    update_guild_data(interaction.guild.id, gd)
+    old = await store.clear_warns(interaction.guild.id, member.id)
+    warn_escalation.forget(interaction.guild.id, member.id)
     e = Style.embed("🗑️  Варны очищены", f"Удалено **{old}** варнов у {member.mention}", Style.SUCCESS, interaction.guild)
     Style.footer(e, interaction.user, "Moderation")
     await interaction.response.send_message(embed=e)
     await _log_action(interaction.guild, "ClearWarns", f"Варны {member} очищены ({old})", interaction.user)
 
 
+# ─── Массовая очистка ─────────────────────────────────────── #
+
+CLEAR_MAX = config.get("CLEAR_MAX", 5000)
+CLEAR_SCAN_LIMIT = config.get("CLEAR_SCAN_LIMIT", 20000)     # сколько сообщений истории просматриваем максимум
+CLEAR_SINGLE_RATE = config.get("CLEAR_SINGLE_RATE", 5)       # одиночных удалений за 5 секунд
+# Bulk delete принимает только сообщения моложе 14 дней, берём с запасом
+BULK_DELETE_AGE = datetime.timedelta(days=14) - datetime.timedelta(minutes=10)
+LINK_RE = re.compile(r"https?://|discord\.gg/", re.IGNORECASE)
+PURGE_PROGRESS_EVERY = 2.0
+
+_purges: dict = {}   # channel_id -> PurgeJob, одна очистка на канал
+
+
+class PurgeJob:
+    """Очистка канала потоком: история читается страницами (по 100),
+    подходящие сообщения моложе 14 дней удаляются пачками через bulk
+    delete, более старые — по одному с лимитом скорости."""
+
+    def __init__(self, channel, amount: int, check, since: Optional[datetime.datetime]):
+        self.channel = channel
+        self.amount = amount
+        self.check = check
+        self.since = since
+        self.scanned = 0
+        self.deleted = 0
+        self.cancelled = False
+        self.last_report = 0.0
+        self.bucket = TokenBucket(CLEAR_SINGLE_RATE, 5)
+
+    async def _bulk(self, batch: list):
+        try:
+            await self.channel.delete_messages(batch)
+            self.deleted += len(batch)
+        except discord.HTTPException:
+            # Кто-то успел удалить часть сообщений — добиваем по одному
+            for msg in batch:
+                await self._single(msg)
+
+    async def _single(self, msg):
+        await self.bucket.acquire()
+        try:
+            await msg.delete()
+            self.deleted += 1
+        except discord.NotFound:
+            pass
+
+    async def run(self, progress):
+        batch = []
+        bulk_cutoff = discord.utils.utcnow() - BULK_DELETE_AGE
+        async for msg in self.channel.history(limit=CLEAR_SCAN_LIMIT):
+            if self.cancelled or self.deleted + len(batch) >= self.amount:
+                break
+            if self.since and msg.created_at < self.since:
+                break   # история идёт от новых к старым — дальше только старше окна
+            self.scanned += 1
+            if self.check(msg):
+                if msg.created_at > bulk_cutoff:
+                    batch.append(msg)
+                    if len(batch) == 100:
+                        await self._bulk(batch)
+                        batch = []
+                else:
+                    if batch:
+                        await self._bulk(batch)
+                        batch = []
+                    await self._single(msg)
+            if time.monotonic() - self.last_report >= PURGE_PROGRESS_EVERY:
+                self.last_report = time.monotonic()
+                await progress(self)
+        if batch and not self.cancelled:
+            await self._bulk(batch)
+
+
+def _purge_check(member: Optional[discord.User], contains: Optional[str], kind: Optional[str]):
+    needle = contains.casefold() if contains else None
+
+    def check(msg: discord.Message) -> bool:
+        if member and msg.author.id != member.id:
+            return False
+        if needle and needle not in msg.content.casefold():
+            return False
+        if kind == "links" and not LINK_RE.search(msg.content):
+            return False
+        if kind == "attachments" and not msg.attachments:
+            return False
+        if kind == "bots" and not msg.author.bot:
+            return False
+        return True
+
+    return check
+
+
+def _purge_embed(job: PurgeJob, guild: discord.Guild, finished: bool = False) -> discord.Embed:
+    if not finished:
+        e = Style.embed("🧹  Очистка…", None, Style.WARNING, guild)
+    elif job.cancelled:
+        e = Style.embed("⏹️  Очистка остановлена", None, Style.WARNING, guild)
+    else:
+        e = Style.embed("🧹  Очищено", None, Style.SUCCESS, guild)
+    e.description = f"Удалено **{job.deleted}** из **{job.amount}**\nПросмотрено сообщений: `{job.scanned}`"
+    return e
+
+
+class JobCancelView(ui.View):
+    """Кнопка остановки долгой задачи (очистка, массовые действия)."""
+
+    def __init__(self, job):
+        super().__init__(timeout=None)
+        self.job = job
+
+    @ui.button(label="Остановить", emoji="⏹️", style=discord.ButtonStyle.danger)
+    async def stop_btn(self, interaction: discord.Interaction, button: ui.Button):
+        self.job.cancelled = True
+        button.disabled = True
+        await interaction.response.edit_message(view=self)
+
+
 @bot.tree.command(name="clear", description="🧹 Очистить сообщения")
 @is_mod()
-@app_commands.describe(amount="Кол-во (1-100)")
-async def clear_cmd(interaction: discord.Interaction, amount: int):
-    if amount < 1 or amount > 100:
-        return await interaction.response.send_message("❌ Число от 1 до 100.", ephemeral=True)
+@app_commands.describe(amount=f"Кол-во (1-{CLEAR_MAX})", member="Только сообщения участника",
+                       contains="Только с этим текстом", kind="Тип сообщений", minutes="Только за последние N минут")
+@app_commands.choices(kind=[
+    app_commands.Choice(name="Со ссылками", value="links"),
+    app_commands.Choice(name="С вложениями", value="attachments"),
+    app_commands.Choice(name="От ботов", value="bots"),
+])
+async def clear_cmd(interaction: discord.Interaction, amount: app_commands.Range[int, 1, CLEAR_MAX],
+                    member: Optional[discord.User] = None, contains: Optional[str] = None,
+                    kind: Optional[app_commands.Choice[str]] = None, minutes: Optional[app_commands.Range[int, 1, 43200]] = None):
+    channel = interaction.channel
+    if channel.id in _purges:
+        return await interaction.response.send_message("⏳ В этом канале уже идёт очистка.", ephemeral=True)
+    since = discord.utils.utcnow() - datetime.timedelta(minutes=minutes) if minutes else None
+    job = PurgeJob(channel, amount, _purge_check(member, contains, kind.value if kind else None), since)
     await interaction.response.defer(ephemeral=True)
-    deleted = await interaction.channel.purge(limit=amount)
-    e = Style.embed("🧹  Очищено", f"Удалено **{len(deleted)}** сообщений.", Style.SUCCESS, interaction.guild)
+    # Пока отвечали, очистку мог запустить другой модератор
+    if channel.id in _purges:
+        return await interaction.followup.send("⏳ В этом канале уже идёт очистка.", ephemeral=True)
+    view = JobCancelView(job)
+
+    async def progress(job: PurgeJob):
+        try:
+            await interaction.edit_original_response(embed=_purge_embed(job, interaction.guild), view=view)
+        except discord.HTTPException:
+            pass   # токен взаимодействия живёт 15 минут — дальше чистим молча
+
+    # Канал занят только внутри try — любая ошибка его освободит
+    _purges[channel.id] = job
+    try:
+        await progress(job)
+        await job.run(progress)
+    finally:
+        _purges.pop(channel.id, None)
+    e = _purge_embed(job, interaction.guild, finished=True)
     Style.footer(e, interaction.user, "Moderation")
-    await interaction.followup.send(embed=e, ephemeral=True)
-    await _log_action(interaction.guild, "Clear", f"{len(deleted)} сообщений в #{interaction.channel.name}", interaction.user)
+    try:
+        await interaction.edit_original_response(embed=e, view=None)
+    except discord.HTTPException:
+        pass
+    filters = ", ".join(f for f in (member and f"автор {member}", contains and f"текст «{contains}»",
+                                    kind and kind.name, minutes and f"за {minutes} мин") if f)
+    await _log_action(interaction.guild, "Clear", f"{job.deleted} сообщений в #{channel.name}" + (f" ({filters})" if filters else ""), interaction.user)
 
 
 @bot.tree.command(name="slowmode", description="🐌 Медленный режим")
@@ -618,51 +1855,199 @@ async def slowmode_cmd(interaction: discord.Interaction, seconds: int):
 # ║                    ТИКЕТЫ / TICKETS                       ║
 # ╚═══════════════════════════════════════════════════════════╝
 
+TICKET_COOLDOWN = config.get("TICKET_COOLDOWN", 30)   # сек между тикетами одного участника
+TICKET_QUEUE_LIMIT = config.get("TICKET_QUEUE_LIMIT", 50)
+TICKET_CREATE_RATE = 5                                  # каналов за 10 секунд на сервер
+
+
+class TicketQueue:
+    """Очередь создания тикетов: свой воркер на сервер.
+
+    Повторные клики одного участника отсекаются, пока его тикет создаётся
+    и ещё TICKET_COOLDOWN секунд после. Каналы создаются по очереди с
+    лимитом скорости, а если очередь переполнена — участник получает
+    просьбу подождать вместо ошибки от Discord.
+    """
+
+    def __init__(self):
+        self.queues: dict = {}
+        self.workers: dict = {}
+        self.buckets: dict = {}
+        self.inflight: set = set()
+        self.recent: dict = {}
+
+    def busy(self, guild_id: int, user_id: int) -> bool:
+        key = (guild_id, user_id)
+        return key in self.inflight or time.monotonic() - self.recent.get(key, 0) < TICKET_COOLDOWN
+
+    def full(self, guild_id: int) -> bool:
+        q = self.queues.get(guild_id)
+        return q is not None and q.qsize() >= TICKET_QUEUE_LIMIT
+
+    def submit(self, interaction: discord.Interaction):
+        gid = interaction.guild.id
+        q = self.queues.get(gid)
+        if q is None:
+            q = self.queues[gid] = asyncio.Queue()
+            self.buckets[gid] = TokenBucket(TICKET_CREATE_RATE, 10)
+        self.inflight.add((gid, interaction.user.id))
+        q.put_nowait(interaction)
+        worker = self.workers.get(gid)
+        if worker is None or worker.done():
+            self.workers[gid] = asyncio.create_task(self._worker(gid, q))
+
+    async def _worker(self, gid: int, q: asyncio.Queue):
+        while not q.empty():
+            interaction = q.get_nowait()
+            key = (gid, interaction.user.id)
+            try:
+                await self.buckets[gid].acquire()
+                await _open_ticket(interaction)
+            except Exception:
+                # любая ошибка, не только от Discord: воркер не должен умирать,
+                # иначе очередь сервера встанет до перезапуска
+                log.error("Тикет не создан", exc_info=True, extra={"guild": gid, "user": interaction.user.id})
+                try: await interaction.followup.send("❌ Не удалось создать тикет, попробуй позже.", ephemeral=True)
+                except discord.HTTPException: log.debug("Ответ о неудаче тикета не доставлен", exc_info=True)
+            finally:
+                self.inflight.discard(key)
+                self.recent[key] = time.monotonic()
+        self.workers.pop(gid, None)
+        # Чистим старые отметки, чтобы словарь не рос бесконечно
+        now = time.monotonic()
+        self.recent = {k: t for k, t in self.recent.items() if now - t < TICKET_COOLDOWN}
+
+
+ticket_queue = TicketQueue()
+
+
+async def _open_ticket(interaction: discord.Interaction):
+    gd = get_guild_data(interaction.guild.id)
+    num = await store.next_ticket(interaction.guild.id)
+
+    overwrites = {
+        interaction.guild.default_role: discord.PermissionOverwrite(view_channel=False),
+        interaction.user: discord.PermissionOverwrite(view_channel=True, send_messages=True),
+        interaction.guild.me: discord.PermissionOverwrite(view_channel=True, send_messages=True, manage_channels=True),
+    }
+    category = None
+    if gd["tickets"].get("category"):
+        category = interaction.guild.get_channel(gd["tickets"]["category"])
+
+    channel = await interaction.guild.create_text_channel(
+        name=f"ticket-{num:04d}", overwrites=overwrites, category=category,
+        topic=f"Тикет #{num} | {interaction.user}",
+    )
+
+    e = Style.embed(guild=interaction.guild)
+    e.title = f"📩  Тикет #{num:04d}"
+    e.description = f"Привет, {interaction.user.mention}!\n\nОпиши проблему и жди ответа.\nНажми 🔒 чтобы закрыть."
+    Style.footer(e, interaction.user, "Ticket System")
+    await channel.send(embed=e, view=TicketCloseView())
+    await store.add_ticket(interaction.guild.id, {
+        "num": num, "opener_id": interaction.user.id, "opener": str(interaction.user),
+        "channel_id": channel.id, "opened_at": time.time(),
+        "closed_at": None, "closer_id": None, "closer": None, "transcript": None,
+    })
+    await interaction.followup.send(f"✅ Тикет создан: {channel.mention}", ephemeral=True)
+    await _log_action(interaction.guild, "Ticket", f"Тикет #{num} создан — {interaction.user}", interaction.user)
+
+
 class TicketCreateView(ui.View):
     def __init__(self):
         super().__init__(timeout=None)
 
     @ui.button(label="📩 Создать тикет", style=discord.ButtonStyle.primary, custom_id="ticket_create")
     async def create_ticket(self, interaction: discord.Interaction, button: ui.Button):
-        gd = get_guild_data(interaction.guild.id)
-        gd["tickets"]["counter"] += 1
-        num = gd["tickets"]["counter"]
-        update_guild_data(interaction.guild.id, gd)
-
-        overwrites = {
-            interaction.guild.default_role: discord.PermissionOverwrite(view_channel=False),
-            interaction.user: discord.PermissionOverwrite(view_channel=True, send_messages=True),
-            interaction.guild.me: discord.PermissionOverwrite(view_channel=True, send_messages=True, manage_channels=True),
-        }
-        category = None
-        if gd["tickets"].get("category"):
-            category = interaction.guild.get_channel(gd["tickets"]["category"])
-
-        channel = await interaction.guild.create_text_channel(
-            name=f"ticket-{num:04d}", overwrites=overwrites, category=category,
-            topic=f"Тикет #{num} | {interaction.user}",
-        )
-
-        e = Style.embed(guild=interaction.guild)
-        e.title = f"📩  Тикет #{num:04d}"
-        e.description = f"Привет, {interaction.user.mention}!\n\nОпиши проблему и жди ответа.\nНажми 🔒 чтобы закрыть."
-        Style.footer(e, interaction.user, "Ticket System")
-        await channel.send(embed=e, view=TicketCloseView())
-        await interaction.response.send_message(f"✅ Тикет создан: {channel.mention}", ephemeral=True)
-        await _log_action(interaction.guild, "Ticket", f"Тикет #{num} создан — {interaction.user}", interaction.user)
+        if ticket_queue.busy(interaction.guild.id, interaction.user.id):
+            return await interaction.response.send_message("⏳ Твой тикет уже создаётся или был создан только что.", ephemeral=True)
+        if ticket_queue.full(interaction.guild.id):
+            return await interaction.response.send_message("🚦 Сейчас много обращений, попробуй через минуту.", ephemeral=True)
+        # Канал может создаться не сразу — отвечаем Discord заранее
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        ticket_queue.submit(interaction)
+
+
+TRANSCRIPTS_DIR = "transcripts"
+TRANSCRIPT_PAGE = 100          # столько сообщений держим в памяти за раз
+TRANSCRIPT_SEND_LIMIT = 8 * 1024 * 1024
+
+
+def _transcript_line(msg: discord.Message) -> str:
+    when = msg.created_at.strftime("%d.%m.%Y %H:%M:%S")
+    parts = [msg.content] if msg.content else []
+    parts += [f"[embed] {e.title or ''} {e.description or ''}".strip() for e in msg.embeds]
+    parts += [f"[файл] {a.url}" for a in msg.attachments]
+    text = "\n    ".join(parts) if parts else "—"
+    return f"[{when}] {msg.author} ({msg.author.id}): {text}\n"
+
+
+async def archive_transcript(channel, guild_id: int, num: int) -> tuple:
+    """Выгрузить историю канала в transcripts/<сервер>/ticket-XXXX.txt.gz.
+
+    История читается страницами по TRANSCRIPT_PAGE сообщений, каждая
+    страница сразу дописывается в gzip — в памяти не бывает больше одной
+    страницы, каким бы длинным ни был тикет."""
+    folder = os.path.join(TRANSCRIPTS_DIR, str(guild_id))
+    path = os.path.join(folder, f"ticket-{num:04d}.txt.gz")
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, functools.partial(os.makedirs, folder, exist_ok=True))
+    f = await loop.run_in_executor(None, functools.partial(gzip.open, path, "wt", encoding="utf-8"))
+    count = 0
+    page = []
+    try:
+        async for msg in channel.history(limit=None, oldest_first=True):
+            page.append(_transcript_line(msg))
+            if len(page) >= TRANSCRIPT_PAGE:
+                await loop.run_in_executor(None, f.write, "".join(page))
+                count += len(page)
+                page = []
+        if page:
+            await loop.run_in_executor(None, f.write, "".join(page))
+            count += len(page)
+    finally:
+        await loop.run_in_executor(None, f.close)
+    return path, count
+
+
+def _read_transcript(path: str, num: int) -> discord.File:
+    with gzip.open(path, "rb") as f:
+        data = f.read(TRANSCRIPT_SEND_LIMIT + 1)
+    if len(data) <= TRANSCRIPT_SEND_LIMIT:
+        return discord.File(io.BytesIO(data), filename=f"ticket-{num:04d}.txt")
+    # Слишком большой для вложения — отдаём архив как есть
+    return discord.File(path, filename=f"ticket-{num:04d}.txt.gz")
 
 
 class TicketCloseView(ui.View):
+    closing: set = set()
+
     def __init__(self):
         super().__init__(timeout=None)
 
     @ui.button(label="🔒 Закрыть тикет", style=discord.ButtonStyle.danger, custom_id="ticket_close")
     async def close_ticket(self, interaction: discord.Interaction, button: ui.Button):
-        e = Style.embed("🔒  Тикет закрыт", f"Закрыл: {interaction.user.mention}\nУдаление через 5с...", Style.ERROR, interaction.guild)
-        await interaction.response.send_message(embed=e)
-        await _log_action(interaction.guild, "Ticket", f"Тикет закрыт — {interaction.user}", interaction.user)
-        await asyncio.sleep(5)
-        await interaction.channel.delete()
+        channel = interaction.channel
+        if channel.id in TicketCloseView.closing:
+            return await interaction.response.send_message("⏳ Тикет уже закрывается.", ephemeral=True)
+        TicketCloseView.closing.add(channel.id)
+        try:
+            e = Style.embed("🔒  Тикет закрыт", f"Закрыл: {interaction.user.mention}\nСохраняю историю и удаляю канал...", Style.ERROR, interaction.guild)
+            await interaction.response.send_message(embed=e)
+            record = await store.get_ticket(interaction.guild.id, channel_id=channel.id)
+            note = ""
+            if record:
+                path, count = await archive_transcript(channel, interaction.guild.id, record["num"])
+                await store.update_ticket(interaction.guild.id, record["num"], {
+                    "closed_at": time.time(), "closer_id": interaction.user.id,
+                    "closer": str(interaction.user), "transcript": path,
+                })
+                note = f" #{record['num']} ({count} сообщ. в архиве)"
+            await _log_action(interaction.guild, "Ticket", f"Тикет{note} закрыт — {interaction.user}", interaction.user)
+            await asyncio.sleep(5)
+            await channel.delete()
+        finally:
+            TicketCloseView.closing.discard(channel.id)
 
 
 @bot.tree.command(name="ticket-setup", description="📩 Создать панель тикетов")
@@ -672,7 +2057,7 @@ async def ticket_setup_cmd(interaction: discord.Interaction, channel: discord.Te
     gd = get_guild_data(interaction.guild.id)
     if category:
         gd["tickets"]["category"] = category.id
-    update_guild_data(interaction.guild.id, gd)
+    await update_guild_data(interaction.guild.id, gd)
 
     e = Style.embed(guild=interaction.guild)
     e.title = "📩  Система тикетов"
@@ -684,6 +2069,38 @@ async def ticket_setup_cmd(interaction: discord.Interaction, channel: discord.Te
     await interaction.response.send_message(f"✅ Панель тикетов → {channel.mention}", ephemeral=True)
 
 
+@bot.tree.command(name="ticket-transcript", description="🗂️ Архив закрытого тикета")
+@is_mod()
+@app_commands.describe(number="Номер тикета", member="Показать тикеты участника")
+async def ticket_transcript_cmd(interaction: discord.Interaction, number: Optional[int] = None, member: Optional[discord.Member] = None):
+    gid = interaction.guild.id
+    if number is None and member is None:
+        return await interaction.response.send_message("❌ Укажи номер тикета или участника.", ephemeral=True)
+    if number is None:
+        records = await store.list_tickets(gid, member.id, 10)
+        e = Style.embed(guild=interaction.guild)
+        e.title = f"🗂️  Тикеты — {member.display_name}"
+        if not records:
+            e.description = "```\nТикетов нет\n```"
+        for r in records:
+            opened = f"<t:{int(r['opened_at'])}:f>"
+            closed = f"закрыл {r['closer']}" if r.get("closed_at") else "открыт"
+            e.add_field(name=f"#{r['num']:04d}", value=f"{opened} • {closed}", inline=False)
+        Style.footer(e, interaction.user, "Ticket System")
+        return await interaction.response.send_message(embed=e, ephemeral=True)
+    record = await store.get_ticket(gid, number)
+    if not record or not record.get("transcript") or not os.path.exists(record["transcript"]):
+        return await interaction.response.send_message("❌ Архив этого тикета не найден.", ephemeral=True)
+    await interaction.response.defer(ephemeral=True)
+    file = await asyncio.get_running_loop().run_in_executor(None, _read_transcript, record["transcript"], number)
+    e = Style.embed(f"🗂️  Тикет #{number:04d}", guild=interaction.guild)
+    e.add_field(name="Открыл", value=f"<@{record['opener_id']}>", inline=True)
+    e.add_field(name="Закрыл", value=f"<@{record['closer_id']}>", inline=True)
+    e.add_field(name="Период", value=f"<t:{int(record['opened_at'])}:f> — <t:{int(record['closed_at'])}:f>", inline=False)
+    Style.footer(e, interaction.user, "Ticket System")
+    await interaction.followup.send(embed=e, file=file, ephemeral=True)
+
+
 # ╔═══════════════════════════════════════════════════════════╗
 # ║                    УТИЛИТЫ / TOOLS                        ║
 # ╚═══════════════════════════════════════════════════════════╝
@@ -729,8 +2146,7 @@ async def userinfo_cmd(interaction: discord.Interaction, member: Optional[discor
     e.add_field(name="📥 Зашёл", value=f"<t:{int(m.joined_at.timestamp())}:R>" if m.joined_at else "`?`", inline=True)
     roles = [r.mention for r in m.roles if r.name != "@everyone"]
     e.add_field(name=f"🎭 Роли [{len(roles)}]", value=" ".join(roles[:10]) if roles else "`нет`", inline=False)
-    gd = get_guild_data(interaction.guild.id)
-    warns_count = len(gd.get("warns", {}).get(str(m.id), []))
+    warns_count = await store.count_warns(interaction.guild.id, m.id)
     e.add_field(name="⚠️ Варны", value=f"`{warns_count}`", inline=True)
     Style.footer(e, interaction.user, "User Info")
     await interaction.response.send_message(embed=e)
@@ -771,7 +2187,7 @@ async def embed_cmd(interaction: discord.Interaction, channel: discord.TextChann
     c = Style.MAIN
     if color:
         try: c = int(color, 16)
-        except: return await interaction.response.send_message("❌ Неверный HEX.", ephemeral=True)
+        except ValueError: return await interaction.response.send_message("❌ Неверный HEX.", ephemeral=True)
     e = discord.Embed(title=title, description=description, color=c, timestamp=datetime.datetime.now(datetime.timezone.utc))
     if image:
         e.set_image(url=image)
@@ -803,31 +2219,78 @@ async def poll_cmd(interaction: discord.Interaction, question: str, option1: str
 @is_admin()
 @app_commands.describe(text="Текст")
 async def note_cmd(interaction: discord.Interaction, text: str):
-    gd = get_guild_data(interaction.guild.id)
-    gd["notes"].append({"text": text, "by": str(interaction.user), "date": datetime.datetime.now().strftime("%d.%m.%Y %H:%M")})
-    if len(gd["notes"]) > 25:
-        gd["notes"] = gd["notes"][-25:]
-    update_guild_data(interaction.guild.id, gd)
+    await store.add_note(interaction.guild.id, {"text": text, "by": str(interaction.user), "by_id": str(interaction.user.id), "date": datetime.datetime.now().strftime("%d.%m.%Y %H:%M")})
     e = Style.embed("📝  Заметка добавлена", f">>> {text}", Style.SUCCESS, interaction.guild)
     Style.footer(e, interaction.user)
     await interaction.response.send_message(embed=e, ephemeral=True)
 
 
+NOTES_PAGE = 5
+
+
+class NotesView(ui.View):
+    """Листание заметок по курсору: страница читается из хранилища по id
+    (или по очкам поиска) последней показанной заметки, без сдвига offset."""
+
+    def __init__(self, total: int, query: Optional[str] = None):
+        super().__init__(timeout=180)
+        self.total = total
+        self.query = query
+        self.cursors: list = [None]     # курсор начала каждой открытой страницы
+        self.next_cursor = None
+
+    async def render(self, interaction: discord.Interaction) -> discord.Embed:
+        cursor = self.cursors[-1]
+        if self.query:
+            notes = await store.search_notes(interaction.guild.id, self.query, NOTES_PAGE + 1, cursor)
+        else:
+            notes = await store.list_notes(interaction.guild.id, NOTES_PAGE + 1, cursor)
+        more = len(notes) > NOTES_PAGE
+        notes = notes[:NOTES_PAGE]
+        if more:
+            last = notes[-1]
+            self.next_cursor = (last["score"], last["id"]) if self.query else last["id"]
+        e = Style.embed(guild=interaction.guild)
+        if self.query:
+            e.title = f"🔎  Заметки: {self.query[:50]}"
+            e.description = None if notes else "```\nНичего не найдено\n```"
+        else:
+            e.title = "📋  Заметки сервера"
+            e.description = f"```\nВсего: {self.total}\n```"
+        for n in notes:
+            e.add_field(name=f"#{n['id']} │ {n['date']}", value=f">>> {n['text'][:1000]}\n*— {n['by']}*", inline=False)
+        Style.footer(e, interaction.user, f"Страница {len(self.cursors)}")
+        self.prev_btn.disabled = len(self.cursors) == 1
+        self.next_btn.disabled = not more
+        self.has_pages = more or len(self.cursors) > 1
+        return e
+
+    @ui.button(label="◀", style=discord.ButtonStyle.secondary)
+    async def prev_btn(self, interaction: discord.Interaction, button: ui.Button):
+        if len(self.cursors) > 1:
+            self.cursors.pop()
+        await interaction.response.edit_message(embed=await self.render(interaction), view=self)
+
+    @ui.button(label="▶", style=discord.ButtonStyle.secondary)
+    async def next_btn(self, interaction: discord.Interaction, button: ui.Button):
+        self.cursors.append(self.next_cursor)
+        await interaction.response.edit_message(embed=await self.render(interaction), view=self)
+
+
 @bot.tree.command(name="notes", description="📋 Заметки сервера")
 @is_admin()
-async def notes_cmd(interaction: discord.Interaction):
-    gd = get_guild_data(interaction.guild.id)
-    notes = gd.get("notes", [])
-    e = Style.embed(guild=interaction.guild)
-    e.title = "📋  Заметки сервера"
-    if not notes:
+@app_commands.describe(search="Найти заметки по словам")
+async def notes_cmd(interaction: discord.Interaction, search: Optional[str] = None):
+    total = await store.count_notes(interaction.guild.id)
+    if not total:
+        e = Style.embed(guild=interaction.guild)
+        e.title = "📋  Заметки сервера"
         e.description = "```\nПусто. Используй /note\n```"
-    else:
-        e.description = f"```\nВсего: {len(notes)}\n```"
-        for i, n in enumerate(notes[-10:], 1):
-            e.add_field(name=f"#{i} │ {n['date']}", value=f">>> {n['text']}\n*— {n['by']}*", inline=False)
-    Style.footer(e, interaction.user)
-    await interaction.response.send_message(embed=e, ephemeral=True)
+        Style.footer(e, interaction.user)
+        return await interaction.response.send_message(embed=e, ephemeral=True)
+    view = NotesView(total, search)
+    e = await view.render(interaction)
+    await interaction.response.send_message(embed=e, view=view if view.has_pages else discord.utils.MISSING, ephemeral=True)
 
 
 @bot.tree.command(name="botinfo", description="🤖 Информация о боте")
@@ -842,10 +2305,20 @@ async def botinfo_cmd(interaction: discord.Interaction):
     e.add_field(name="⏱️ Аптайм", value=f"`{h}ч {m}м {s}с`", inline=True)
     e.add_field(name="🌐 Серверов", value=f"`{len(bot.guilds)}`", inline=True)
     e.add_field(name="📡 Пинг", value=f"`{round(bot.latency * 1000)}мс`", inline=True)
+    if SHARDED:
+        per_shard: dict = {}
+        for g in bot.guilds:
+            per_shard[g.shard_id] = per_shard.get(g.shard_id, 0) + 1
+        lines = [f"`#{sid}` {round(lat * 1000)}мс • {per_shard.get(sid, 0)} серв." for sid, lat in bot.latencies[:20]]
+        if len(bot.latencies) > 20:
+            lines.append(f"… и ещё {len(bot.latencies) - 20}")
+        e.add_field(name=f"🧩 Шарды [{bot.shard_count}]", value="\n".join(lines) or "`нет`", inline=False)
     e.add_field(name="🐍 discord.py", value=f"`{discord.__version__}`", inline=True)
     e.add_field(name="🆔 Bot ID", value=f"`{bot.user.id}`", inline=True)
     invite = f"https://discord.com/oauth2/authorize?client_id={bot.user.id}&permissions=8&scope=bot%20applications.commands"
     e.add_field(name="🔗 Пригласить", value=f"[Ссылка]({invite})", inline=True)
+    if interaction.guild and SHARDED:
+        e.add_field(name="🧩 Этот сервер", value=f"`шард #{interaction.guild.shard_id}`", inline=True)
     Style.footer(e, interaction.user, "Bot Info")
     await interaction.response.send_message(embed=e)
 
@@ -872,14 +2345,18 @@ class HelpSelect(ui.Select):
             e.description = (
                 "**`/status`** — Установить статус сервера\n"
                 "**`/serverstatus`** — Посмотреть статус\n"
+                "**`/status-follow`** / **`/status-unfollow`** — Подписка на статус другого сервера\n"
+                "**`/maintenance`** — Плановые тех. работы по расписанию\n"
                 "**`/setup`** — Панель настроек\n"
                 "**`/settings logs`** — Канал логов\n"
                 "**`/settings status-channel`** — Канал статуса\n"
                 "**`/settings welcome-channel`** — Канал приветствий\n"
                 "**`/settings autorole`** — Авто-роль\n"
+                "**`/settings warn-expiry`** — Срок жизни варнов\n"
+                "**`/settings status-followers`** — Кто может подписаться на статус\n"
                 "**`/announce`** — Объявление\n"
                 "**`/embed`** — Кастомный embed\n"
-                "**`/note`** / **`/notes`** — Заметки\n"
+                "**`/note`** / **`/notes [search]`** — Заметки и поиск\n"
             )
         elif cat == "moderation":
             e.title = "🛡️  Модерация"
@@ -889,14 +2366,21 @@ class HelpSelect(ui.Select):
                 "**`/unban`** — Разбанить по ID\n"
                 "**`/warn`** — Выдать варн\n"
                 "**`/warns`** — Посмотреть варны\n"
+                "**`/unwarn`** — Снять варн по ID\n"
                 "**`/clearwarns`** — Очистить варны\n"
+                "**`/escalation`** — Авто-наказания за варны\n"
+                "**`/antiraid`** — Защита от рейдов и спама\n"
+                "**`/massban`** / **`/masskick`** / **`/masstimeout`** — Массовые действия\n"
+                "**`/cachestats`** — Кэш участников и память\n"
+                "**`/stats`** — Метрики бота\n"
                 "**`/clear`** — Очистить сообщения\n"
                 "**`/slowmode`** — Медленный режим\n"
             )
         elif cat == "tickets":
             e.title = "📩  Тикеты"
             e.description = (
-                "**`/ticket-setup`** — Создать панель тикетов\n\n"
+                "**`/ticket-setup`** — Создать панель тикетов\n"
+                "**`/ticket-transcript`** — Архив закрытого тикета\n\n"
                 "Участники нажимают кнопку → приватный канал.\n"
                 "Кнопка 🔒 закрывает тикет."
             )
@@ -940,108 +2424,1164 @@ async def help_cmd(interaction: discord.Interaction):
 # ║                   ЛОГИРОВАНИЕ / LOGS                      ║
 # ╚═══════════════════════════════════════════════════════════╝
 
+LOG_BATCH = 10            # Discord принимает до 10 embed в одном сообщении
+LOG_LINGER = 1.0          # сколько ждать, чтобы набралась пачка
+LOG_QUEUE_SIZE = 1000
+LOG_RETRIES = 3
+LOG_IDLE_TIMEOUT = 60     # воркер сервера засыпает после минуты тишины
+LOG_SPILL_FILE = "log_spill.jsonl"
+
+
+class TokenBucket:
+    """Токен-бакет: не больше rate отправок за per секунд."""
+
+    def __init__(self, rate: int, per: float):
+        self.rate = rate
+        self.per = per
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) * self.per / self.rate)
+
+
+_channel_buckets: dict = {}
+
+def channel_bucket(channel_id: int) -> TokenBucket:
+    # Лимит Discord на отправку в один канал — 5 сообщений за 5 секунд
+    bucket = _channel_buckets.get(channel_id)
+    if bucket is None:
+        bucket = _channel_buckets[channel_id] = TokenBucket(5, 5)
+    return bucket
+
+
+class LogDispatcher:
+    """Очередь логов на каждый сервер + фоновый воркер.
+
+    Обработчики только кладут запись в очередь. Воркер собирает до
+    LOG_BATCH записей в одно сообщение, соблюдает лимит канала, повторяет
+    отправку с backoff, а если канал недоступен — дописывает записи в
+    LOG_SPILL_FILE, чтобы они не потерялись.
+    """
+
+    def __init__(self):
+        self.queues: dict = {}
+        self.workers: dict = {}
+
+    def enqueue(self, guild, embed: discord.Embed, record: dict):
+        q = self.queues.get(guild.id)
+        if q is None:
+            q = self.queues[guild.id] = asyncio.Queue(maxsize=LOG_QUEUE_SIZE)
+        try:
+            q.put_nowait((embed, record))
+        except asyncio.QueueFull:
+            self.spill([record])
+            return
+        worker = self.workers.get(guild.id)
+        if worker is None or worker.done():
+            self.workers[guild.id] = asyncio.create_task(self._worker(guild.id, q))
+
+    async def _worker(self, guild_id: int, q: asyncio.Queue):
+        while True:
+            try:
+                first = await asyncio.wait_for(q.get(), LOG_IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.workers.pop(guild_id, None)
+                return
+            await asyncio.sleep(LOG_LINGER)
+            batch = [first]
+            while len(batch) < LOG_BATCH and not q.empty():
+                batch.append(q.get_nowait())
+            await self._deliver(guild_id, batch)
+
+    async def _deliver(self, guild_id: int, batch: list):
+        guild = bot.get_guild(guild_id)
+        log_id = get_settings(guild_id).log_channel
+        channel = guild.get_channel(log_id) if guild and log_id else None
+        for part in _split_embeds(batch):
+            if channel is None or not await self._send(channel, part):
+                self.spill([r for _, r in part])
+
+    async def _send(self, channel, part: list) -> bool:
+        for attempt in range(LOG_RETRIES):
+            await channel_bucket(channel.id).acquire()
+            try:
+                await channel.send(embeds=[e for e, _ in part])
+                return True
+            except discord.HTTPException as e:
+                # 4xx (кроме 429) повтор не исправит — нет прав, канала или
+                # сообщение не проходит по лимитам
+                if 400 <= e.status < 500 and e.status != 429:
+                    return False
+                await asyncio.sleep(2 ** attempt)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                await asyncio.sleep(2 ** attempt)
+        return False
+
+    def spill(self, records: list):
+        try:
+            asyncio.get_running_loop().run_in_executor(None, _write_spill, records)
+        except RuntimeError:
+            _write_spill(records)
+
+    def spill_pending(self):
+        """При выключении — всё, что не успело уйти в канал, пишем в файл."""
+        for q in self.queues.values():
+            records = []
+            while not q.empty():
+                records.append(q.get_nowait()[1])
+            if records:
+                _write_spill(records)
+
+
+EMBEDS_TOTAL_LIMIT = 6000   # символов во всех embed одного сообщения (лимит Discord)
+
+
+def _split_embeds(batch: list) -> list:
+    """Разбить пачку (embed, запись) на сообщения, не превышающие лимит
+    Discord на суммарную длину embed."""
+    parts, part, size = [], [], 0
+    for item in batch:
+        n = len(item[0])
+        if part and size + n > EMBEDS_TOTAL_LIMIT:
+            parts.append(part)
+            part, size = [], 0
+        part.append(item)
+        size += n
+    if part:
+        parts.append(part)
+    return parts
+
+
+def _write_spill(records: list):
+    with open(LOG_SPILL_FILE, "a", encoding="utf-8") as f:
+        for r in records:
+            f.write(json.dumps(r, ensure_ascii=False) + "\n")
+
+
+log_dispatcher = LogDispatcher()
+
+
 async def _log_action(guild, action, description, user=None):
-    gd = get_guild_data(guild.id)
-    log_id = gd["settings"].get("log_channel")
+    log_id = get_settings(guild.id).log_channel
     if not log_id:
         return
-    channel = guild.get_channel(log_id)
-    if not channel:
-        return
     e = discord.Embed(description=f"**[{action}]** {description}", color=Style.DARK, timestamp=datetime.datetime.now(datetime.timezone.utc))
     if user:
         e.set_author(name=user.display_name, icon_url=user.display_avatar.url)
     e.set_footer(text=f"Log │ {action}")
-    try: await channel.send(embed=e)
-    except: pass
+    record = {"guild": guild.id, "action": action, "description": description,
+              "user": str(user) if user else None, "at": e.timestamp.isoformat()}
+    m_log_actions.inc(action)
+    log_dispatcher.enqueue(guild, e, record)
 
 
-async def _notify_status(guild, embed):
-    gd = get_guild_data(guild.id)
-    ch_id = gd["settings"].get("status_channel")
-    if not ch_id:
-        return
-    channel = guild.get_channel(ch_id)
-    if channel:
-        try: await channel.send(embed=embed)
-        except: pass
+STATUS_FANOUT_CONCURRENCY = config.get("STATUS_FANOUT_CONCURRENCY", 10)
+STATUS_SUBSCRIBERS_LIMIT = config.get("STATUS_SUBSCRIBERS_LIMIT", 100)   # каналов-подписчиков на сервер
+
+
+class StatusBroadcaster:
+    """Рассылка статуса во все каналы-подписчики.
+
+    Отправки идут параллельно (не больше STATUS_FANOUT_CONCURRENCY разом)
+    с лимитом на каждый канал. По итогу в лог пишется отчёт о доставке.
+    """
+
+    def __init__(self):
+        self.semaphore: Optional[asyncio.Semaphore] = None   # создаётся в event loop, см. Scheduler
+        self.reports: dict = {}
+        self.tasks: set = set()
+
+    def targets(self, guild) -> list:
+        # Канал статуса самого сервера ведёт StatusMessage, здесь — только подписчики
+        status_channel = get_settings(guild.id).status_channel
+        ids = []
+        for sub in get_guild_data(guild.id).get("status_subscribers", []):
+            if sub["channel"] == status_channel:
+                continue
+            if sub["channel"] not in ids:
+                ids.append(sub["channel"])
+        return ids
+
+    def broadcast(self, guild, embed: discord.Embed) -> Optional[asyncio.Task]:
+        ids = self.targets(guild)
+        if not ids:
+            return None
+        task = asyncio.create_task(self._run(guild, embed, ids))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def _send(self, channel_id: int, embed: discord.Embed) -> bool:
+        # Канал подписчика может быть на шарде другого процесса — тогда
+        # его нет в кэше, но отправить по ID всё равно можно
+        channel = bot.get_channel(channel_id) or bot.get_partial_messageable(channel_id)
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(STATUS_FANOUT_CONCURRENCY)
+        async with self.semaphore:
+            await channel_bucket(channel_id).acquire()
+            try:
+                await channel.send(embed=embed)
+                return True
+            except (discord.HTTPException, aiohttp.ClientError, asyncio.TimeoutError):
+                return False
+
+    async def _run(self, guild, embed: discord.Embed, ids: list):
+        results = await asyncio.gather(*(self._send(cid, embed) for cid in ids))
+        failed = [cid for cid, ok in zip(ids, results) if not ok]
+        report = {"total": len(ids), "delivered": len(ids) - len(failed), "failed": failed,
+                  "at": datetime.datetime.now().strftime("%d.%m.%Y %H:%M")}
+        self.reports[guild.id] = report
+        text = f"Рассылка статуса: ✅ {report['delivered']} / {report['total']}"
+        if failed:
+            text += "\nНе доставлено: " + ", ".join(f"<#{cid}>" for cid in failed[:20])
+        await _log_action(guild, "Broadcast", text)
+
+
+status_broadcaster = StatusBroadcaster()
+
+
+STATUS_EDIT_DEBOUNCE = config.get("STATUS_EDIT_DEBOUNCE", 3)
+
+
+class StatusMessage:
+    """Одно закреплённое сообщение статуса на сервер.
+
+    Вместо нового embed на каждое изменение бот редактирует своё сообщение
+    в канале статуса (ID хранится в guild data). Правки откладываются на
+    STATUS_EDIT_DEBOUNCE секунд — частые переключения схлопываются в один
+    запрос. Если сообщение удалили, оно создаётся и закрепляется заново.
+    Обновления одного сервера идут по очереди (лок на сервер) — иначе два
+    перекрывающихся обновления могли создать два сообщения.
+    """
+
+    def __init__(self):
+        self.pending: dict = {}
+        self.locks: dict = {}
+
+    def schedule(self, guild):
+        if guild.id in self.pending:
+            return
+        self.pending[guild.id] = asyncio.create_task(self._later(guild))
+
+    async def _later(self, guild):
+        try:
+            await asyncio.sleep(STATUS_EDIT_DEBOUNCE)
+        finally:
+            # Снимаем отметку до отправки: изменение во время запроса
+            # запланирует ещё одну правку, а не потеряется
+            self.pending.pop(guild.id, None)
+        await self.update(guild)
+
+    async def update(self, guild):
+        lock = self.locks.get(guild.id)
+        if lock is None:
+            lock = self.locks[guild.id] = asyncio.Lock()
+        async with lock:
+            await self._update(guild)
+
+    async def _update(self, guild):
+        ch_id = get_settings(guild.id).status_channel
+        channel = guild.get_channel(ch_id) if ch_id else None
+        if channel is None:
+            return
+        embed = build_status_embed(guild)
+        gd = get_guild_data(guild.id)
+        ref = gd.get("status_message") or {}
+        if ref.get("channel") == ch_id and ref.get("message"):
+            await channel_bucket(ch_id).acquire()
+            try:
+                await channel.get_partial_message(ref["message"]).edit(embed=embed)
+                return
+            except discord.NotFound:
+                pass
+            except discord.HTTPException:
+                return
+        await channel_bucket(ch_id).acquire()
+        try:
+            msg = await channel.send(embed=embed)
+        except discord.HTTPException:
+            return
+        try: await msg.pin()
+        except discord.HTTPException: log.debug("Не удалось закрепить статус", exc_info=True, extra={"guild": guild.id})
+        gd["status_message"] = {"channel": ch_id, "message": msg.id}
+        await update_guild_data(guild.id, gd)
+
+
+status_message = StatusMessage()
+
+
+def _notify_status(guild, embed):
+    # Не ждём рассылку — отправивший модалку сразу получает ответ
+    status_message.schedule(guild)
+    return status_broadcaster.broadcast(guild, embed)
+
+
+# ─── Метрики ──────────────────────────────────────────────── #
+# Команды, время до ответа на взаимодействие, запросы к Discord API
+# (с 429 по маршрутам), хранилище и логи. METRICS_PORT — порт локального
+# HTTP /metrics для Prometheus (в кластере к нему прибавляется номер
+# процесса), сводка — /stats.
+
+METRICS_HOST = config.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = config.get("METRICS_PORT", 0)
+
+registry = Registry()
+m_commands = registry.counter("bot_commands_total", "Вызовы команд по результату", ("command", "status"))
+m_command_seconds = registry.histogram("bot_command_seconds", "Время выполнения команды", ("command",))
+m_ack_seconds = registry.histogram("bot_interaction_ack_seconds", "Время от создания взаимодействия до ответа", ("command",))
+m_http = registry.counter("bot_http_requests_total", "Запросы к Discord API", ("route", "status"))
+m_http_seconds = registry.histogram("bot_http_seconds", "Время запросов к Discord API", ("route",))
+m_ratelimits = registry.counter("bot_ratelimit_hits_total", "Ответы 429 от Discord", ("route",))
+m_storage_seconds = registry.histogram("bot_storage_seconds", "Время операций хранилища", ("op",))
+m_storage_errors = registry.counter("bot_storage_errors_total", "Ошибки хранилища", ("op",))
+m_log_actions = registry.counter("bot_log_actions_total", "Записи в лог-канал", ("action",))
+registry.gauge("bot_log_queue_depth", "Записей в очередях логов", lambda: sum(q.qsize() for q in log_dispatcher.queues.values()))
+registry.gauge("bot_guilds", "Серверов", lambda: len(bot.guilds))
+registry.gauge("bot_scheduled_jobs", "Заданий в планировщике", lambda: len(scheduler.heap))
+registry.gauge("bot_uptime_seconds", "Аптайм", lambda: time.time() - start_time)
+registry.gauge("bot_latency_seconds", "Пинг шлюза по шардам",
+               lambda: {(str(sid),): lat for sid, lat in getattr(bot, "latencies", [(0, bot.latency)]) if lat < float("inf")},
+               ("shard",))
+
+INTERACT_ROUTE = "POST /interactions/{interaction_id}/{interaction_token}/callback"
+# Отсчёт — от создания взаимодействия (время из snowflake ID), а не от
+# on_interaction: discord.py запускает команду раньше, чем этот listener.
+_inflight: dict = {}    # interaction.id -> (время создания, команда, это команда?)
+INFLIGHT_LIMIT = 10000
+
+
+STORAGE_SLOW = config.get("STORAGE_SLOW", 0.5)    # сек — медленные операции попадают в журнал
+
+
+def _observe_storage(op: str, seconds: float, failed: bool):
+    m_storage_seconds.observe(seconds, op)
+    if failed:
+        m_storage_errors.inc(op)
+        log.error("Ошибка хранилища: %s", op, extra={"op": op, "ms": round(seconds * 1000, 1)})
+    elif seconds >= STORAGE_SLOW:
+        log.warning("Медленная операция хранилища: %s %.0f мс", op, seconds * 1000, extra={"op": op, "ms": round(seconds * 1000, 1)})
+    else:
+        log.debug("storage %s", op, extra={"op": op, "ms": round(seconds * 1000, 2)})
+
+
+def _route_label(method: str, url: str) -> str:
+    path = re.sub(r"^https?://[^/]+/api/v\d+", "", str(url)).split("?")[0]
+    path = re.sub(r"/\d{15,}", "/{id}", path)
+    return f"{method} " + re.sub(r"/[\w-]{50,}", "/{token}", path)
+
+
+class RateLimitWatcher(logging.Handler):
+    """discord.py сам ждёт и повторяет запрос после 429 и лишь пишет
+    предупреждение в лог — по этим записям и считаем попадания."""
+
+    def emit(self, record: logging.LogRecord):
+        msg = record.msg if isinstance(record.msg, str) else ""
+        if msg.startswith("We are being rate limited") and len(record.args) >= 2:
+            m_ratelimits.inc(_route_label(record.args[0], record.args[1]))
+        elif msg.startswith("Global rate limit"):
+            m_ratelimits.inc("global")
+
+
+def _timed_http(request):
+    @functools.wraps(request)
+    async def timed(route, **kwargs):
+        label = f"{route.method} {route.path}"
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            return await request(route, **kwargs)
+        except discord.HTTPException as e:
+            status = str(e.status)
+            raise
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            m_http.inc(label, status)
+            m_http_seconds.observe(time.perf_counter() - started, label)
+    return timed
+
+
+def _timed_ack(create_response):
+    # Первый ответ на взаимодействие идёт не через bot.http, а через
+    # webhook-адаптер discord.py — засекаем время до ответа здесь.
+    @functools.wraps(create_response)
+    async def timed(self, interaction_id, token, **kwargs):
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            return await create_response(self, interaction_id, token, **kwargs)
+        except discord.HTTPException as e:
+            status = str(e.status)
+            raise
+        finally:
+            m_http.inc(INTERACT_ROUTE, status)
+            m_http_seconds.observe(time.perf_counter() - started, INTERACT_ROUTE)
+            iid = int(interaction_id)
+            seen = _inflight.get(iid)
+            created = seen[0] if seen else discord.utils.snowflake_time(iid).timestamp()
+            m_ack_seconds.observe(max(0.0, time.time() - created), seen[1] if seen else "unknown")
+            if seen is not None and not seen[2]:
+                del _inflight[iid]
+    return timed
+
+
+def install_metrics():
+    store.observe = _observe_storage
+    bot.http.request = _timed_http(bot.http.request)
+    adapter = discord.webhook.async_.AsyncWebhookAdapter
+    adapter.create_interaction_response = _timed_ack(adapter.create_interaction_response)
+    logging.getLogger("discord.http").addHandler(RateLimitWatcher(logging.WARNING))
+
+
+@bot.listen("on_interaction")
+async def metrics_on_interaction(interaction: discord.Interaction):
+    command = interaction.command
+    label = command.qualified_name if command is not None else interaction.type.name
+    _inflight[interaction.id] = (interaction.created_at.timestamp(), label, command is not None)
+    while len(_inflight) > INFLIGHT_LIMIT:
+        _inflight.pop(next(iter(_inflight)))
+
+
+def finish_command(interaction: discord.Interaction, status: str):
+    """Метрики и запись в журнал по завершении команды."""
+    seen = _inflight.pop(interaction.id, None)
+    label = seen[1] if seen else (interaction.command.qualified_name if interaction.command else "unknown")
+    m_commands.inc(label, status)
+    took = None
+    if seen is not None:
+        took = max(0.0, time.time() - seen[0])
+        m_command_seconds.observe(took, label)
+    log.info("/%s — %s", label, status, extra={
+        "command": label, "status": status, "ms": round(took * 1000, 1) if took is not None else None,
+        "guild": interaction.guild_id, "user": interaction.user.id,
+    })
+
+
+@bot.listen("on_app_command_completion")
+async def metrics_on_completion(interaction: discord.Interaction, command):
+    finish_command(interaction, "ok")
+
+
+def _ms(seconds: Optional[float]) -> str:
+    return "—" if seconds is None else f"{seconds * 1000:.0f} мс"
+
+
+@bot.tree.command(name="stats", description="📈 Метрики бота")
+@is_admin()
+async def stats_cmd(interaction: discord.Interaction):
+    e = Style.embed(guild=interaction.guild)
+    e.title = "📈  Метрики бота"
+    uptime = int(time.time() - start_time)
+    e.description = f"Аптайм `{uptime // 3600}ч {uptime % 3600 // 60}м` │ Серверов `{len(bot.guilds)}`"
+
+    calls: dict = {}
+    errors: dict = {}
+    for (command, status), n in m_commands.values.items():
+        calls[command] = calls.get(command, 0) + n
+        if status != "ok":
+            errors[command] = errors.get(command, 0) + n
+    top = sorted(calls.items(), key=lambda x: x[1], reverse=True)[:8]
+    lines = [f"`/{c}` — {int(n)} │ p50 {_ms(m_command_seconds.quantile(0.5, c))} │ p95 {_ms(m_command_seconds.quantile(0.95, c))}"
+             f" │ ошибок {errors.get(c, 0) / n:.0%}" for c, n in top]
+    e.add_field(name="⚡ Команды", value="\n".join(lines) or "—", inline=False)
+    e.add_field(name="⏱️ Ответ на взаимодействие",
+                value=f"p50 `{_ms(m_ack_seconds.quantile(0.5))}` │ p95 `{_ms(m_ack_seconds.quantile(0.95))}` │ p99 `{_ms(m_ack_seconds.quantile(0.99))}`",
+                inline=False)
+
+    failed = sum(n for (_, status), n in m_http.values.items() if status != "ok")
+    slow = sorted(((m_http_seconds.quantile(0.95, *k) or 0, k[0]) for k in m_http_seconds.series), reverse=True)[:3]
+    api = [f"Запросов `{int(m_http.total())}` │ ошибок `{int(failed)}` │ 429 `{int(m_ratelimits.total())}`"]
+    api += [f"`{route[:60]}` p95 {_ms(p95)}" for p95, route in slow]
+    limited = sorted(m_ratelimits.values.items(), key=lambda x: x[1], reverse=True)[:3]
+    api += [f"429 `{route[0][:60]}` × {int(n)}" for route, n in limited]
+    e.add_field(name="🌐 Discord API", value="\n".join(api), inline=False)
+
+    ops = sorted(m_storage_seconds.series, key=lambda k: m_storage_seconds.count(*k), reverse=True)[:5]
+    storage_lines = [f"`{op[0]}` × {m_storage_seconds.count(*op)} │ p95 {_ms(m_storage_seconds.quantile(0.95, *op))}" for op in ops]
+    e.add_field(name="💾 Хранилище", value="\n".join(storage_lines) or "—", inline=False)
+    Style.footer(e, interaction.user)
+    await interaction.response.send_message(embed=e, ephemeral=True)
 
 
 # ╔═══════════════════════════════════════════════════════════╗
 # ║                    СОБЫТИЯ / EVENTS                       ║
 # ╚═══════════════════════════════════════════════════════════╝
 
-@bot.event
-async def on_ready():
-    print(f"\n{'═' * 50}")
-    print(f"  🤖 {bot.user.name} запущен!")
-    print(f"  📡 ID: {bot.user.id}")
-    print(f"  🌐 Серверов: {len(bot.guilds)}")
-    print(f"{'═' * 50}")
+# ─── Синхронизация команд ─────────────────────────────────── #
+# Глобальный sync медленный и жёстко ограничен по частоте, поэтому дерево
+# команд хэшируется и синхронизируется, только если что-то поменялось
+# (или при запуске с --sync). DEV_GUILDS — список ID серверов для
+# разработки: команды копируются туда и обновляются мгновенно, а
+# глобальный sync не выполняется.
 
+COMMAND_HASH_FILE = config.get("COMMAND_HASH_FILE", "command_tree.hash")
+DEV_GUILDS = config.get("DEV_GUILDS", [])
+
+
+def _command_dict(command) -> dict:
+    # discord.py 2.4+ передаёт дерево в to_dict, 2.3 — без аргументов
+    try:
+        return command.to_dict(bot.tree)
+    except TypeError:
+        return command.to_dict()
+
+
+def command_tree_hash(guild: Optional[discord.abc.Snowflake] = None) -> str:
+    commands_ = sorted((_command_dict(c) for c in bot.tree.get_commands(guild=guild)),
+                       key=lambda c: (c.get("type", 1), c["name"]))
+    return hashlib.sha256(json.dumps(commands_, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+def _load_command_hashes() -> dict:
+    try:
+        with open(COMMAND_HASH_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+async def sync_commands():
+    hashes = _load_command_hashes()
+    force = "--sync" in sys.argv
+    targets = [discord.Object(gid) for gid in DEV_GUILDS] or [None]
+    for guild in targets:
+        if guild is not None:
+            bot.tree.copy_global_to(guild=guild)
+        key = f"{bot.application_id}:{guild.id if guild else 'global'}"
+        digest = command_tree_hash(guild)
+        where = f"сервер {guild.id}" if guild else "глобально"
+        if not force and hashes.get(key) == digest:
+            log.info("✅ Команды не менялись (%s) — sync пропущен", where)
+            continue
+        try:
+            synced = await bot.tree.sync(guild=guild)
+        except discord.HTTPException as e:
+            log.error("❌ Ошибка синхронизации (%s): %s", where, e, exc_info=e)
+            continue
+        hashes[key] = digest
+        log.info("✅ Синхронизировано %d команд (%s)", len(synced), where)
+    with open(COMMAND_HASH_FILE, "w", encoding="utf-8") as f:
+        json.dump(hashes, f, indent=2)
+
+
+@bot.event
+async def setup_hook():
+    """Разовая инициализация: вызывается один раз после входа, до
+    подключения к шлюзу. on_ready же срабатывает и при переподключениях."""
+    boot_mark("вход в Discord")
+    install_metrics()
+    if METRICS_PORT:
+        port = METRICS_PORT + (CLUSTER_ID or 0)
+        try:
+            await serve_metrics(registry, METRICS_HOST, port)
+            log.info("📈 Метрики: http://%s:%d/metrics", METRICS_HOST, port)
+        except OSError as e:
+            log.error("❌ Метрики не запущены: %s", e)
+    scheduler.start()
+    db_flush_loop.start()
+    db_compact_loop.start()
+    warn_sweep_loop.start()
     bot.add_view(TicketCreateView())
     bot.add_view(TicketCloseView())
+    boot_mark("фоновые задачи и view")
+    # В кластере дерево команд общее — синхронизирует только первый процесс
+    if not CLUSTER_ID:
+        await sync_commands()
+        boot_mark("синхронизация команд")
 
-    try:
-        synced = await bot.tree.sync()
-        print(f"  ✅ Синхронизировано {len(synced)} команд")
-    except Exception as e:
-        print(f"  ❌ Ошибка синхронизации: {e}")
 
+_ready_once = False
+
+
+@bot.event
+async def on_ready():
+    global _ready_once, _chunk_task
     await bot.change_presence(activity=discord.Activity(type=discord.ActivityType.watching, name=f"{len(bot.guilds)} серверов 👀"))
-    print(f"{'═' * 50}\n")
+    if _ready_once:
+        log.info("🔄 Переподключение — серверов: %d", len(bot.guilds))
+        return
+    _ready_once = True
+    boot_mark("подключение к шлюзу")
+
+    log.info("🤖 %s запущен! ID: %s, серверов: %d", bot.user.name, bot.user.id, len(bot.guilds),
+             extra={"guilds": len(bot.guilds)})
+    total = time.perf_counter() - BOOT_STARTED
+    log.info("⏱️ Запуск за %.2fс: %s", total, ", ".join(f"{stage} {took:.2f}с" for stage, took in boot_marks),
+             extra={"boot": {stage: round(took, 3) for stage, took in boot_marks}, "boot_total": round(total, 3)})
+
+    if MEMBER_CACHE == "full" and intents.members:
+        _chunk_task = asyncio.create_task(chunk_guilds_lazily())
+
+
+# ─── Поток входов: приветствия и авто-роли ────────────────── #
+
+JOIN_WINDOW = config.get("JOIN_WINDOW", 2)        # сек, за которые копятся входы
+JOIN_MENTIONS_LIMIT = 30                          # сколько упоминаний в одном приветствии
+AUTOROLE_RATE = config.get("AUTOROLE_RATE", 10)   # выдач роли за 10 секунд на сервер
+AUTOROLE_RETRIES = 3
+
+
+class JoinPipeline:
+    """Приветствия пачками.
+
+    Входы копятся JOIN_WINDOW секунд. Один вошедший — обычное приветствие,
+    наплыв — одно общее сообщение со списком новичков.
+    """
+
+    def __init__(self):
+        self.buffers: dict = {}
+
+    def add(self, member):
+        buf = self.buffers.get(member.guild.id)
+        if buf is None:
+            buf = self.buffers[member.guild.id] = []
+            asyncio.create_task(self._flush_later(member.guild))
+        buf.append(member)
+
+    async def _flush_later(self, guild):
+        await asyncio.sleep(JOIN_WINDOW)
+        members = self.buffers.pop(guild.id, [])
+        if members:
+            await self._welcome(guild, members)
+
+    async def _welcome(self, guild, members: list):
+        s = get_settings(guild.id)
+        ch = guild.get_channel(s.welcome_channel) if s.welcome_channel else None
+        if ch is None:
+            return
+        shown = members[:JOIN_MENTIONS_LIMIT]
+        mentions = ", ".join(m.mention for m in shown)
+        if len(members) > len(shown):
+            mentions += f" и ещё {len(members) - len(shown)}"
+        e = Style.embed(color=Style.SUCCESS, settings=s)
+        e.description = s.render_welcome({"user": mentions, "server": guild.name, "count": str(guild.member_count)})
+        if len(members) == 1:
+            e.title = "👋  Добро пожаловать!"
+            e.set_thumbnail(url=members[0].display_avatar.url)
+            e.set_footer(text=f"Участник #{guild.member_count}")
+        else:
+            e.title = f"👋  Добро пожаловать, новички! (+{len(members)})"
+            e.set_footer(text=f"Всего участников: {guild.member_count}")
+        await channel_bucket(ch.id).acquire()
+        try: await ch.send(embed=e)
+        except discord.HTTPException: log.warning("Приветствие не отправлено", exc_info=True, extra={"guild": guild.id})
+
+
+class AutoroleQueue:
+    """Очередь выдачи авто-роли: свой воркер на сервер, лимит скорости
+    и повтор с backoff при временных ошибках."""
+
+    def __init__(self):
+        self.queues: dict = {}
+        self.buckets: dict = {}
+        self.workers: dict = {}
+
+    def put(self, member, role, attempt: int = 0):
+        gid = member.guild.id
+        q = self.queues.get(gid)
+        if q is None:
+            q = self.queues[gid] = asyncio.Queue()
+            self.buckets[gid] = TokenBucket(AUTOROLE_RATE, 10)
+        q.put_nowait((member, role, attempt))
+        worker = self.workers.get(gid)
+        if worker is None or worker.done():
+            self.workers[gid] = asyncio.create_task(self._worker(gid, q))
+
+    async def _worker(self, gid: int, q: asyncio.Queue):
+        while not q.empty():
+            member, role, attempt = q.get_nowait()
+            await self.buckets[gid].acquire()
+            try:
+                await member.add_roles(role, reason="Авто-роль")
+            except (discord.Forbidden, discord.NotFound) as err:
+                log.warning("Авто-роль не выдана: %s", err, extra={"guild": gid, "user": member.id})
+            except (discord.HTTPException, aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt + 1 < AUTOROLE_RETRIES:
+                    asyncio.get_running_loop().call_later(2 ** attempt, self.put, member, role, attempt + 1)
+        self.workers.pop(gid, None)
+
+
+join_pipeline = JoinPipeline()
+autorole_queue = AutoroleQueue()
 
 
 @bot.event
 async def on_member_join(member):
-    gd = get_guild_data(member.guild.id)
-    s = gd["settings"]
-    # Приветствие
-    if s.get("welcome_channel"):
-        ch = member.guild.get_channel(s["welcome_channel"])
-        if ch:
-            msg = s.get("welcome_message", "Добро пожаловать, {user}!")
-            msg = msg.replace("{user}", member.mention).replace("{server}", member.guild.name).replace("{count}", str(member.guild.member_count))
-            e = Style.embed(color=Style.SUCCESS, guild=member.guild)
-            e.title = "👋  Добро пожаловать!"
-            e.description = msg
-            e.set_thumbnail(url=member.display_avatar.url)
-            e.set_footer(text=f"Участник #{member.guild.member_count}")
-            try: await ch.send(embed=e)
-            except: pass
-    # Авто-роль
-    if s.get("autorole"):
-        role = member.guild.get_role(s["autorole"])
+    s = get_settings(member.guild.id)
+    if s.antiraid:
+        await anti_raid.on_join(member)
+    if s.welcome_channel:
+        join_pipeline.add(member)
+    if s.autorole:
+        role = member.guild.get_role(s.autorole)
         if role:
-            try: await member.add_roles(role)
-            except: pass
+            autorole_queue.put(member, role)
+
+
+# ─── Защита от рейдов и спама ─────────────────────────────── #
+
+ANTIRAID_DEFAULTS = {
+    "msg_rate": 8,          # сообщений от одного участника за 5 секунд
+    "duplicates": 4,        # одинаковых сообщений на сервере за 30 секунд
+    "mentions": 10,         # упоминаний от одного участника за 10 секунд
+    "joins": 10,            # входов на сервер за 10 секунд
+    "timeout_minutes": 10,
+    "slowmode": 10,
+    "lockdown_minutes": 15,
+}
+ANTIRAID_USERS = config.get("ANTIRAID_USERS", 5000)     # сколько активных участников отслеживаем на сервер
+ANTIRAID_SLOWMODE_MINUTES = config.get("ANTIRAID_SLOWMODE_MINUTES", 10)   # через сколько слоумод откатывается
+ANTIRAID_HASHES = 1024                                   # сколько разных текстов помним на сервер
+
+
+class RingCounter:
+    """Скользящее окно на кольце корзин: window секунд делится на slots
+    корзин, сумма держится отдельно. Добавление — O(1) (обнуляется не
+    больше slots устаревших корзин), память постоянная."""
+
+    __slots__ = ("width", "counts", "total", "head")
+
+    def __init__(self, window: float, slots: int = 5):
+        self.width = window / slots
+        self.counts = [0] * slots
+        self.total = 0
+        self.head = 0
+
+    def add(self, now: float, n: int = 1) -> int:
+        tick = int(now / self.width)
+        if tick > self.head:
+            for t in range(max(self.head + 1, tick - len(self.counts) + 1), tick + 1):
+                i = t % len(self.counts)
+                self.total -= self.counts[i]
+                self.counts[i] = 0
+            self.head = tick
+        self.counts[tick % len(self.counts)] += n
+        self.total += n
+        return self.total
+
+
+class RaidUser:
+    __slots__ = ("messages", "mentions", "punished_until")
+
+    def __init__(self):
+        self.messages = RingCounter(5)
+        self.mentions = RingCounter(10)
+        self.punished_until = 0.0
+
+
+class RaidGuild:
+    """Счётчики одного сервера. Участники и тексты — LRU с потолком,
+    поэтому память не зависит от размера сервера (100k+ участников)."""
+
+    def __init__(self):
+        self.joins = RingCounter(10)
+        self.users: OrderedDict = OrderedDict()
+        self.hashes: OrderedDict = OrderedDict()
+        self.slowed: dict = {}          # channel_id -> до какого времени не трогаем
+        self.locked = False
+
+    def user(self, user_id: int) -> RaidUser:
+        state = self.users.get(user_id)
+        if state is None:
+            state = self.users[user_id] = RaidUser()
+            if len(self.users) > ANTIRAID_USERS:
+                self.users.popitem(last=False)
+        else:
+            self.users.move_to_end(user_id)
+        return state
+
+    def duplicate(self, content: str, now: float) -> int:
+        key = hash(content.casefold().strip())
+        counter = self.hashes.get(key)
+        if counter is None:
+            counter = self.hashes[key] = RingCounter(30)
+            if len(self.hashes) > ANTIRAID_HASHES:
+                self.hashes.popitem(last=False)
+        else:
+            self.hashes.move_to_end(key)
+        return counter.add(now)
+
+
+class AntiRaid:
+    """Включается на сервере командой /antiraid enable. Каждое событие
+    обновляет счётчики за O(1); при превышении порога — таймаут участнику,
+    слоумод каналу или локдаун сервера (максимальный уровень проверки)."""
+
+    def __init__(self):
+        self.guilds: dict = {}
+
+    def state(self, guild_id: int) -> RaidGuild:
+        st = self.guilds.get(guild_id)
+        if st is None:
+            st = self.guilds[guild_id] = RaidGuild()
+        return st
+
+    def forget(self, guild_id: int):
+        self.guilds.pop(guild_id, None)
+
+    async def on_message(self, message: discord.Message):
+        cfg = get_settings(message.guild.id).antiraid
+        if cfg is None or message.author.bot or not isinstance(message.author, discord.Member):
+            return
+        if message.author.guild_permissions.manage_messages:
+            return
+        now = time.time()
+        st = self.state(message.guild.id)
+        user = st.user(message.author.id)
+        reason = None
+        if user.messages.add(now) > cfg["msg_rate"]:
+            reason = "флуд сообщениями"
+        # mentions/role_mentions приходят в payload шлюза; raw_* разбирают
+        # content, который без MESSAGE_CONTENT_INTENT пуст
+        mentions = len(message.mentions) + len(message.role_mentions) + (5 if message.mention_everyone else 0)
+        if mentions and user.mentions.add(now, mentions) > cfg["mentions"]:
+            reason = "массовые упоминания"
+        if message.content and st.duplicate(message.content, now) >= cfg["duplicates"]:
+            reason = reason or "повтор одинаковых сообщений"
+            await self._slowmode(message.channel, st, cfg, now)
+        if reason and user.punished_until < now:
+            user.punished_until = now + cfg["timeout_minutes"] * 60
+            moderation_queue.submit(message.guild, "timeout", message.author, f"Анти-спам: {reason}",
+                                    datetime.timedelta(minutes=cfg["timeout_minutes"]))
+            await _log_action(message.guild, "AntiRaid", f"{message.author} — таймаут {cfg['timeout_minutes']} мин ({reason})")
+
+    async def _slowmode(self, channel, st: RaidGuild, cfg: dict, now: float):
+        if st.slowed.get(channel.id, 0) > now or getattr(channel, "slowmode_delay", cfg["slowmode"]) >= cfg["slowmode"]:
+            return
+        st.slowed[channel.id] = now + 60
+        until = now + ANTIRAID_SLOWMODE_MINUTES * 60
+        prev = getattr(channel, "slowmode_delay", 0)
+
+        def mark(gd):
+            # prev не перезаписываем: если слоумод уже наш, вернуть нужно исходный
+            slow = gd.setdefault("antiraid_slowmode", {}).setdefault(str(channel.id), {"prev": prev})
+            slow.update(delay=cfg["slowmode"], until=until)
+
+        # Сначала запись в базу, как у локдауна: если бот упадёт сразу после
+        # правки канала, слоумод всё равно снимется после перезапуска
+        await store.modify(channel.guild.id, mark)
+        self.schedule_slowmode_revert(channel.guild, channel.id, until)
+        try:
+            await channel.edit(slowmode_delay=cfg["slowmode"], reason="Анти-спам: повтор сообщений")
+            await _log_action(channel.guild, "AntiRaid", f"Слоумод {cfg['slowmode']}с в #{channel.name} на {ANTIRAID_SLOWMODE_MINUTES} мин")
+        except discord.HTTPException:
+            log.warning("Анти-спам: слоумод не включён", exc_info=True, extra={"guild": channel.guild.id})
+
+    def schedule_slowmode_revert(self, guild: discord.Guild, channel_id: int, until: float):
+        scheduler.at(until, "antiraid_slowmode", guild.id, channel_id)
+
+    async def revert_slowmode(self, guild: discord.Guild, channel_id: int):
+        slow = None
+
+        def clear(gd):
+            nonlocal slow
+            slowed = gd.get("antiraid_slowmode", {})
+            slow = slowed.pop(str(channel_id), None)
+            if not slowed:
+                gd.pop("antiraid_slowmode", None)
+
+        await store.modify(guild.id, clear)
+        channel = guild.get_channel(channel_id)
+        # Если слоумод с тех пор поменяли руками — не трогаем
+        if slow is None or channel is None or getattr(channel, "slowmode_delay", None) != slow["delay"]:
+            return
+        try:
+            await channel.edit(slowmode_delay=slow["prev"], reason="Анти-спам: слоумод снят")
+        except discord.HTTPException:
+            log.warning("Анти-спам: слоумод не снят", exc_info=True, extra={"guild": guild.id})
+            return
+        await _log_action(guild, "AntiRaid", f"Слоумод в #{channel.name} снят")
+
+    async def on_join(self, member: discord.Member):
+        cfg = get_settings(member.guild.id).antiraid
+        if cfg is None:
+            return
+        st = self.state(member.guild.id)
+        if st.joins.add(time.time()) >= cfg["joins"] and not st.locked:
+            await self.lockdown(member.guild, cfg["lockdown_minutes"])
+
+    async def lockdown(self, guild: discord.Guild, minutes: int):
+        st = self.state(guild.id)
+        st.locked = True
+        until = time.time() + minutes * 60
+        prev = guild.verification_level.value
+
+        def mark(gd):
+            gd.setdefault("antiraid_lock", {"prev": prev})["until"] = until
+
+        await store.modify(guild.id, mark)
+        try:
+            await guild.edit(verification_level=discord.VerificationLevel.highest, reason="Анти-рейд: наплыв входов")
+        except discord.HTTPException:
+            log.warning("Анти-рейд: локдаун не включён", exc_info=True, extra={"guild": guild.id})
+        await _log_action(guild, "AntiRaid", f"🔒 Локдаун на {minutes} мин — наплыв входов")
+        self.schedule_unlock(guild, until)
+
+    def schedule_unlock(self, guild: discord.Guild, until: float):
+        scheduler.at(until, "antiraid_unlock", guild.id)
+
+    async def unlock(self, guild: discord.Guild) -> bool:
+        lock = None
+
+        def clear(gd):
+            nonlocal lock
+            lock = gd.pop("antiraid_lock", None)
+
+        await store.modify(guild.id, clear)
+        self.state(guild.id).locked = False
+        if lock is None:
+            return False
+        try:
+            await guild.edit(verification_level=discord.VerificationLevel(lock["prev"]), reason="Анти-рейд: локдаун снят")
+        except discord.HTTPException:
+            log.warning("Анти-рейд: уровень проверки не восстановлен", exc_info=True, extra={"guild": guild.id})
+        await _log_action(guild, "AntiRaid", "🔓 Локдаун снят")
+        return True
+
+
+anti_raid = AntiRaid()
+
+
+@bot.listen("on_guild_available")
+@bot.listen("on_guild_join")
+async def antiraid_restore_lock(guild: discord.Guild):
+    # Локдауны и слоумоды, включённые до перезапуска или недоступности
+    # сервера, снимутся по своему сроку
+    gd = get_guild_data(guild.id)
+    lock = gd.get("antiraid_lock")
+    if lock:
+        anti_raid.state(guild.id).locked = True
+        anti_raid.schedule_unlock(guild, lock["until"])
+    for channel_id, slow in gd.get("antiraid_slowmode", {}).items():
+        anti_raid.schedule_slowmode_revert(guild, int(channel_id), slow["until"])
+
+
+@scheduler.handler("antiraid_unlock")
+async def antiraid_unlock_job(guild: discord.Guild, key, when: float):
+    lock = get_guild_data(guild.id).get("antiraid_lock")
+    if lock and lock["until"] <= time.time():
+        await anti_raid.unlock(guild)
+
+
+@scheduler.handler("antiraid_slowmode")
+async def antiraid_slowmode_job(guild: discord.Guild, channel_id: int, when: float):
+    slow = get_guild_data(guild.id).get("antiraid_slowmode", {}).get(str(channel_id))
+    if slow and slow["until"] <= time.time():
+        await anti_raid.revert_slowmode(guild, channel_id)
+
+
+@bot.listen("on_message")
+async def antiraid_on_message(message: discord.Message):
+    if message.guild:
+        await anti_raid.on_message(message)
+
+
+antiraid_group = app_commands.Group(name="antiraid", description="🛡️ Защита от рейдов и спама")
+
+@antiraid_group.command(name="enable", description="🛡️ Включить защиту")
+@is_admin()
+@app_commands.describe(msg_rate="Сообщений от участника за 5с", duplicates="Одинаковых сообщений за 30с",
+                       mentions="Упоминаний от участника за 10с", joins="Входов за 10с до локдауна",
+                       timeout_minutes="Таймаут нарушителю (мин)", slowmode="Слоумод при спаме (с)", lockdown_minutes="Длительность локдауна (мин)")
+async def antiraid_enable(interaction: discord.Interaction,
+                          msg_rate: Optional[app_commands.Range[int, 2, 100]] = None,
+                          duplicates: Optional[app_commands.Range[int, 2, 100]] = None,
+                          mentions: Optional[app_commands.Range[int, 2, 200]] = None,
+                          joins: Optional[app_commands.Range[int, 2, 500]] = None,
+                          timeout_minutes: Optional[app_commands.Range[int, 1, 40320]] = None,
+                          slowmode: Optional[app_commands.Range[int, 1, 21600]] = None,
+                          lockdown_minutes: Optional[app_commands.Range[int, 1, 1440]] = None):
+    gd = get_guild_data(interaction.guild.id)
+    cfg = gd["settings"].setdefault("antiraid", {})
+    cfg["enabled"] = True
+    given = {"msg_rate": msg_rate, "duplicates": duplicates, "mentions": mentions, "joins": joins,
+             "timeout_minutes": timeout_minutes, "slowmode": slowmode, "lockdown_minutes": lockdown_minutes}
+    cfg.update({k: v for k, v in given.items() if v is not None})
+    await update_guild_data(interaction.guild.id, gd)
+    cfg = get_settings(interaction.guild.id).antiraid
+    e = Style.embed("🛡️  Защита включена", None, Style.SUCCESS, interaction.guild)
+    e.description = (f"Флуд: `{cfg['msg_rate']}` сообщ. / 5с\nПовторы: `{cfg['duplicates']}` / 30с\n"
+                     f"Упоминания: `{cfg['mentions']}` / 10с\nВходы: `{cfg['joins']}` / 10с\n"
+                     f"Таймаут `{cfg['timeout_minutes']}` мин, слоумод `{cfg['slowmode']}`с, локдаун `{cfg['lockdown_minutes']}` мин")
+    if not (intents.message_content and intents.members):
+        e.add_field(name="⚠️ Интенты", value="Для полной защиты включи `MEMBERS_INTENT` и `MESSAGE_CONTENT_INTENT`", inline=False)
+    Style.footer(e, interaction.user)
+    await interaction.response.send_message(embed=e, ephemeral=True)
+
+@antiraid_group.command(name="disable", description="⏸️ Выключить защиту")
+@is_admin()
+async def antiraid_disable(interaction: discord.Interaction):
+    gd = get_guild_data(interaction.guild.id)
+    gd["settings"].setdefault("antiraid", {})["enabled"] = False
+    await update_guild_data(interaction.guild.id, gd)
+    anti_raid.forget(interaction.guild.id)
+    e = Style.embed("⏸️  Защита выключена", None, Style.WARNING, interaction.guild)
+    Style.footer(e, interaction.user)
+    await interaction.response.send_message(embed=e, ephemeral=True)
+
+@antiraid_group.command(name="unlock", description="🔓 Снять локдаун")
+@is_admin()
+async def antiraid_unlock(interaction: discord.Interaction):
+    await interaction.response.defer(ephemeral=True)
+    done = await anti_raid.unlock(interaction.guild)
+    await interaction.followup.send("🔓 Локдаун снят." if done else "ℹ️ Локдаун не включён.", ephemeral=True)
+
+bot.tree.add_command(antiraid_group)
+
+
+# ─── Кэш участников ───────────────────────────────────────── #
+
+_interaction_cached: dict = {}   # guild.id -> сколько участников добавил режим "interaction"
+
+
+@bot.listen("on_interaction")
+async def cache_interaction_member(interaction: discord.Interaction):
+    # Режим "interaction": запоминаем только тех, кто реально пользуется
+    # ботом. Только с members-интентом — без него Discord не присылает
+    # изменения ролей/ников и уходы, и записи в кэше устаревали бы.
+    guild = interaction.guild
+    if MEMBER_CACHE != "interaction" or not intents.members or guild is None:
+        return
+    uid = interaction.user.id
+    # Счётчик не уменьшается при уходах — потолок соблюдается с запасом
+    added = _interaction_cached.get(guild.id, 0)
+    if guild.get_member(uid) is not None or added >= MEMBER_CACHE_LIMIT:
+        return
+    _interaction_cached[guild.id] = added + 1
+    try:
+        await guild.query_members(user_ids=[uid], cache=True)
+    except (asyncio.TimeoutError, discord.ClientException):
+        log.debug("Участник не добавлен в кэш", exc_info=True, extra={"guild": guild.id, "user": uid})
+
+
+async def chunk_guilds_lazily():
+    """Режим "full": догружаем участников по одному серверу в фоне,
+    чтобы запуск и on_ready не ждали чанков всех серверов."""
+    for guild in list(bot.guilds):
+        if guild.chunked or (CHUNK_GUILDS and guild.id not in CHUNK_GUILDS):
+            continue
+        try:
+            await guild.chunk(cache=True)
+        except (discord.HTTPException, asyncio.TimeoutError):
+            continue
+        await asyncio.sleep(1)
+
+
+def member_cache_bytes(guild: discord.Guild) -> int:
+    """Примерный объём кэша участников сервера: средний размер объекта
+    по выборке, умноженный на число участников в кэше."""
+    members = guild.members
+    if not members:
+        return 0
+    sample = members[:50]
+    per_member = sum(sys.getsizeof(m) + sys.getsizeof(m.name) + sys.getsizeof(m.nick or "") + 8 * len(m.roles) + 200
+                     for m in sample) / len(sample)
+    return int(per_member * len(members))
+
+
+def _mb(size: int) -> str:
+    return f"{size / 1024 / 1024:.1f} МБ"
+
+
+@bot.tree.command(name="cachestats", description="🧠 Кэш участников и память")
+@is_admin()
+async def cachestats_cmd(interaction: discord.Interaction):
+    guild = interaction.guild
+    e = Style.embed(guild=guild)
+    e.title = "🧠  Кэш участников"
+    e.description = f"Режим: `{MEMBER_CACHE}`" + ("" if intents.members else " (без `MEMBERS_INTENT`)")
+    e.add_field(name="В кэше", value=f"```{len(guild.members)} / {guild.member_count}```", inline=True)
+    e.add_field(name="Память", value=f"```≈ {_mb(member_cache_bytes(guild))}```", inline=True)
+    e.add_field(name="Загружен целиком", value=f"```{'да' if guild.chunked else 'нет'}```", inline=True)
+    if interaction.user.id in OWNER_IDS:
+        # Владельцу бота — самые тяжёлые серверы по всему процессу
+        sizes = sorted(((member_cache_bytes(g), g) for g in bot.guilds), key=lambda x: x[0], reverse=True)
+        total = sum(size for size, _ in sizes)
+        top = "\n".join(f"`{_mb(size):>9}` {g.name[:30]} ({len(g.members)})" for size, g in sizes[:10])
+        e.add_field(name=f"Все серверы — ≈ {_mb(total)}", value=top or "—", inline=False)
+    Style.footer(e, interaction.user)
+    await interaction.response.send_message(embed=e, ephemeral=True)
+
+
+# ─── Сброс журнала и снапшот базы ─────────────────────────── #
+
+@tasks.loop(seconds=DB_FLUSH_INTERVAL)
+async def db_flush_loop():
+    # Исключение внутри tasks.loop останавливает цикл навсегда — а с ним и
+    # запись на диск. Ошибку пишем в журнал и ждём следующего круга.
+    try:
+        await store.flush()
+        # В кластере подтягиваем настройки, изменённые другими процессами
+        for key in await store.refresh():
+            invalidate_settings(int(key))
+    except Exception:
+        log.exception("[DB] Ошибка сброса на диск")
+
+@tasks.loop(minutes=10)
+async def warn_sweep_loop():
+    # Истёкшие варны убираются здесь, а не в обработчиках команд
+    try:
+        await store.sweep_warns(time.time())
+    except Exception:
+        log.exception("[DB] Ошибка очистки истёкших варнов")
+
+@tasks.loop(seconds=DB_COMPACT_INTERVAL)
+async def db_compact_loop():
+    try:
+        await store.compact()
+    except Exception:
+        log.exception("[DB] Ошибка сворачивания журнала")
 
 
 # ─── Обработка ошибок ─────────────────────────────────────── #
 
 @bot.tree.error
 async def on_app_command_error(interaction, error):
+    finish_command(interaction, "denied" if isinstance(error, app_commands.CheckFailure) else "error")
     if isinstance(error, app_commands.CheckFailure):
         e = Style.embed("❌  Нет доступа", "Нужны права **администратора** или **модератора**.", Style.ERROR)
         Style.footer(e, interaction.user)
-        try: await interaction.response.send_message(embed=e, ephemeral=True)
-        except: await interaction.followup.send(embed=e, ephemeral=True)
     else:
         e = Style.embed("❌  Ошибка", f"```\n{error}\n```", Style.ERROR)
-        try: await interaction.response.send_message(embed=e, ephemeral=True)
-        except: await interaction.followup.send(embed=e, ephemeral=True)
-        print(f"[ERROR] {error}")
+        name = interaction.command.qualified_name if interaction.command else "?"
+        log.error("Ошибка в /%s: %s", name, error, exc_info=getattr(error, "original", error),
+                  extra={"command": name, "guild": interaction.guild_id, "user": interaction.user.id})
+    try:
+        if interaction.response.is_done():
+            await interaction.followup.send(embed=e, ephemeral=True)
+        else:
+            await interaction.response.send_message(embed=e, ephemeral=True)
+    except discord.HTTPException:
+        log.warning("Не удалось показать ошибку пользователю", exc_info=True)
 
 
 # ─── Запуск ───────────────────────────────────────────────── #
 
 if __name__ == "__main__":
+    failure = None
     try:
-        bot.run(TOKEN)
+        bot.run(TOKEN, log_handler=None)   # логи discord.py идут в наш журнал
     except discord.LoginFailure:
-        print("\n❌ ОШИБКА: Неверный токен бота!")
-        print("   Проверь TOKEN в config.json")
-        input("\nНажми Enter чтобы закрыть...")
+        failure = "Неверный токен бота! Проверь TOKEN в config.json"
     except Exception as e:
-        print(f"\n❌ ОШИБКА: {e}")
+        failure = str(e)
+        log.exception("Бот упал")
+    finally:
+        log_dispatcher.spill_pending()
+        store.close()
+        if failure:
+            log.critical("❌ ОШИБКА: %s", failure)
+        log_listener.stop()
+    if failure:
         input("\nНажми Enter чтобы закрыть...")
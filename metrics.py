@@ -0,0 +1,162 @@
+from aiohttp import web
+from bisect import bisect_left
+from typing import Optional
+
+# ═══════════════════════════════════════════════════════════════
+#  Метрики бота
+#
+#  Счётчики и гистограммы в памяти процесса + HTTP /metrics в текстовом
+#  формате Prometheus. Всё обновляется из event loop, поэтому без
+#  блокировок. Гистограммы — фиксированные корзины: память постоянная,
+#  перцентили для /stats оцениваются по корзинам.
+# ═══════════════════════════════════════════════════════════════
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, labels: tuple = ()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = labels
+        self.values: dict = {}
+
+    def inc(self, *labels, amount: float = 1.0):
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def total(self) -> float:
+        return sum(self.values.values())
+
+    def render(self) -> list:
+        return [f"{self.name}{_labels(self.labelnames, k)} {v:g}" for k, v in self.values.items()]
+
+
+class Gauge:
+    """Значение снимается в момент чтения: fn() возвращает число или
+    {значения меток: число}."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, doc: str, fn, labels: tuple = ()):
+        self.name = name
+        self.doc = doc
+        self.fn = fn
+        self.labelnames = labels
+
+    def render(self) -> list:
+        value = self.fn()
+        if not isinstance(value, dict):
+            value = {(): value}
+        return [f"{self.name}{_labels(self.labelnames, k)} {v:g}" for k, v in value.items()]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labelnames = labels
+        self.buckets = buckets
+        self.series: dict = {}   # метки -> [счётчики корзин (+Inf последней), сумма, количество]
+
+    def observe(self, value: float, *labels):
+        s = self.series.get(labels)
+        if s is None:
+            s = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        s[0][bisect_left(self.buckets, value)] += 1
+        s[1] += value
+        s[2] += 1
+
+    def count(self, *labels) -> int:
+        if labels:
+            s = self.series.get(labels)
+            return s[2] if s else 0
+        return sum(s[2] for s in self.series.values())
+
+    def quantile(self, q: float, *labels) -> Optional[float]:
+        """Оценка перцентиля по корзинам (линейно внутри корзины). Без
+        меток — по всем сериям вместе."""
+        if labels:
+            series = [self.series[labels]] if labels in self.series else []
+        else:
+            series = list(self.series.values())
+        counts = [sum(s[0][i] for s in series) for i in range(len(self.buckets) + 1)]
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for i, c in enumerate(counts):
+            if seen + c >= rank and c:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / c
+            seen += c
+        return self.buckets[-1]
+
+    def render(self) -> list:
+        lines = []
+        for labels, (counts, total, n) in self.series.items():
+            cumulative = 0
+            for bound, c in zip(self.buckets + (float("inf"),), counts):
+                cumulative += c
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound:g}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {total:g}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {n}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, doc: str, labels: tuple = ()) -> Counter:
+        return self._add(Counter(name, doc, labels))
+
+    def gauge(self, name: str, doc: str, fn, labels: tuple = ()) -> Gauge:
+        return self._add(Gauge(name, doc, fn, labels))
+
+    def histogram(self, name: str, doc: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, doc, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for m in self.metrics:
+            lines.append(f"# HELP {m.name} {m.doc}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+
+async def serve_metrics(registry: Registry, host: str, port: int) -> web.AppRunner:
+    """Поднять HTTP-сервер с /metrics. Вернуть runner для остановки."""
+
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,1134 @@
+import asyncio
+import functools
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from bisect import bisect_left, insort
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+log = logging.getLogger("bot.storage")
+
+# ═══════════════════════════════════════════════════════════════
+#  Хранилище данных серверов
+#
+#  Бот работает только через интерфейс StorageBackend, а конкретный
+#  движок выбирается в config.json ("STORAGE": "json" или "sqlite").
+# ═══════════════════════════════════════════════════════════════
+
+
+def default_guild_data() -> dict:
+    return {
+        "settings": {
+            "color": "5865F2",
+            "log_channel": None,
+            "status_channel": None,
+            "welcome_channel": None,
+            "welcome_message": "Добро пожаловать на сервер, {user}! 🎉",
+            "autorole": None,
+        },
+        "status": {
+            "state": "none",
+            "reason": "",
+            "estimated_time": "",
+            "additional_info": "",
+            "updated_by": "",
+            "updated_at": "",
+        },
+        "warns": {},
+        "tickets": {
+            "counter": 0,
+            "category": None,
+        },
+        "notes": [],
+    }
+
+
+class StorageBackend:
+    """Общий интерфейс хранилища.
+
+    get() отдаёт настройки/статус/тикеты сервера из памяти. Варны и
+    заметки читаются только через list_*/count_* — движок сам решает,
+    держать их в памяти или в отдельной таблице.
+    Запись отложенная: изменения копятся и уходят на диск в flush().
+    """
+
+    compact_due = False   # движок просит свернуть журнал при удобном случае
+
+    def load(self):
+        raise NotImplementedError
+
+    def get(self, guild_id: int) -> dict:
+        raise NotImplementedError
+
+    def put(self, guild_id: int, data: dict, flush: bool = False):
+        raise NotImplementedError
+
+    def set_status(self, guild_id: int, status: dict):
+        raise NotImplementedError
+
+    def next_ticket(self, guild_id: int) -> int:
+        raise NotImplementedError
+
+    def add_warn(self, guild_id: int, user_id: int, record: dict) -> int:
+        """Добавить варн (движок присваивает ему id), вернуть число варнов."""
+        raise NotImplementedError
+
+    def list_warns(self, guild_id: int, user_id: int, limit: int = 10, offset: int = 0) -> list:
+        """Страница варнов участника, новые первыми."""
+        raise NotImplementedError
+
+    def count_warns(self, guild_id: int, user_id: int) -> int:
+        raise NotImplementedError
+
+    def clear_warns(self, guild_id: int, user_id: int) -> int:
+        raise NotImplementedError
+
+    def remove_warn(self, guild_id: int, warn_id: int) -> Optional[str]:
+        """Снять один варн по id; вернуть ID участника или None."""
+        raise NotImplementedError
+
+    def sweep_warns(self, now: float) -> int:
+        """Удалить варны с истёкшим expires_at; вернуть сколько удалено."""
+        raise NotImplementedError
+
+    def add_note(self, guild_id: int, record: dict):
+        raise NotImplementedError
+
+    def list_notes(self, guild_id: int, limit: int = 10, before: Optional[int] = None) -> list:
+        """Заметки от новых к старым; before — курсор (id последней показанной)."""
+        raise NotImplementedError
+
+    def search_notes(self, guild_id: int, query: str, limit: int = 10, after: Optional[tuple] = None) -> list:
+        """Поиск по словам (префиксы), лучшие совпадения первыми. У каждой
+        заметки есть score; курсор следующей страницы — (score, id) последней."""
+        raise NotImplementedError
+
+    def count_notes(self, guild_id: int) -> int:
+        raise NotImplementedError
+
+    def add_ticket(self, guild_id: int, record: dict):
+        raise NotImplementedError
+
+    def get_ticket(self, guild_id: int, num: Optional[int] = None, channel_id: Optional[int] = None) -> Optional[dict]:
+        raise NotImplementedError
+
+    def update_ticket(self, guild_id: int, num: int, changes: dict) -> Optional[dict]:
+        raise NotImplementedError
+
+    def list_tickets(self, guild_id: int, user_id: int, limit: int = 10) -> list:
+        raise NotImplementedError
+
+    def modify(self, guild_id: int, fn) -> dict:
+        """Атомарно изменить данные сервера: fn получает свежую копию и
+        правит её на месте. Нужно для записей в чужой сервер (в кластере
+        он может принадлежать другому процессу)."""
+        raise NotImplementedError
+
+    def refresh(self) -> list:
+        """Подтянуть изменения других процессов; вернуть ID изменённых серверов."""
+        return []
+
+    def flush(self) -> int:
+        raise NotImplementedError
+
+    def snapshot(self) -> Optional[tuple]:
+        """Снять состояние для compact() в потоке event loop — там же, где
+        обработчики меняют данные серверов. None — снимать нечего."""
+        return None
+
+    def compact(self, snapshot: Optional[tuple] = None):
+        pass
+
+    def close(self):
+        self.compact()
+
+
+# ─── JSON: снапшот + журнал ───────────────────────────────── #
+
+def load_snapshot(path: str) -> dict:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except json.JSONDecodeError as e:
+        # Не затираем данные молча: откладываем битый файл в сторону,
+        # дальше состояние восстановится из журнала.
+        broken = f"{path}.corrupt-{int(time.time())}"
+        os.replace(path, broken)
+        log.error("[DB] %s повреждён (%s), сохранён как %s", path, e, broken)
+        return {}
+
+def save_snapshot(path: str, data):
+    """data — словарь или уже готовый JSON-текст."""
+    if not isinstance(data, str):
+        data = json.dumps(data, ensure_ascii=False)
+    # Пишем во временный файл и атомарно подменяем — при падении на диске
+    # остаётся либо старый, либо новый снапшот, но не обрубок.
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+# ─── Поиск по заметкам ───────────────────────────────────── #
+
+WORD_RE = re.compile(r"\w+")
+
+
+def note_words(text: str) -> list:
+    return [w.casefold() for w in WORD_RE.findall(text or "")]
+
+
+class NoteIndex:
+    """Обратный индекс заметок одного сервера для JSON-хранилища.
+
+    Слово → {id заметки: сколько раз встречается}. Словарь слов держится
+    отсортированным, поэтому поиск по префиксу — бинарный поиск, а не
+    перебор всех заметок. Индекс строится один раз и дальше обновляется
+    на каждую новую/вытесненную заметку.
+    """
+
+    def __init__(self, notes: list):
+        self.terms: dict = {}
+        self.vocab: list = []
+        self.notes: dict = {}
+        for i, note in enumerate(notes):
+            # У старых заметок нет id — они старше всех новых
+            note.setdefault("id", i - len(notes))
+            self.add(note)
+
+    def add(self, note: dict):
+        self.notes[note["id"]] = note
+        for word in note_words(note.get("text")):
+            postings = self.terms.get(word)
+            if postings is None:
+                postings = self.terms[word] = {}
+                insort(self.vocab, word)
+            postings[note["id"]] = postings.get(note["id"], 0) + 1
+
+    def remove(self, note: dict):
+        self.notes.pop(note.get("id"), None)
+        for word in set(note_words(note.get("text"))):
+            postings = self.terms.get(word, {})
+            postings.pop(note.get("id"), None)
+            if not postings and word in self.terms:
+                del self.terms[word]
+                self.vocab.pop(bisect_left(self.vocab, word))
+
+    def _prefix(self, word: str) -> dict:
+        hits: dict = {}
+        i = bisect_left(self.vocab, word)
+        while i < len(self.vocab) and self.vocab[i].startswith(word):
+            for nid, tf in self.terms[self.vocab[i]].items():
+                hits[nid] = hits.get(nid, 0) + tf
+            i += 1
+        return hits
+
+    def search(self, query: str, limit: int, after: Optional[tuple]) -> list:
+        words = note_words(query)
+        if not words:
+            return []
+        # Все слова запроса должны встретиться; очки — сумма вхождений
+        scores = None
+        for word in sorted(words, key=len, reverse=True):
+            hits = self._prefix(word)
+            scores = hits if scores is None else {nid: scores[nid] + tf for nid, tf in hits.items() if nid in scores}
+            if not scores:
+                return []
+        ranked = sorted(((score, nid) for nid, score in scores.items()), reverse=True)
+        if after is not None:
+            ranked = [r for r in ranked if r < tuple(after)]
+        return [{**self.notes[nid], "score": score} for score, nid in ranked[:limit]]
+
+
+class JsonBackend(StorageBackend):
+    """Данные всех серверов в памяти + журнал изменений на диске.
+
+    Каждое изменение — маленькая запись в журнале (варн, заметка, статус,
+    счётчик тикетов или целиком данные сервера). Записи копятся в буфере
+    и сбрасываются пачкой: по таймеру, при переполнении max_pending или
+    сразу (flush=True) для критичных записей. Периодически журнал
+    сворачивается в снапшот. При запуске снапшот читается и поверх него
+    проигрывается журнал.
+    """
+
+    def __init__(self, path: str, journal_path: str, max_pending: int = 50,
+                 journal_max_bytes: int = 1024 * 1024, notes_limit: int = 1000, warn_limit: int = 100):
+        self.path = path
+        self.journal_path = journal_path
+        self.max_pending = max_pending
+        self.journal_max_bytes = journal_max_bytes
+        self.notes_limit = notes_limit
+        self.warn_limit = warn_limit
+        self.data: dict = {}
+        self.seq = 0
+        self.snapshot_seq = 0
+        self.pending: list = []
+        self.note_indexes: dict = {}
+        # Тикеты лежат отдельно от данных серверов (в снапшоте — ключ
+        # __tickets__): put() сервера не переписывает в журнал всю историю
+        # тикетов. Для поиска по каналу и автору — индексы.
+        self.tickets: dict = {}           # guild_id -> {номер: запись}
+        self.ticket_channels: dict = {}   # channel_id -> (guild_id, номер)
+        self.ticket_openers: dict = {}    # (guild_id, opener_id) -> [номера]
+        # seq и применённые записи меняются в потоке хранилища, снапшот
+        # снимается в потоке event loop — лок держит их согласованными
+        self.lock = threading.Lock()
+
+    # ─── Запуск / восстановление ─── #
+
+    def load(self):
+        self.data = load_snapshot(self.path)
+        self.snapshot_seq = self.seq = self.data.pop("__seq__", 0)
+        for key, records in self.data.pop("__tickets__", {}).items():
+            for rec in records.values():
+                self._put_ticket(key, rec)
+        for key, gd in self.data.items():
+            self._take_tickets(key, gd)
+        replayed = 0
+        try:
+            with open(self.journal_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        op = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Оборванная последняя строка после падения
+                        break
+                    if op["seq"] <= self.snapshot_seq:
+                        continue
+                    self._apply(op)
+                    self.seq = op["seq"]
+                    replayed += 1
+        except FileNotFoundError:
+            pass
+        self.pending.clear()
+        if replayed:
+            log.info("[DB] Восстановлено %d изменений из журнала", replayed)
+            self.compact()
+
+    # ─── Чтение ─── #
+
+    def get(self, guild_id: int) -> dict:
+        key = str(guild_id)
+        gd = self.data.get(key)
+        if gd is None:
+            gd = self.data[key] = default_guild_data()
+        return gd
+
+    def list_warns(self, guild_id: int, user_id: int, limit: int = 10, offset: int = 0) -> list:
+        warns = self.get(guild_id).get("warns", {}).get(str(user_id), [])
+        end = len(warns) - offset
+        return warns[max(end - limit, 0):max(end, 0)][::-1]
+
+    def count_warns(self, guild_id: int, user_id: int) -> int:
+        # Список варнов участника ограничен warn_limit, len() — O(1)
+        return len(self.get(guild_id).get("warns", {}).get(str(user_id), []))
+
+    def _note_index(self, guild_id) -> NoteIndex:
+        key = str(guild_id)
+        index = self.note_indexes.get(key)
+        if index is None:
+            index = self.note_indexes[key] = NoteIndex(self.get(key).setdefault("notes", []))
+        return index
+
+    def list_notes(self, guild_id: int, limit: int = 10, before: Optional[int] = None) -> list:
+        self._note_index(guild_id)   # проставит id старым заметкам
+        notes = self.get(guild_id).get("notes", [])
+        end = len(notes) if before is None else bisect_left([n["id"] for n in notes], before)
+        return notes[max(end - limit, 0):end][::-1]
+
+    def search_notes(self, guild_id: int, query: str, limit: int = 10, after: Optional[tuple] = None) -> list:
+        return self._note_index(guild_id).search(query, limit, after)
+
+    def count_notes(self, guild_id: int) -> int:
+        return len(self.get(guild_id).get("notes", []))
+
+    # ─── Изменения ─── #
+
+    def _apply(self, op: dict):
+        gd = self.get(op["g"])
+        kind = op["op"]
+        if kind == "guild":
+            if op["data"] is not gd:
+                self.note_indexes.pop(op["g"], None)
+            self._take_tickets(op["g"], op["data"])
+            self.data[op["g"]] = op["data"]
+        elif kind == "warn":
+            warns = gd.setdefault("warns", {}).setdefault(op["u"], [])
+            warns.append(op["rec"])
+            del warns[:-self.warn_limit]
+        elif kind == "warns_clear":
+            gd.setdefault("warns", {}).pop(op["u"], None)
+        elif kind == "warn_remove":
+            warns = gd.get("warns", {}).get(op["u"], [])
+            warns[:] = [w for w in warns if w.get("id") != op["id"]]
+        elif kind == "warns_expire":
+            for uid in list(gd.get("warns", {})):
+                left = [w for w in gd["warns"][uid] if not w.get("expires_at") or w["expires_at"] > op["now"]]
+                if left:
+                    gd["warns"][uid] = left
+                else:
+                    del gd["warns"][uid]
+        elif kind == "note":
+            notes = gd.setdefault("notes", [])
+            notes.append(op["rec"])
+            index = self.note_indexes.get(op["g"])
+            if index is not None:
+                index.add(op["rec"])
+                for old in notes[:-self.notes_limit]:
+                    index.remove(old)
+            del notes[:-self.notes_limit]
+        elif kind == "status":
+            gd["status"] = op["status"]
+        elif kind == "counter":
+            gd[op["name"]]["counter"] = op["value"]
+        elif kind == "ticket":
+            self._put_ticket(op["g"], op["rec"])
+
+    def _append(self, op: dict):
+        # Только под self.lock
+        self.seq += 1
+        op["seq"] = self.seq
+        self._apply(op)
+        self.pending.append(json.dumps(op, ensure_ascii=False))
+
+    def _record(self, op: dict, flush: bool = False):
+        with self.lock:
+            self._append(op)
+        if flush or len(self.pending) >= self.max_pending:
+            self.flush()
+
+    def put(self, guild_id: int, data: dict, flush: bool = False):
+        self._record({"op": "guild", "g": str(guild_id), "data": data}, flush)
+
+    def add_ticket(self, guild_id: int, record: dict):
+        self._record({"op": "ticket", "g": str(guild_id), "rec": record})
+
+    def _put_ticket(self, key: str, rec: dict):
+        records = self.tickets.setdefault(key, {})
+        num = str(rec["num"])
+        if num not in records:
+            self.ticket_openers.setdefault((key, rec.get("opener_id")), []).append(num)
+        records[num] = rec
+        if rec.get("channel_id") is not None:
+            self.ticket_channels[rec["channel_id"]] = (key, num)
+
+    def _take_tickets(self, key: str, gd: dict):
+        # Старый формат: тикеты внутри данных сервера
+        for rec in gd.pop("ticket_records", {}).values():
+            self._put_ticket(key, rec)
+
+    def get_ticket(self, guild_id: int, num: Optional[int] = None, channel_id: Optional[int] = None) -> Optional[dict]:
+        key = str(guild_id)
+        if num is None:
+            found = self.ticket_channels.get(channel_id)
+            if found is None or found[0] != key:
+                return None
+            num = found[1]
+        return self.tickets.get(key, {}).get(str(num))
+
+    def update_ticket(self, guild_id: int, num: int, changes: dict) -> Optional[dict]:
+        rec = self.get_ticket(guild_id, num)
+        if rec is None:
+            return None
+        rec = {**rec, **changes}
+        self._record({"op": "ticket", "g": str(guild_id), "rec": rec})
+        return rec
+
+    def list_tickets(self, guild_id: int, user_id: int, limit: int = 10) -> list:
+        key = str(guild_id)
+        records = self.tickets.get(key, {})
+        mine = [records[num] for num in self.ticket_openers.get((key, user_id), [])]
+        return sorted(mine, key=lambda r: r["num"])[-limit:]
+
+    def modify(self, guild_id: int, fn) -> dict:
+        # fn и запись — под одним локом: снапшот из потока event loop не
+        # увидит данные, изменённые fn, но ещё не попавшие в журнал
+        with self.lock:
+            gd = self.get(guild_id)
+            fn(gd)
+            self._append({"op": "guild", "g": str(guild_id), "data": gd})
+        if len(self.pending) >= self.max_pending:
+            self.flush()
+        return gd
+
+    def add_warn(self, guild_id: int, user_id: int, record: dict) -> int:
+        # id варна — номер записи в журнале, он уникален в пределах базы
+        record = {**record, "id": self.seq + 1}
+        self._record({"op": "warn", "g": str(guild_id), "u": str(user_id), "rec": record})
+        return self.count_warns(guild_id, user_id)
+
+    def remove_warn(self, guild_id: int, warn_id: int) -> Optional[str]:
+        for uid, warns in self.get(guild_id).get("warns", {}).items():
+            if any(w.get("id") == warn_id for w in warns):
+                self._record({"op": "warn_remove", "g": str(guild_id), "u": uid, "id": warn_id})
+                return uid
+        return None
+
+    def sweep_warns(self, now: float) -> int:
+        removed = 0
+        for key, gd in list(self.data.items()):
+            expired = sum(1 for warns in gd.get("warns", {}).values()
+                          for w in warns if w.get("expires_at") and w["expires_at"] <= now)
+            if expired:
+                self._record({"op": "warns_expire", "g": key, "now": now})
+                removed += expired
+        return removed
+
+    def clear_warns(self, guild_id: int, user_id: int) -> int:
+        old = self.count_warns(guild_id, user_id)
+        self._record({"op": "warns_clear", "g": str(guild_id), "u": str(user_id)})
+        return old
+
+    def add_note(self, guild_id: int, record: dict):
+        record = {**record, "id": self.seq + 1}
+        self._record({"op": "note", "g": str(guild_id), "rec": record})
+
+    def set_status(self, guild_id: int, status: dict):
+        self._record({"op": "status", "g": str(guild_id), "status": status})
+
+    def next_ticket(self, guild_id: int) -> int:
+        num = self.get(guild_id)["tickets"]["counter"] + 1
+        self._record({"op": "counter", "g": str(guild_id), "name": "tickets", "value": num}, flush=True)
+        return num
+
+    # ─── Запись на диск ─── #
+
+    def _write_journal(self) -> int:
+        if not self.pending:
+            return 0
+        count = len(self.pending)
+        chunk = memoryview(("\n".join(self.pending) + "\n").encode("utf-8"))
+        # Без буфера: при ошибке в файле ровно то, что успело записаться,
+        # и откат ниже его убирает
+        with open(self.journal_path, "ab", buffering=0) as f:
+            start = f.seek(0, os.SEEK_END)
+            try:
+                while chunk:
+                    chunk = chunk[f.write(chunk):]
+                os.fsync(f.fileno())
+            except OSError:
+                # Обрубок посреди журнала остановил бы восстановление на себе:
+                # откатываем хвост, записи остаются в pending до следующего сброса
+                f.truncate(start)
+                raise
+        self.pending.clear()
+        return count
+
+    def flush(self) -> int:
+        count = self._write_journal()
+        try:
+            if os.path.getsize(self.journal_path) >= self.journal_max_bytes:
+                # Сворачивать здесь нельзя: снапшот снимается в потоке
+                # event loop, AsyncStorage сделает это после операции
+                self.compact_due = True
+        except OSError:
+            pass
+        return count
+
+    def snapshot(self) -> Optional[tuple]:
+        """(seq, JSON-текст) всех данных. Вызывается в потоке event loop:
+        обработчики меняют вложенные словари серверов только там, а записи
+        из потока хранилища отделены локом. Сериализация целиком в памяти —
+        поток хранилища получит готовый текст и только запишет его."""
+        with self.lock:
+            if self.seq == self.snapshot_seq:
+                return None
+            return self.seq, json.dumps({"__seq__": self.seq, "__tickets__": self.tickets, **self.data}, ensure_ascii=False)
+
+    def compact(self, snapshot: Optional[tuple] = None):
+        """Свернуть журнал в снапшот. Сначала атомарно пишем снапшот с номером
+        последней записи, потом убираем из журнала то, что в него вошло —
+        если упадём между ними, учтённые записи при восстановлении отсеются
+        по seq. Без snapshot снимок делается здесь же — так можно только
+        когда других потоков нет (load, close)."""
+        self._write_journal()
+        if snapshot is None:
+            snapshot = self.snapshot()
+        if snapshot is None:
+            return
+        seq, text = snapshot
+        save_snapshot(self.path, text)
+        self.snapshot_seq = seq
+        self.compact_due = False
+        # Записи, сделанные после снимка, остаются в журнале
+        newer = []
+        try:
+            with open(self.journal_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        if json.loads(line)["seq"] > seq:
+                            newer.append(line)
+                    except (json.JSONDecodeError, KeyError):
+                        break   # оборванная строка после падения
+        except FileNotFoundError:
+            pass
+        # Как и снапшот — через временный файл, чтобы падение посреди
+        # перезаписи не оставило обрезанный журнал
+        tmp = self.journal_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.writelines(newer)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.journal_path)
+
+
+# ─── SQLite (WAL) ─────────────────────────────────────────── #
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS guilds (
+    guild_id TEXT PRIMARY KEY,
+    data     TEXT NOT NULL,
+    rev      INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS counters (
+    guild_id TEXT NOT NULL,
+    name     TEXT NOT NULL,
+    value    INTEGER NOT NULL,
+    PRIMARY KEY (guild_id, name)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('rev', 0);
+CREATE TABLE IF NOT EXISTS warns (
+    id         INTEGER PRIMARY KEY AUTOINCREMENT,
+    guild_id   TEXT NOT NULL,
+    user_id    TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    data       TEXT NOT NULL,
+    expires_at REAL
+);
+CREATE INDEX IF NOT EXISTS warns_by_user ON warns (guild_id, user_id, created_at);
+CREATE INDEX IF NOT EXISTS warns_by_expiry ON warns (expires_at) WHERE expires_at IS NOT NULL;
+CREATE TABLE IF NOT EXISTS warn_counts (
+    guild_id TEXT NOT NULL,
+    user_id  TEXT NOT NULL,
+    count    INTEGER NOT NULL,
+    PRIMARY KEY (guild_id, user_id)
+);
+CREATE TABLE IF NOT EXISTS notes (
+    id         INTEGER PRIMARY KEY AUTOINCREMENT,
+    guild_id   TEXT NOT NULL,
+    user_id    TEXT,
+    created_at REAL NOT NULL,
+    data       TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS notes_by_guild ON notes (guild_id, created_at);
+CREATE INDEX IF NOT EXISTS notes_by_id ON notes (guild_id, id);
+CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5 (text, content='notes', content_rowid='id');
+CREATE INDEX IF NOT EXISTS guilds_by_rev ON guilds (rev);
+CREATE TABLE IF NOT EXISTS tickets (
+    guild_id   TEXT NOT NULL,
+    num        INTEGER NOT NULL,
+    opener_id  INTEGER NOT NULL,
+    channel_id INTEGER,
+    opened_at  REAL NOT NULL,
+    data       TEXT NOT NULL,
+    PRIMARY KEY (guild_id, num)
+);
+CREATE INDEX IF NOT EXISTS tickets_by_opener ON tickets (guild_id, opener_id, opened_at);
+CREATE INDEX IF NOT EXISTS tickets_by_channel ON tickets (channel_id);
+"""
+
+
+def merge_changes(base: dict, ours: dict, theirs: dict) -> dict:
+    """Трёхстороннее слияние данных сервера: к версии theirs применяются
+    изменения, которые ours внёс относительно base. Вложенные словари
+    сливаются по ключам, остальные значения (списки, числа) — целиком."""
+    result = dict(theirs)
+    for k in set(base) | set(ours):
+        if k not in ours:
+            result.pop(k, None)
+        elif k in base and ours[k] == base[k]:
+            continue
+        elif isinstance(ours[k], dict) and isinstance(base.get(k), dict) and isinstance(theirs.get(k), dict):
+            result[k] = merge_changes(base[k], ours[k], theirs[k])
+        else:
+            result[k] = ours[k]
+    return result
+
+
+class SqliteBackend(StorageBackend):
+    """Встроенная SQLite в режиме WAL.
+
+    Настройки/статус/тикеты сервера лежат одной строкой в guilds и
+    держатся в памяти. Варны и заметки — отдельные строки с индексами,
+    поэтому /warns и /notes читают только последние записи, а новая
+    запись трогает одну строку. Транзакция коммитится в flush().
+
+    shared=True — режим кластера: одну базу делят несколько процессов.
+    Каждая запись коммитится сразу под BEGIN IMMEDIATE (блокировка на
+    запись между процессами), у каждой строки guilds есть номер ревизии,
+    и refresh() подтягивает строки, изменённые другими процессами.
+    put() сверяет ревизию строки с той, что процесс видел последней: если
+    другой процесс успел её перезаписать, на его версию переносятся только
+    поля, изменённые этим процессом (merge_changes), а не вся копия.
+    Счётчики тикетов увеличиваются атомарно в таблице counters.
+    """
+
+    def __init__(self, path: str, import_from: Optional[str] = None, max_pending: int = 50, shared: bool = False,
+                 warn_limit: int = 100):
+        self.path = path
+        self.warn_limit = warn_limit
+        self.import_from = import_from
+        self.max_pending = 1 if shared else max_pending
+        self.shared = shared
+        self.conn: Optional[sqlite3.Connection] = None
+        self.guilds: dict = {}
+        self.bases: dict = {}   # shared: guild_id -> (ревизия, JSON) последней виденной версии
+        self.rev = 0
+        self.pending = 0
+        self.in_tx = False
+
+    def load(self):
+        # Соединение используется из потока AsyncStorage, доступ к нему
+        # сериализован, поэтому проверка потока не нужна. Транзакциями
+        # управляем сами (isolation_level=None).
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        columns = [r[1] for r in self.conn.execute("PRAGMA table_info(guilds)")]
+        if columns and "rev" not in columns:
+            self.conn.execute("ALTER TABLE guilds ADD COLUMN rev INTEGER NOT NULL DEFAULT 0")
+        columns = [r[1] for r in self.conn.execute("PRAGMA table_info(warns)")]
+        if columns and "expires_at" not in columns:
+            self.conn.execute("ALTER TABLE warns ADD COLUMN expires_at REAL")
+        had_counts = bool(self.conn.execute("SELECT name FROM sqlite_master WHERE name = 'warn_counts'").fetchone())
+        had_fts = bool(self.conn.execute("SELECT name FROM sqlite_master WHERE name = 'notes_fts'").fetchone())
+        self.conn.executescript(SQLITE_SCHEMA)
+        if not had_fts:
+            self.conn.execute("INSERT INTO notes_fts (rowid, text) SELECT id, json_extract(data, '$.text') FROM notes")
+        if not had_counts:
+            self.conn.execute("INSERT OR IGNORE INTO warn_counts (guild_id, user_id, count) "
+                              "SELECT guild_id, user_id, COUNT(*) FROM warns GROUP BY guild_id, user_id")
+        for key, data, rev in self.conn.execute("SELECT guild_id, data, rev FROM guilds"):
+            self._seen(key, data, rev)
+            self.rev = max(self.rev, rev)
+        if not self.guilds and self.import_from and os.path.exists(self.import_from):
+            self._import_json(self.import_from)
+
+    def _import_json(self, path: str):
+        """Первый запуск на SQLite — переносим данные из database.json."""
+        data = load_snapshot(path)
+        data.pop("__seq__", None)
+        tickets = data.pop("__tickets__", {})
+        now = time.time()
+        for key, gd in data.items():
+            self._begin()
+            records = {**gd.get("ticket_records", {}), **tickets.get(key, {})}
+            for rec in records.values():
+                self._write_ticket(key, {"opened_at": now, **rec})
+            for uid, warns in gd.get("warns", {}).items():
+                for w in warns:
+                    self.conn.execute("INSERT INTO warns (guild_id, user_id, created_at, data, expires_at) VALUES (?, ?, ?, ?, ?)",
+                                      (key, uid, w.get("created_at", now), json.dumps(w, ensure_ascii=False), w.get("expires_at")))
+                self.conn.execute("INSERT OR REPLACE INTO warn_counts (guild_id, user_id, count) VALUES (?, ?, ?)",
+                                  (key, uid, len(warns)))
+            for n in gd.get("notes", []):
+                self._insert_note(key, now, {k: v for k, v in n.items() if k != "id"})
+            self.put(key, gd)
+        self.flush()
+        log.info("[DB] Импортировано %d серверов из %s", len(data), path)
+
+    # ─── Настройки сервера ─── #
+
+    def get(self, guild_id: int) -> dict:
+        key = str(guild_id)
+        gd = self.guilds.get(key)
+        if gd is None:
+            gd = self.guilds[key] = self._default()
+        return gd
+
+    @staticmethod
+    def _default() -> dict:
+        gd = default_guild_data()
+        del gd["warns"], gd["notes"]
+        return gd
+
+    def _resident(self, key: str, data: dict) -> dict:
+        """Положить data в словарь сервера, который держит память. Объект
+        не подменяется: get() всегда отдаёт один и тот же словарь (как в
+        JSON-движке), иначе обработчик, взявший его раньше, записал бы
+        назад устаревшую копию поверх чужих изменений."""
+        gd = self.guilds.get(key)
+        if gd is None:
+            gd = self.guilds[key] = data
+        elif gd is not data:
+            gd.clear()
+            gd.update(data)
+        for k in ("warns", "notes", "ticket_records"):
+            gd.pop(k, None)
+        return gd
+
+    def _seen(self, key: str, text: str, rev: int):
+        self._resident(key, json.loads(text))
+        if self.shared:
+            self.bases[key] = (rev, text)
+
+    def _write_guild(self, key: str, data: dict):
+        data = self._resident(key, data)
+        self.conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'rev'")
+        rev = self.conn.execute("SELECT value FROM meta WHERE key = 'rev'").fetchone()[0]
+        text = json.dumps(data, ensure_ascii=False)
+        self.conn.execute("INSERT OR REPLACE INTO guilds (guild_id, data, rev) VALUES (?, ?, ?)", (key, text, rev))
+        if self.shared:
+            self.bases[key] = (rev, text)
+
+    def _rebase(self, key: str, data: dict) -> dict:
+        """Внутри BEGIN IMMEDIATE: если строку после нашего чтения записал
+        другой процесс, перенести наши изменения на его версию."""
+        row = self.conn.execute("SELECT data, rev FROM guilds WHERE guild_id = ?", (key,)).fetchone()
+        base_rev, base_text = self.bases.get(key, (None, None))
+        if row is None or row[1] == base_rev:
+            return data
+        # Без base процесс строку не видел, и data выросла из пустых данных
+        # get(): изменениями считаем только отличия от них, иначе значения
+        # по умолчанию затёрли бы всё, что записал другой процесс
+        base = json.loads(base_text) if base_text else self._default()
+        return merge_changes(base, data, json.loads(row[0]))
+
+    def put(self, guild_id: int, data: dict, flush: bool = False):
+        key = str(guild_id)
+        self._begin()
+        if self.shared:
+            data = self._rebase(key, data)
+        self._write_guild(key, data)
+        self._written(flush)
+
+    def modify(self, guild_id: int, fn) -> dict:
+        key = str(guild_id)
+        self._begin()
+        row = self.conn.execute("SELECT data FROM guilds WHERE guild_id = ?", (key,)).fetchone()
+        gd = json.loads(row[0]) if row else self.get(guild_id)
+        fn(gd)
+        self._write_guild(key, gd)
+        self._written(flush=True)
+        return gd
+
+    def refresh(self) -> list:
+        if not self.shared:
+            return []
+        changed = []
+        for key, data, rev in self.conn.execute("SELECT guild_id, data, rev FROM guilds WHERE rev > ?", (self.rev,)):
+            self._seen(key, data, rev)
+            self.rev = max(self.rev, rev)
+            changed.append(key)
+        return changed
+
+    def set_status(self, guild_id: int, status: dict):
+        gd = self.get(guild_id)
+        gd["status"] = status
+        self.put(guild_id, gd)
+
+    def next_ticket(self, guild_id: int) -> int:
+        # Счётчик живёт в своей таблице и увеличивается одной транзакцией —
+        # два процесса не получат один и тот же номер
+        key = str(guild_id)
+        gd = self.get(guild_id)
+        self._begin()
+        self.conn.execute("INSERT OR IGNORE INTO counters (guild_id, name, value) VALUES (?, 'tickets', ?)",
+                          (key, gd["tickets"]["counter"]))
+        self.conn.execute("UPDATE counters SET value = value + 1 WHERE guild_id = ? AND name = 'tickets'", (key,))
+        num = self.conn.execute("SELECT value FROM counters WHERE guild_id = ? AND name = 'tickets'", (key,)).fetchone()[0]
+        self._written(flush=True)
+        gd["tickets"]["counter"] = num
+        return num
+
+    # ─── Тикеты ─── #
+
+    def _write_ticket(self, guild_id: int, record: dict):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO tickets (guild_id, num, opener_id, channel_id, opened_at, data) VALUES (?, ?, ?, ?, ?, ?)",
+            (str(guild_id), record["num"], record["opener_id"], record.get("channel_id"), record["opened_at"],
+             json.dumps(record, ensure_ascii=False)))
+
+    def add_ticket(self, guild_id: int, record: dict):
+        self._begin()
+        self._write_ticket(guild_id, record)
+        self._written()
+
+    def get_ticket(self, guild_id: int, num: Optional[int] = None, channel_id: Optional[int] = None) -> Optional[dict]:
+        if num is not None:
+            row = self.conn.execute("SELECT data FROM tickets WHERE guild_id = ? AND num = ?", (str(guild_id), num)).fetchone()
+        else:
+            row = self.conn.execute("SELECT data FROM tickets WHERE channel_id = ?", (channel_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update_ticket(self, guild_id: int, num: int, changes: dict) -> Optional[dict]:
+        self._begin()
+        rec = self.get_ticket(guild_id, num)
+        if rec is not None:
+            rec = {**rec, **changes}
+            self._write_ticket(guild_id, rec)
+        self._written(flush=True)
+        return rec
+
+    def list_tickets(self, guild_id: int, user_id: int, limit: int = 10) -> list:
+        rows = self.conn.execute(
+            "SELECT data FROM tickets WHERE guild_id = ? AND opener_id = ? ORDER BY opened_at DESC LIMIT ?",
+            (str(guild_id), user_id, limit)).fetchall()
+        return [json.loads(r[0]) for r in reversed(rows)]
+
+    # ─── Варны ─── #
+
+    def _bump_count(self, key: str, uid: str, delta: int) -> int:
+        self.conn.execute("INSERT OR IGNORE INTO warn_counts (guild_id, user_id, count) VALUES (?, ?, 0)", (key, uid))
+        self.conn.execute("UPDATE warn_counts SET count = MAX(count + ?, 0) WHERE guild_id = ? AND user_id = ?", (delta, key, uid))
+        return self.conn.execute("SELECT count FROM warn_counts WHERE guild_id = ? AND user_id = ?", (key, uid)).fetchone()[0]
+
+    def add_warn(self, guild_id: int, user_id: int, record: dict) -> int:
+        key, uid = str(guild_id), str(user_id)
+        self._begin()
+        self.conn.execute("INSERT INTO warns (guild_id, user_id, created_at, data, expires_at) VALUES (?, ?, ?, ?, ?)",
+                          (key, uid, record.get("created_at", time.time()), json.dumps(record, ensure_ascii=False),
+                           record.get("expires_at")))
+        count = self._bump_count(key, uid, 1)
+        if count > self.warn_limit:
+            # Храним не больше warn_limit последних варнов на участника
+            self.conn.execute(
+                "DELETE FROM warns WHERE id IN (SELECT id FROM warns WHERE guild_id = ? AND user_id = ? "
+                "ORDER BY created_at, id LIMIT ?)", (key, uid, count - self.warn_limit))
+            count = self._bump_count(key, uid, self.warn_limit - count)
+        self._written()
+        return count
+
+    def list_warns(self, guild_id: int, user_id: int, limit: int = 10, offset: int = 0) -> list:
+        rows = self.conn.execute(
+            "SELECT id, data FROM warns WHERE guild_id = ? AND user_id = ? ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?",
+            (str(guild_id), str(user_id), limit, offset)).fetchall()
+        return [{**json.loads(data), "id": wid} for wid, data in rows]
+
+    def count_warns(self, guild_id: int, user_id: int) -> int:
+        row = self.conn.execute("SELECT count FROM warn_counts WHERE guild_id = ? AND user_id = ?",
+                                (str(guild_id), str(user_id))).fetchone()
+        return row[0] if row else 0
+
+    def clear_warns(self, guild_id: int, user_id: int) -> int:
+        self._begin()
+        cur = self.conn.execute("DELETE FROM warns WHERE guild_id = ? AND user_id = ?", (str(guild_id), str(user_id)))
+        self.conn.execute("DELETE FROM warn_counts WHERE guild_id = ? AND user_id = ?", (str(guild_id), str(user_id)))
+        self._written()
+        return cur.rowcount
+
+    def remove_warn(self, guild_id: int, warn_id: int) -> Optional[str]:
+        key = str(guild_id)
+        row = self.conn.execute("SELECT user_id FROM warns WHERE guild_id = ? AND id = ?", (key, warn_id)).fetchone()
+        if row is None:
+            return None
+        self._begin()
+        self.conn.execute("DELETE FROM warns WHERE id = ?", (warn_id,))
+        self._bump_count(key, row[0], -1)
+        self._written()
+        return row[0]
+
+    def sweep_warns(self, now: float) -> int:
+        self._begin()
+        groups = self.conn.execute(
+            "SELECT guild_id, user_id, COUNT(*) FROM warns WHERE expires_at IS NOT NULL AND expires_at <= ? "
+            "GROUP BY guild_id, user_id", (now,)).fetchall()
+        self.conn.execute("DELETE FROM warns WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+        for key, uid, n in groups:
+            self._bump_count(key, uid, -n)
+        self._written(flush=True)
+        return sum(n for _, _, n in groups)
+
+    # ─── Заметки ─── #
+
+    def _insert_note(self, key: str, created_at: float, record: dict):
+        # notes_fts — внешний FTS5-индекс над notes, текст кладём туда же
+        cur = self.conn.execute("INSERT INTO notes (guild_id, user_id, created_at, data) VALUES (?, ?, ?, ?)",
+                                (key, record.get("by_id"), created_at, json.dumps(record, ensure_ascii=False)))
+        self.conn.execute("INSERT INTO notes_fts (rowid, text) VALUES (?, ?)", (cur.lastrowid, record.get("text", "")))
+
+    def add_note(self, guild_id: int, record: dict):
+        self._begin()
+        self._insert_note(str(guild_id), time.time(), record)
+        self._written()
+
+    def list_notes(self, guild_id: int, limit: int = 10, before: Optional[int] = None) -> list:
+        rows = self.conn.execute(
+            "SELECT id, data FROM notes WHERE guild_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+            (str(guild_id), before if before is not None else 2 ** 63 - 1, limit)).fetchall()
+        return [{**json.loads(data), "id": nid} for nid, data in rows]
+
+    def search_notes(self, guild_id: int, query: str, limit: int = 10, after: Optional[tuple] = None) -> list:
+        words = note_words(query)
+        if not words:
+            return []
+        match = " ".join(f'"{w}"*' for w in words)
+        score, last = after if after is not None else (float("inf"), 0)
+        # bm25() меньше — лучше, переворачиваем знак, чтобы score рос с релевантностью
+        rows = self.conn.execute(
+            "SELECT id, data, score FROM ("
+            " SELECT n.id AS id, n.data AS data, -bm25(notes_fts) AS score"
+            " FROM notes_fts JOIN notes n ON n.id = notes_fts.rowid"
+            " WHERE notes_fts MATCH ? AND n.guild_id = ?)"
+            " WHERE score < ? OR (score = ? AND id < ?)"
+            " ORDER BY score DESC, id DESC LIMIT ?",
+            (match, str(guild_id), score, score, last, limit)).fetchall()
+        return [{**json.loads(data), "id": nid, "score": s} for nid, data, s in rows]
+
+    def count_notes(self, guild_id: int) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM notes WHERE guild_id = ?", (str(guild_id),)).fetchone()[0]
+
+    # ─── Запись на диск ─── #
+
+    def _begin(self):
+        if not self.in_tx:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.in_tx = True
+
+    def _written(self, flush: bool = False):
+        self.pending += 1
+        if flush or self.pending >= self.max_pending:
+            self.flush()
+
+    def flush(self) -> int:
+        count, self.pending = self.pending, 0
+        if self.in_tx:
+            self.conn.execute("COMMIT")
+            self.in_tx = False
+        return count
+
+    def compact(self, snapshot: Optional[tuple] = None):
+        self.flush()
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        if self.conn:
+            self.compact()
+            self.conn.close()
+            self.conn = None
+
+
+def open_storage(kind: str, **options) -> StorageBackend:
+    if kind == "sqlite":
+        return SqliteBackend(options.get("sqlite_file", "database.sqlite3"), import_from=options.get("json_file"),
+                             max_pending=options.get("max_pending", 50), shared=options.get("shared", False),
+                             warn_limit=options.get("warn_limit", 100))
+    return JsonBackend(options.get("json_file", "database.json"), options.get("journal_file", "database.journal"),
+                       max_pending=options.get("max_pending", 50),
+                       journal_max_bytes=options.get("journal_max_bytes", 1024 * 1024),
+                       notes_limit=options.get("notes_limit", 1000), warn_limit=options.get("warn_limit", 100))
+
+
+# ─── Асинхронная обёртка ──────────────────────────────────── #
+
+class AsyncStorage:
+    """Неблокирующий доступ к хранилищу из обработчиков.
+
+    Все операции с диском выполняются в одном отдельном потоке — записи
+    сериализованы, а event loop (heartbeat, другие команды) не ждёт их.
+    get() читает данные сервера из памяти и остаётся синхронным.
+
+    observe(операция, секунды, ошибка) — необязательный хук для метрик:
+    вызывается после каждой операции, время включает ожидание очереди.
+    """
+
+    def __init__(self, backend: StorageBackend):
+        self.backend = backend
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+        self.observe = None
+
+    async def _run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        failed = False
+        try:
+            result = await loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+        except Exception:
+            failed = True
+            raise
+        finally:
+            if self.observe is not None:
+                self.observe(fn.__name__, time.perf_counter() - started, failed)
+        if self.backend.compact_due:
+            self.backend.compact_due = False
+            await self.compact()
+        return result
+
+    def load(self):
+        self.backend.load()
+
+    def get(self, guild_id: int) -> dict:
+        return self.backend.get(guild_id)
+
+    async def put(self, guild_id: int, data: dict, flush: bool = False):
+        return await self._run(self.backend.put, guild_id, data, flush)
+
+    async def set_status(self, guild_id: int, status: dict):
+        return await self._run(self.backend.set_status, guild_id, status)
+
+    async def next_ticket(self, guild_id: int) -> int:
+        return await self._run(self.backend.next_ticket, guild_id)
+
+    async def add_warn(self, guild_id: int, user_id: int, record: dict) -> int:
+        return await self._run(self.backend.add_warn, guild_id, user_id, record)
+
+    async def list_warns(self, guild_id: int, user_id: int, limit: int = 10, offset: int = 0) -> list:
+        return await self._run(self.backend.list_warns, guild_id, user_id, limit, offset)
+
+    async def count_warns(self, guild_id: int, user_id: int) -> int:
+        return await self._run(self.backend.count_warns, guild_id, user_id)
+
+    async def clear_warns(self, guild_id: int, user_id: int) -> int:
+        return await self._run(self.backend.clear_warns, guild_id, user_id)
+
+    async def remove_warn(self, guild_id: int, warn_id: int) -> Optional[str]:
+        return await self._run(self.backend.remove_warn, guild_id, warn_id)
+
+    async def sweep_warns(self, now: float) -> int:
+        return await self._run(self.backend.sweep_warns, now)
+
+    async def add_note(self, guild_id: int, record: dict):
+        return await self._run(self.backend.add_note, guild_id, record)
+
+    async def list_notes(self, guild_id: int, limit: int = 10, before: Optional[int] = None) -> list:
+        return await self._run(self.backend.list_notes, guild_id, limit, before)
+
+    async def search_notes(self, guild_id: int, query: str, limit: int = 10, after: Optional[tuple] = None) -> list:
+        return await self._run(self.backend.search_notes, guild_id, query, limit, after)
+
+    async def count_notes(self, guild_id: int) -> int:
+        return await self._run(self.backend.count_notes, guild_id)
+
+    async def add_ticket(self, guild_id: int, record: dict):
+        return await self._run(self.backend.add_ticket, guild_id, record)
+
+    async def get_ticket(self, guild_id: int, num: Optional[int] = None, channel_id: Optional[int] = None) -> Optional[dict]:
+        return await self._run(self.backend.get_ticket, guild_id, num, channel_id)
+
+    async def update_ticket(self, guild_id: int, num: int, changes: dict) -> Optional[dict]:
+        return await self._run(self.backend.update_ticket, guild_id, num, changes)
+
+    async def list_tickets(self, guild_id: int, user_id: int, limit: int = 10) -> list:
+        return await self._run(self.backend.list_tickets, guild_id, user_id, limit)
+
+    async def modify(self, guild_id: int, fn) -> dict:
+        return await self._run(self.backend.modify, guild_id, fn)
+
+    async def refresh(self) -> list:
+        return await self._run(self.backend.refresh)
+
+    async def flush(self) -> int:
+        return await self._run(self.backend.flush)
+
+    async def compact(self):
+        # Снимок — здесь, в потоке event loop; в поток хранилища уходит
+        # только запись готового текста
+        return await self._run(self.backend.compact, self.backend.snapshot())
+
+    def close(self):
+        # Дожидаемся записей, которые уже стоят в очереди потока
+        self.executor.shutdown(wait=True)
+        self.backend.close()